@@ -0,0 +1,114 @@
+# pylint: skip-file
+"""Memory-versus-speed benchmark of activation checkpointing in the U-Net score models.
+
+Runs training steps of the model in `--config` under several checkpointing policies and reports
+the time per step and the activation memory. The latter is the peak allocated CUDA memory on GPU
+and the total size of the tensors saved for the backward pass otherwise.
+
+  python -m benchmarks.checkpointing --config configs/vp/cifar10_ddpmpp_deep_continuous.py
+"""
+
+import time
+
+import torch
+from absl import app
+from absl import flags
+from ml_collections.config_flags import config_flags
+
+import losses
+import run_lib
+from models import utils as mutils
+from models import ddpm, ncsnv2, ncsnpp
+
+FLAGS = flags.FLAGS
+
+config_flags.DEFINE_config_file("config", None, "Model configuration.", lock_config=False)
+flags.DEFINE_integer("batch_size", None, "Batch size; defaults to config.training.batch_size.")
+flags.DEFINE_integer("steps", 10, "Timed training steps per policy.")
+flags.DEFINE_integer("warmup_steps", 2, "Untimed training steps per policy.")
+flags.mark_flags_as_required(["config"])
+
+
+def _policies(config):
+  """Checkpointing policies to compare: (name, module kinds, resolutions)."""
+  resolutions = [config.data.image_size // (2 ** i) for i in range(len(config.model.ch_mult))]
+  policies = [('none', (), ()),
+              ('attn', ('attn',), ()),
+              ('resblock', ('resblock',), ()),
+              ('all', ('resblock', 'attn'), ())]
+  policies += [(f'all@{res}', ('resblock', 'attn'), (res,)) for res in resolutions]
+  return policies
+
+
+class _SavedTensorBytes:
+  """Sums the bytes of the tensors autograd saves for the backward pass."""
+
+  def __init__(self):
+    self.nbytes = 0
+
+  def pack(self, tensor):
+    self.nbytes += tensor.numel() * tensor.element_size()
+    return tensor
+
+  def hooks(self):
+    return torch.autograd.graph.saved_tensors_hooks(self.pack, lambda tensor: tensor)
+
+
+def benchmark(config, batch_size, steps, warmup_steps):
+  cuda = torch.device(config.device).type == 'cuda'
+  sde, _ = run_lib._get_sde(config)
+  x = torch.rand(batch_size, config.data.num_channels, config.data.image_size, config.data.image_size,
+                 device=config.device)
+  results = []
+  for name, kinds, resolutions in _policies(config):
+    config.model.checkpoint_modules = kinds
+    config.model.checkpoint_resolutions = resolutions
+    torch.manual_seed(config.seed)
+    model = mutils.create_model(config)
+    optimizer = torch.optim.Adam(model.parameters(), lr=config.optim.lr)
+    loss_fn = losses.get_sde_loss_fn(sde, train=True, reduce_mean=config.training.reduce_mean,
+                                     continuous=config.training.continuous,
+                                     likelihood_weighting=config.training.likelihood_weighting)
+
+    def step(counter=None):
+      optimizer.zero_grad(set_to_none=True)
+      if counter is None:
+        loss = loss_fn(model, x)
+      else:
+        with counter.hooks():
+          loss = loss_fn(model, x)
+      loss.backward()
+      optimizer.step()
+
+    for _ in range(warmup_steps):
+      step()
+    if cuda:
+      torch.cuda.synchronize()
+      torch.cuda.reset_peak_memory_stats()
+    # Checkpointed blocks save only their inputs, which the hooks see in the forward pass
+    counter = _SavedTensorBytes()
+    step(counter)
+    start = time.perf_counter()
+    for _ in range(steps):
+      step()
+    if cuda:
+      torch.cuda.synchronize()
+    ms = 1e3 * (time.perf_counter() - start) / steps
+    memory_mb = (torch.cuda.max_memory_allocated() if cuda else counter.nbytes) / 2 ** 20
+    results.append((name, ms, memory_mb))
+    del model, optimizer
+
+  print(f"{'policy':<12}{'ms/step':>10}{'rel':>7}{'memory MB':>12}{'rel':>7}")
+  base_ms, base_mb = results[0][1], results[0][2]
+  for name, ms, memory_mb in results:
+    print(f"{name:<12}{ms:>10.1f}{ms / base_ms:>7.2f}{memory_mb:>12.1f}{memory_mb / base_mb:>7.2f}")
+  return results
+
+
+def main(argv):
+  config = FLAGS.config
+  benchmark(config, FLAGS.batch_size or config.training.batch_size, FLAGS.steps, FLAGS.warmup_steps)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,58 @@
+# pylint: skip-file
+"""Read throughput of the training data loader for different numbers of worker processes.
+
+Iterates over the training loader of `--config` with every value of `--num_workers` (-1 is one
+worker per available CPU core) and reports samples/sec and MB/sec. Worker start-up is excluded
+by discarding the first `--warmup_batches` batches.
+
+  python -m benchmarks.data_loading --config configs/vp/nc_ddpmpp.py --num_workers 0,2,4,8,-1
+"""
+
+import time
+
+from absl import app
+from absl import flags
+from ml_collections.config_flags import config_flags
+
+import datasets
+
+FLAGS = flags.FLAGS
+
+config_flags.DEFINE_config_file("config", None, "Data configuration.", lock_config=False)
+flags.DEFINE_list("num_workers", ["0", "1", "2", "4", "8", "-1"], "Worker counts to compare.")
+flags.DEFINE_integer("batches", 50, "Timed batches per setting.")
+flags.DEFINE_integer("warmup_batches", 5, "Untimed batches per setting.")
+flags.mark_flags_as_required(["config"])
+
+
+def benchmark(config, num_workers, batches, warmup_batches):
+  results = []
+  for workers in num_workers:
+    config.data.num_workers = workers
+    train_ds, _ = datasets.get_dataset(config, uniform_dequantization=config.data.uniform_dequantization)
+    loader = iter(train_ds)
+    for _ in range(warmup_batches):
+      next(loader)
+    samples, nbytes = 0, 0
+    start = time.perf_counter()
+    for _ in range(batches):
+      batch = next(loader)
+      batch = batch[0] if isinstance(batch, (list, tuple)) else batch
+      samples += batch.shape[0]
+      nbytes += batch.numel() * batch.element_size()
+    elapsed = time.perf_counter() - start
+    results.append((datasets._num_workers(workers), samples / elapsed, nbytes / elapsed / 2 ** 20))
+    del loader, train_ds
+
+  print(f"{'workers':>8}{'samples/s':>12}{'MB/s':>10}{'speedup':>9}")
+  for workers, samples_per_sec, mb_per_sec in results:
+    print(f"{workers:>8}{samples_per_sec:>12.1f}{mb_per_sec:>10.1f}{samples_per_sec / results[0][1]:>9.2f}")
+  return results
+
+
+def main(argv):
+  benchmark(FLAGS.config, [int(n) for n in FLAGS.num_workers], FLAGS.batches, FLAGS.warmup_batches)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,78 @@
+# pylint: skip-file
+"""Throughput of the on-device inpainting mask generators.
+
+Generates `--num_masks` masks of every kind in batches of `--batch_size`, each with its own seed,
+and reports masks/sec. For comparison the random masks of `datasets.get_mask_dataset`, which
+are drawn through a DataLoader, are timed as well.
+
+  python -m benchmarks.masks --config configs/inverse/nc_ddpmpp_rndinpaint_dps.py
+"""
+
+import time
+
+import torch
+from absl import app
+from absl import flags
+from ml_collections.config_flags import config_flags
+
+import datasets
+from inverse import masks
+
+FLAGS = flags.FLAGS
+
+config_flags.DEFINE_config_file("config", None, "Inverse problem configuration.", lock_config=False)
+flags.DEFINE_list("kinds", ["random", "box", "stroke", "land"], "Mask kinds to compare.")
+flags.DEFINE_integer("num_masks", 4096, "Masks per kind.")
+flags.DEFINE_integer("batch_size", 256, "Masks per call.")
+flags.mark_flags_as_required(["config"])
+
+
+def _sync(device):
+  if torch.device(device).type == 'cuda':
+    torch.cuda.synchronize()
+
+
+def benchmark(config, kinds, num_masks, batch_size):
+  results = []
+  for kind in kinds:
+    config.inverse.mask = kind
+    try:
+      mask_fn = masks.get_mask_fn(config)
+    except (OSError, NotImplementedError) as e:
+      print(f"{kind}: skipped ({e})")
+      continue
+    mask_fn(torch.arange(batch_size, device=config.device))
+    _sync(config.device)
+    start = time.perf_counter()
+    observed = 0.
+    for first in range(0, num_masks, batch_size):
+      seeds = torch.arange(first, min(first + batch_size, num_masks), device=config.device)
+      observed += mask_fn(seeds).mean().item() * len(seeds)
+    _sync(config.device)
+    results.append((kind, num_masks / (time.perf_counter() - start), observed / num_masks))
+
+  # One mask per item, as used by the 'inpaint_rnd' operator before
+  config.inverse.operator = 'inpaint_rnd'
+  config.training.batch_size = 1
+  loader = datasets.get_mask_dataset(config)
+  start = time.perf_counter()
+  count = 0
+  while count < min(num_masks, 512):
+    for mask, _ in loader:
+      mask.to(config.device)
+      count += 1
+  _sync(config.device)
+  results.append(("dataloader", count / (time.perf_counter() - start), float('nan')))
+
+  print(f"{'kind':<12}{'masks/s':>12}{'observed':>10}")
+  for kind, rate, observed in results:
+    print(f"{kind:<12}{rate:>12.0f}{observed:>10.3f}")
+  return results
+
+
+def main(argv):
+  benchmark(FLAGS.config, FLAGS.kinds, FLAGS.num_masks, FLAGS.batch_size)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,81 @@
+# pylint: skip-file
+"""Per-step overhead of the optimizers and their implementations on a score model.
+
+Times `optimize_fn` (learning-rate schedule, gradient clipping and the optimizer update) with
+random gradients on the parameters of the model in `--config`, for every registered optimizer and
+implementation that is available on the device.
+
+  python -m benchmarks.optimizers --config configs/ve/cifar10_ncsnpp_continuous.py
+"""
+
+import time
+
+import torch
+from absl import app
+from absl import flags
+from ml_collections.config_flags import config_flags
+
+import losses
+from models import utils as mutils
+from models import ddpm, ncsnv2, ncsnpp
+
+FLAGS = flags.FLAGS
+
+config_flags.DEFINE_config_file("config", None, "Model configuration.", lock_config=False)
+flags.DEFINE_list("optimizers", ["Adam", "AdamW", "Lion"], "Optimizers to compare.")
+flags.DEFINE_list("implementations", ["loop", "foreach", "fused"], "Implementations to compare.")
+flags.DEFINE_integer("steps", 50, "Timed optimizer steps per setting.")
+flags.DEFINE_integer("warmup_steps", 5, "Untimed optimizer steps per setting.")
+flags.mark_flags_as_required(["config"])
+
+
+def benchmark(config, optimizers, implementations, steps, warmup_steps):
+  cuda = torch.device(config.device).type == 'cuda'
+  model = mutils.create_model(config)
+  params = [p for p in model.parameters() if p.requires_grad]
+  for p in params:
+    p.grad = torch.randn_like(p) * 1e-3
+  print(f"{sum(p.numel() for p in params) / 1e6:.1f}M parameters in {len(params)} tensors")
+
+  optimize_fn = losses.optimization_manager(config)
+  initial = [p.detach().clone() for p in params]
+  results = []
+  for name in optimizers:
+    for implementation in implementations:
+      config.optim.optimizer = name
+      config.optim.implementation = implementation
+      try:
+        optimizer = losses.get_optimizer(config, params)
+        optimize_fn(optimizer, params, step=0)
+      except (ValueError, RuntimeError) as e:
+        print(f"{name}/{implementation}: skipped ({e})")
+        continue
+
+      for _ in range(warmup_steps):
+        optimize_fn(optimizer, params, step=config.optim.warmup)
+      if cuda:
+        torch.cuda.synchronize()
+      start = time.perf_counter()
+      for _ in range(steps):
+        optimize_fn(optimizer, params, step=config.optim.warmup)
+      if cuda:
+        torch.cuda.synchronize()
+      results.append((f"{name}/{implementation}", 1e3 * (time.perf_counter() - start) / steps))
+
+      del optimizer
+      with torch.no_grad():
+        for p, p0 in zip(params, initial):
+          p.copy_(p0)
+
+  print(f"{'optimizer':<20}{'ms/step':>10}")
+  for name, ms in results:
+    print(f"{name:<20}{ms:>10.2f}")
+  return results
+
+
+def main(argv):
+  benchmark(FLAGS.config, FLAGS.optimizers, FLAGS.implementations, FLAGS.steps, FLAGS.warmup_steps)
+
+
+if __name__ == "__main__":
+  app.run(main)
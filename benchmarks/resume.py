@@ -0,0 +1,86 @@
+# pylint: skip-file
+"""Check that an interrupted and resumed run sees the same data and noise as an uninterrupted one.
+
+Simulates the training loop on random uint8 images with random crops, flips and uniform
+dequantization: batches come through a `DevicePrefetcher` and every step draws training noise
+from the global RNG. One run goes through all `--steps`; the other is interrupted after
+`--interrupt_at` steps, the sampler position and RNG states are saved as in a checkpoint, and a
+fresh pipeline resumes from them. The augmented batches and the noise of the remaining steps have
+to be bit-identical. Exits with an error otherwise.
+
+  python -m benchmarks.resume --num_workers 0,2 --device cuda
+"""
+
+import sys
+
+import torch
+from absl import app
+from absl import flags
+from torch.utils.data import DataLoader, TensorDataset
+
+import datasets
+from utils import RNGState, set_seed
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list("num_workers", ["0", "2"], "Worker counts to check.")
+flags.DEFINE_integer("steps", 12, "Training steps of the uninterrupted run.")
+flags.DEFINE_integer("interrupt_at", 5, "Steps before the interruption.")
+flags.DEFINE_integer("batch_size", 8, "Batch size.")
+flags.DEFINE_integer("num_samples", 40, "Dataset size; smaller than steps * batch_size to cross epochs.")
+flags.DEFINE_string("device", "cuda" if torch.cuda.is_available() else "cpu", "Device of the prefetcher.")
+flags.DEFINE_integer("seed", 0, "Seed of the run.")
+
+
+def _pipeline(num_workers, batch_size, num_samples, seed):
+  images = torch.randint(256, (num_samples, 3, 20, 20), generator=torch.Generator().manual_seed(0),
+                         dtype=torch.uint8)
+  dataset = TensorDataset(images, torch.arange(num_samples))
+  sampler = datasets.ResumableSampler(dataset, shuffle=True, seed=seed)
+  generator = torch.Generator()
+  generator.manual_seed(seed)
+  loader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers,
+                      persistent_workers=num_workers > 0, generator=generator)
+  augment = datasets.BatchAugment(random_crop=16, flip=True, dequantize=True)
+  return datasets.AugmentedLoader(loader, augment), sampler
+
+
+def _run(steps, num_workers, batch_size, num_samples, device, seed, state=None):
+  """Batches and noise of `steps` training steps, and the state at the end, starting from `state`."""
+  set_seed(seed)
+  rng = RNGState()
+  loader, sampler = _pipeline(num_workers, batch_size, num_samples, seed)
+  if state is not None:
+    sampler.load_state_dict(state['sampler'])
+    rng.load_state_dict(state['rng'])
+  train_iter = datasets.DevicePrefetcher(loader, device)
+  records = []
+  for _ in range(steps):
+    batch, _ = next(train_iter)
+    sampler.advance(batch.shape[0])
+    records.append((batch.cpu(), torch.randn(batch.shape, device=device).cpu()))
+  return records, dict(sampler=sampler.state_dict(), rng=rng.state_dict())
+
+
+def check(num_workers, steps, interrupt_at, batch_size, num_samples, device, seed):
+  ok = True
+  for workers in num_workers:
+    args = (workers, batch_size, num_samples, device, seed)
+    full, _ = _run(steps, *args)
+    _, state = _run(interrupt_at, *args)
+    resumed, _ = _run(steps - interrupt_at, *args, state=state)
+    same = all(torch.equal(a, b) and torch.equal(na, nb)
+               for (a, na), (b, nb) in zip(full[interrupt_at:], resumed))
+    print(f"workers {workers}: resumed run {'matches' if same else 'DIFFERS from'} the uninterrupted run")
+    ok = ok and same
+  return ok
+
+
+def main(argv):
+  if not check([int(n) for n in FLAGS.num_workers], FLAGS.steps, FLAGS.interrupt_at, FLAGS.batch_size,
+               FLAGS.num_samples, FLAGS.device, FLAGS.seed):
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  app.run(main)
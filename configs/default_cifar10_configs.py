@@ -15,9 +15,27 @@ def get_default_configs():
   training.snapshot_freq_for_preemption = 10000
   ## produce samples at each snapshot.
   training.snapshot_sampling = True
+  ## >0 offloads snapshot sampling to that many background processes
+  training.snapshot_sampling_workers = 0
   training.likelihood_weighting = False
   training.continuous = True
   training.reduce_mean = False
+  ## adaptive importance sampling of t for continuous training: 'none', 'loss' or 'loss2'
+  training.importance_sampling = 'none'
+  training.importance_bins = 100
+  ## noise draws per example in each training step and sampling of t: 'uniform', 'stratified' or 'lowdiscrepancy'
+  training.num_noise_draws = 1
+  training.t_sampling = 'uniform'
+  ## checkpoint retention (0 keeps all checkpoints) and EMA-only export for inference
+  training.keep_last = 0
+  training.keep_best = 0
+  training.export_ema = True
+  training.export_fp16 = False
+  ## opt-in breakdown of step time, written to tensorboard and profile/steps.jsonl;
+  ## profile_steps > 0 additionally traces that many steps with torch.profiler after profile_wait steps
+  training.profile = False
+  training.profile_wait = 10
+  training.profile_steps = 0
 
   # sampling
   config.sampling = sampling = ml_collections.ConfigDict()
@@ -36,6 +54,8 @@ def get_default_configs():
   evaluate.enable_loss = True
   evaluate.enable_bpd = False
   evaluate.bpd_dataset = 'test'
+  ## number of checkpoints evaluated concurrently, each worker holds its own model
+  evaluate.num_workers = 1
 
   # data
   config.data = data = ml_collections.ConfigDict()
@@ -45,6 +65,16 @@ def get_default_configs():
   data.centered = False
   data.uniform_dequantization = False
   data.num_channels = 3
+  ## DataLoader worker processes per training process; -1 for one per available CPU core
+  data.num_workers = 4
+  ## directory of preprocessed shards written by shards.py, streamed instead of the dataset; empty to disable
+  data.shard_dir = ''
+  ## per-channel normalization with statistics of the data computed once and cached: 'none' (data in [0, 1]),
+  ## 'standard' (zero mean, unit variance), 'minmax' or 'quantile' (normalization_quantiles mapped to [0, 1])
+  data.normalization = 'none'
+  data.normalization_quantiles = (0.001, 0.999)
+  ## shuffle runs of this many consecutive samples instead of single samples (for datasets that cache neighbours); 1 to disable
+  data.sample_window = 1
 
   # model
   config.model = model = ml_collections.ConfigDict()
@@ -55,6 +85,9 @@ def get_default_configs():
   model.beta_max = 20.
   model.dropout = 0.1
   model.embedding_type = 'fourier'
+  ## activation checkpointing of U-Net blocks: kinds ('resblock', 'attn') and input resolutions (empty = all)
+  model.checkpoint_modules = ()
+  model.checkpoint_resolutions = ()
 
   # optimization
   config.optim = optim = ml_collections.ConfigDict()
@@ -62,9 +95,17 @@ def get_default_configs():
   optim.optimizer = 'Adam'
   optim.lr = 2e-4
   optim.beta1 = 0.9
+  optim.beta2 = 0.999
   optim.eps = 1e-8
   optim.warmup = 5000
   optim.grad_clip = 1.
+  ## optimizer implementation: 'default', 'foreach', 'fused' or 'loop'
+  optim.implementation = 'default'
+  ## learning-rate schedule: 'warmup', 'warmup_cosine' (decays to lr * min_lr_ratio) or 'inverse_sqrt'
+  optim.schedule = 'warmup'
+  optim.min_lr_ratio = 0.
+  ## shard the optimizer state across ranks (ZeRO-1) in multi-process training
+  optim.zero_redundancy = True
 
   config.seed = 42
   config.device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
@@ -0,0 +1,41 @@
+# coding=utf-8
+# Copyright 2020 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import ml_collections
+from configs.vp import nc_ddpmpp
+# Lint as: python3
+
+def get_config():
+  config = nc_ddpmpp.get_config()
+
+  config.training.batch_size = 64
+
+  # deblur
+  inverse = config.inverse = ml_collections.ConfigDict()
+  inverse.operator = 'blur'
+  inverse.kernel_size = 9 # odd
+  inverse.blur_std = 4. # variance of the Gaussian kernel in pixels^2
+  inverse.rcond = 1e-3 # relative cutoff of the singular values in the pseudo-inverse
+  inverse.sampler = 'dps'
+  inverse.num_batches = 1 # test batches to solve, 0 for the whole test split
+  inverse.variance = 0.1
+  inverse.solver = 'heun' # 'euler' ('fixed'), 'heun', 'RK45', 'RK23'
+  inverse.steps = 50 # steps of 'euler' and 'heun'
+  inverse.schedule = 'uniform' # 'uniform', 'quadratic', 'log'
+  inverse.rtol = 1e-3 # tolerances of 'RK45' and 'RK23'
+  inverse.atol = 1e-3
+
+
+
+  return config
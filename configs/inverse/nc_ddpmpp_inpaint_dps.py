@@ -26,9 +26,17 @@ def get_config():
   inverse.operator = 'inpaint'
   inverse.invert = False
   inverse.ratio = 0.5
+  inverse.mask = 'random' # masks of inpaint_rnd: 'random', 'box', 'stroke', 'land'
+  inverse.mask_seed = 0
+  inverse.mask_per_sample = False # one mask per test sample for inpaint and inpaint_rnd
   inverse.sampler = 'dps'
+  inverse.num_batches = 1 # test batches to solve, 0 for the whole test split
   inverse.variance = 0.1
-  inverse.solver = 'RK45' #‘RK45’, ‘RK23’, 'fixed'
+  inverse.solver = 'heun' # 'euler' ('fixed'), 'heun', 'RK45', 'RK23'
+  inverse.steps = 50 # steps of 'euler' and 'heun'
+  inverse.schedule = 'uniform' # 'uniform', 'quadratic', 'log'
+  inverse.rtol = 1e-3 # tolerances of 'RK45' and 'RK23'
+  inverse.atol = 1e-3
 
 
 
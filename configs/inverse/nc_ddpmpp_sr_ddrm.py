@@ -0,0 +1,39 @@
+# coding=utf-8
+# Copyright 2020 The Google Research Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import ml_collections
+from configs.vp import nc_ddpmpp
+# Lint as: python3
+
+def get_config():
+  config = nc_ddpmpp.get_config()
+
+  config.training.batch_size = 64
+
+  # super-resolution
+  inverse = config.inverse = ml_collections.ConfigDict()
+  inverse.operator = 'sr' # 'sr', 'cs' or 'colorize'
+  inverse.scale = 4 # average pooling factor of 'sr'
+  inverse.ratio = 0.25 # observed frequencies of 'cs'
+  inverse.mask_seed = 0
+  inverse.sampler = 'ddrm'
+  inverse.num_batches = 1 # test batches to solve, 0 for the whole test split
+  inverse.variance = 0.01
+  inverse.steps = 20
+  inverse.eta = 0.85
+  inverse.eta_b = 1.0
+
+
+
+  return config
@@ -13,6 +13,16 @@ def get_default_configs():
   training.eval_freq = 500
   ## store additional checkpoints for preemption in cloud computing environments
   training.snapshot_freq_for_preemption = 2500
+  ## checkpoint retention (0 keeps all checkpoints) and EMA-only export for inference
+  training.keep_last = 0
+  training.keep_best = 0
+  training.export_ema = True
+  training.export_fp16 = False
+  ## opt-in breakdown of step time, written to tensorboard and profile/steps.jsonl;
+  ## profile_steps > 0 additionally traces that many steps with torch.profiler after profile_wait steps
+  training.profile = False
+  training.profile_wait = 10
+  training.profile_steps = 0
   ## produce samples at each snapshot.
 
   # data
@@ -23,6 +33,25 @@ def get_default_configs():
   data.random_flip = False
   data.uniform_dequantization = False
   data.centered = False
+  ## memory-mapped cache of the NetCDF data, converted on first use (e.g. './data/cache'); None reads NetCDF directly
+  data.cache_dir = ml_collections.config_dict.placeholder(str)
+  data.cache_dtype = 'float32'
+  ## DataLoader worker processes per training process; -1 for one per available CPU core
+  data.num_workers = 4
+  ## directory of preprocessed shards written by shards.py, streamed instead of the dataset; empty to disable
+  data.shard_dir = ''
+  ## per-channel normalization with statistics of the data computed once and cached: 'none' (data in [0, 1]),
+  ## 'standard' (zero mean, unit variance), 'minmax' or 'quantile' (normalization_quantiles mapped to [0, 1])
+  data.normalization = 'none'
+  data.normalization_quantiles = (0.001, 0.999)
+  ## HDF5 chunk cache of each worker's NetCDF handle, in MiB
+  data.chunk_cache_mb = 64
+  ## PDE frames are paired as (t, t + pair_stride); frames are read read_block at a time into an LRU cache of
+  ## frame_cache frames, and training shuffles runs of sample_window consecutive pairs so that the reads are sequential
+  data.pair_stride = 1
+  data.frame_cache = 64
+  data.read_block = 16
+  data.sample_window = 32
 
   # model
   config.model = model = ml_collections.ConfigDict()
@@ -64,9 +93,17 @@ def get_default_configs():
   optim.optimizer = 'Adam'
   optim.lr = 2e-4
   optim.beta1 = 0.9
+  optim.beta2 = 0.999
   optim.eps = 1e-8
   optim.warmup = 5000
   optim.grad_clip = 1.
+  ## optimizer implementation: 'default', 'foreach', 'fused' or 'loop'
+  optim.implementation = 'default'
+  ## learning-rate schedule: 'warmup', 'warmup_cosine' (decays to lr * min_lr_ratio) or 'inverse_sqrt'
+  optim.schedule = 'warmup'
+  optim.min_lr_ratio = 0.
+  ## shard the optimizer state across ranks (ZeRO-1) in multi-process training
+  optim.zero_redundancy = True
 
   config.seed = 42
   config.device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
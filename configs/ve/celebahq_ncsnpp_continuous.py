@@ -35,6 +35,24 @@ def get_config():
   training.continuous = True
   training.likelihood_weighting = False
   training.reduce_mean = False
+  ## >0 offloads snapshot sampling to that many background processes
+  training.snapshot_sampling_workers = 0
+  ## adaptive importance sampling of t for continuous training: 'none', 'loss' or 'loss2'
+  training.importance_sampling = 'none'
+  training.importance_bins = 100
+  ## noise draws per example in each training step and sampling of t: 'uniform', 'stratified' or 'lowdiscrepancy'
+  training.num_noise_draws = 1
+  training.t_sampling = 'uniform'
+  ## checkpoint retention (0 keeps all checkpoints) and EMA-only export for inference
+  training.keep_last = 0
+  training.keep_best = 0
+  training.export_ema = True
+  training.export_fp16 = False
+  ## opt-in breakdown of step time, written to tensorboard and profile/steps.jsonl;
+  ## profile_steps > 0 additionally traces that many steps with torch.profiler after profile_wait steps
+  training.profile = False
+  training.profile_wait = 10
+  training.profile_steps = 0
 
   # sampling
   config.sampling = sampling = ml_collections.ConfigDict()
@@ -52,6 +70,8 @@ def get_config():
   evaluate.num_samples = 50000
   evaluate.begin_ckpt = 1
   evaluate.end_ckpt = 96
+  ## number of checkpoints evaluated concurrently, each worker holds its own model
+  evaluate.num_workers = 1
 
   # data
   config.data = data = ml_collections.ConfigDict()
@@ -61,6 +81,16 @@ def get_config():
   data.random_flip = True
   data.uniform_dequantization = False
   data.num_channels = 3
+  ## DataLoader worker processes per training process; -1 for one per available CPU core
+  data.num_workers = 4
+  ## directory of preprocessed shards written by shards.py, streamed instead of the dataset; empty to disable
+  data.shard_dir = ''
+  ## per-channel normalization with statistics of the data computed once and cached: 'none' (data in [0, 1]),
+  ## 'standard' (zero mean, unit variance), 'minmax' or 'quantile' (normalization_quantiles mapped to [0, 1])
+  data.normalization = 'none'
+  data.normalization_quantiles = (0.001, 0.999)
+  ## shuffle runs of this many consecutive samples instead of single samples (for datasets that cache neighbours); 1 to disable
+  data.sample_window = 1
   data.tfrecords_path = '/atlas/u/yangsong/celeba_hq/-r10.tfrecords'
 
   # model
@@ -92,6 +122,9 @@ def get_config():
   model.fourier_scale = 16
   model.conv_size = 3
   model.embedding_type = 'fourier'
+  ## activation checkpointing of U-Net blocks: kinds ('resblock', 'attn') and input resolutions (empty = all)
+  model.checkpoint_modules = ()
+  model.checkpoint_resolutions = ()
 
   # optim
   config.optim = optim = ml_collections.ConfigDict()
@@ -99,10 +132,18 @@ def get_config():
   optim.optimizer = 'Adam'
   optim.lr = 2e-4
   optim.beta1 = 0.9
+  optim.beta2 = 0.999
   optim.amsgrad = False
   optim.eps = 1e-8
   optim.warmup = 5000
   optim.grad_clip = 1.
+  ## optimizer implementation: 'default', 'foreach', 'fused' or 'loop'
+  optim.implementation = 'default'
+  ## learning-rate schedule: 'warmup', 'warmup_cosine' (decays to lr * min_lr_ratio) or 'inverse_sqrt'
+  optim.schedule = 'warmup'
+  optim.min_lr_ratio = 0.
+  ## shard the optimizer state across ranks (ZeRO-1) in multi-process training
+  optim.zero_redundancy = True
 
   config.seed = 42
   config.device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
@@ -15,13 +15,21 @@
 
 # pylint: skip-file
 """Return training and evaluation/test datasets from config files."""
+import collections
+import contextlib
+import hashlib
+import json
+import math
+import shutil
 import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset, Sampler
 from torchvision import datasets, transforms
 from torchvision.transforms.functional import InterpolationMode
 import os
 import imageio.v2 as imageio
+import distributed
+from shards import ShardedDataset
 
 
 def load_images_from_folder(folder):
@@ -61,22 +69,45 @@ class Repeat:
 
 
 class CustomDataset(Dataset):
-    def __init__(self, data, split='train', transform=None, land_cut=0, remove_mask=True):
+    """Time slices `data[t, depth, land_cut:]` of a (time, depth, y, x) array or NetCDF variable.
+
+    With `crop_origins` from `get_crop_index` every sample is a `crop_size` crop at an origin drawn from the index, and
+    only the crop is read from `data`. Batches of an in-memory or memory-mapped array are then gathered with a single
+    vectorized indexing operation in `__getitems__`. The origin of a sample is a hash of `seed`, its index and the
+    epoch of its `SampleIndex`, so crops neither depend on the DataLoader workers nor on the global RNG and continue
+    where they left off after a resume.
+    """
+
+    def __init__(self, data, split='train', transform=None, land_cut=0, remove_mask=True, depth=0, crop_origins=None,
+                 crop_size=None, seed=0):
         self.len = len(data)
         self.split = split
         self.data = data
         self.transform = transform
         self.land_cut = land_cut
         self.remove_mask = remove_mask
+        self.depth = depth
+        self.crop_origins = crop_origins
+        self.crop_size = crop_size
+        self.seed = seed
+        if crop_origins is not None:
+            height, width = data.shape[2] - land_cut, data.shape[3]
+            self._batched = isinstance(data, np.ndarray) and min(height, width) >= crop_size
 
     def __len__(self):
         return int(self.len * 0.8) if self.split == 'train' else int(self.len * 0.2)
 
-    def __getitem__(self, idx):
-        idx = idx if self.split == 'train' else int(self.len * 0.8) + idx
-        sample = self.data[idx, 0, self.land_cut:]
+    def _time_index(self, idx):
+        return idx if self.split == 'train' else int(self.len * 0.8) + idx
+
+    def _sample_origins(self, indices):
+        # Plain integer indices, e.g. from direct indexing, count as epoch 0
+        epochs = np.array([getattr(idx, 'epoch', 0) for idx in indices])
+        keys = _mix_seed(self.seed, epochs, np.array(indices, dtype=np.int64))
+        return self.crop_origins[keys % np.uint64(len(self.crop_origins))]
 
-        if self.remove_mask:
+    def _finish(self, sample):
+        if self.remove_mask and isinstance(sample, np.ma.MaskedArray):
             sample = sample.data
 
         if self.transform:
@@ -84,27 +115,79 @@ class CustomDataset(Dataset):
 
         return sample, 0
 
+    def __getitem__(self, idx):
+        if self.crop_origins is None:
+            return self._finish(self.data[self._time_index(idx), self.depth, self.land_cut:])
+
+        (y, x), = self._sample_origins([idx])
+        idx = self._time_index(idx)
+        y += self.land_cut
+        sample = self.data[idx, self.depth, y:y + self.crop_size, x:x + self.crop_size]
+        # Crops of images smaller than `crop_size` reach into zero padding, as with RandomCrop(pad_if_needed=True)
+        pad = [(0, self.crop_size - n) for n in sample.shape]
+        if any(after for _, after in pad):
+            sample = np.pad(np.ma.getdata(sample), pad)
+        return self._finish(sample)
+
+    def __getitems__(self, indices):
+        if self.crop_origins is None or not self._batched:
+            return [self.__getitem__(idx) for idx in indices]
+
+        times = np.array([self._time_index(idx) for idx in indices])
+        origins = self._sample_origins(indices)
+        offsets = np.arange(self.crop_size)
+        rows = (self.land_cut + origins[:, :1] + offsets)[:, :, None]
+        cols = (origins[:, 1:] + offsets)[:, None, :]
+        crops = self.data[times[:, None, None], self.depth, rows, cols]
+        return [self._finish(crop) for crop in crops]
+
 
 class PDEDataset(Dataset):
-    def __init__(self, data, split='train', transform=None):
+    """Pairs of frames (t, t + stride) of a (time, channel, y, x) PDE simulation.
+
+    Frames are read in blocks of `read_block` consecutive time steps into an LRU cache of `cache_frames` frames, so
+    that a frame shared by several pairs is only read once. This pays off when consecutive pairs are requested
+    together, e.g. in evaluation or with `ResumableSampler(window=...)`.
+    """
+
+    def __init__(self, data, split='train', transform=None, region=(slice(5, 300), slice(5, -5)), stride=1,
+                 cache_frames=0, read_block=1):
         self.len = len(data)
         self.data = data
         self.split = split
         self.transform = transform
         self.offset = 160
+        self.region = region
+        self.stride = stride
+        self.cache_frames = cache_frames
+        self.read_block = max(min(read_block, cache_frames), 1)
+        self._frames = collections.OrderedDict()
 
     def __len__(self):
         len = int(self.len * 0.9)-self.offset if self.split == 'train' else int(self.len * 0.1)
-        return len - 1
+        return len - self.stride
+
+    def _frame(self, i):
+        if i in self._frames:
+            self._frames.move_to_end(i)
+            return self._frames[i]
+        block = np.ma.getdata(self.data[i:min(i + self.read_block, self.len), :, self.region[0], self.region[1]])
+        if self.cache_frames == 0:
+            return block[0]
+        for j, frame in enumerate(block):
+            self._frames[i + j] = frame
+            self._frames.move_to_end(i + j)
+        while len(self._frames) > self.cache_frames:
+            self._frames.popitem(last=False)
+        return block[0]
 
     def __getitem__(self, idx):
         ''' Return a batch of f1, f2, coord, t, target '''
 
         idx = idx+self.offset if self.split == 'train' else int(self.len * 0.9) + idx
         #t = idx / self.__len__()
-        t = idx+1
-        sample = self.data[idx:idx+2, :, 5:300,5:-5].data
-        sample = torch.from_numpy(sample)
+        t = idx+self.stride
+        sample = torch.from_numpy(np.stack([self._frame(idx), self._frame(idx + self.stride)]))
         #sample = sample.reshape(sample.shape[1], sample.shape[2], sample.shape[0])
         #print(sample.shape)
         if self.transform:
@@ -117,22 +200,719 @@ class PDEDataset(Dataset):
 
 
 
+class NetCDFVariable:
+    """A NetCDF variable that is opened lazily in the process that reads it.
+
+    HDF5 handles must not be shared across `fork`, so the parent only reads the shape and closes the file again.
+    Each DataLoader worker opens its own handle on first access, or earlier in `netcdf_worker_init_fn`, with a chunk
+    cache of `chunk_cache_bytes` (the library default if None).
+    """
+
+    def __init__(self, path, key, chunk_cache_bytes=None):
+        from netCDF4 import Dataset
+
+        self.path = path
+        self.key = key
+        self.chunk_cache_bytes = chunk_cache_bytes
+        with Dataset(path) as nc:
+            self.shape = nc[key].shape
+        self._nc = None
+        self._var = None
+        self._pid = None
+
+    def open(self):
+        from netCDF4 import Dataset
+
+        if self._var is not None and self._pid == os.getpid():
+            return self._var
+        # A handle inherited from the parent process is dropped without closing it
+        self._nc = Dataset(self.path)
+        self._var = self._nc[self.key]
+        self._pid = os.getpid()
+        if self.chunk_cache_bytes:
+            self._var.set_var_chunk_cache(size=self.chunk_cache_bytes)
+        return self._var
+
+    def close(self):
+        if self._nc is not None and self._pid == os.getpid():
+            self._nc.close()
+        self._nc = self._var = self._pid = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.open()[index]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(_nc=None, _var=None, _pid=None)
+        return state
+
+
+def netcdf_worker_init_fn(worker_id):
+    """Open a fresh handle of the NetCDF variable of the dataset in each DataLoader worker."""
+    dataset = torch.utils.data.get_worker_info().dataset
+    if isinstance(getattr(dataset, 'data', None), NetCDFVariable):
+        dataset.data.open()
+
+
+def _num_workers(num_workers):
+    """`num_workers`, or with -1 one worker per CPU core available to this process."""
+    if num_workers >= 0:
+        return num_workers
+    return max(len(os.sched_getaffinity(0)) // distributed.get_world_size() - 1, 1)
+
+
+def _file_fingerprint(path, block_size=1 << 20):
+    """Hash of the size, modification time and the first and last `block_size` bytes of `path`."""
+    stat = os.stat(path)
+    digest = hashlib.sha256(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    with open(path, 'rb') as fin:
+        digest.update(fin.read(block_size))
+        fin.seek(max(stat.st_size - block_size, 0))
+        digest.update(fin.read(block_size))
+    return digest.hexdigest()
+
+
+def _build_netcdf_cache(path, key, index, cache_path, dtype, chunk_bytes):
+    from netCDF4 import Dataset
+
+    tmp_path = f'{cache_path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    with Dataset(path) as nc:
+        var = nc[key]
+        slab = var[(slice(0, 1),) + index]
+        shape = (var.shape[0],) + slab.shape[1:]
+        # Read whole chunks of the variable along time, as many as fit into `chunk_bytes`
+        chunking = var.chunking()
+        time_chunk = chunking[0] if isinstance(chunking, list) else 1
+        slab_bytes = max(slab.size * np.dtype(dtype).itemsize, 1)
+        steps_per_read = max(chunk_bytes // slab_bytes // time_chunk, 1) * time_chunk
+
+        data = np.lib.format.open_memmap(os.path.join(tmp_path, 'data.npy'), mode='w+', dtype=dtype, shape=shape)
+        mask = np.zeros(shape[1:], dtype=bool)
+        for start in range(0, shape[0], steps_per_read):
+            chunk = var[(slice(start, start + steps_per_read),) + index]
+            data[start:start + len(chunk)] = np.ma.getdata(chunk)
+            mask |= np.ma.getmaskarray(chunk).any(axis=0)
+        data.flush()
+        del data
+
+    np.save(os.path.join(tmp_path, 'mask.npy'), mask)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as fout:
+        json.dump(dict(source=os.path.abspath(path), key=key, index=repr(index), shape=shape, dtype=dtype), fout)
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Another process finished the same cache first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def get_netcdf_cache(path, key, index, cache_dir, dtype='float32', chunk_bytes=256 << 20):
+    """Memory-mapped copy of `Dataset(path)[key][:, *index]`, converted once and reused afterwards.
+
+    Decompressing NetCDF and building masked arrays on every read is slow, so the selected part of the variable is
+    written once to a C-contiguous .npy file in `cache_dir`, keyed by a fingerprint of the file, `key`, `index` and
+    `dtype`. Each time step is then a contiguous block of the file and slices of it are views without a copy.
+
+    Returns:
+      data: A copy-on-write memory map of shape (time, ...) with the raw values of masked points.
+      mask: A boolean array of shape data.shape[1:] that is True where any time step is masked, e.g. on land.
+    """
+    name = hashlib.sha256(repr((_file_fingerprint(path), key, index, dtype)).encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f'{os.path.splitext(os.path.basename(path))[0]}-{key}-{name}')
+    if not os.path.exists(os.path.join(cache_path, 'meta.json')):
+        # In multi-process training the main process converts the file while the others wait
+        if distributed.is_main_process():
+            os.makedirs(cache_dir, exist_ok=True)
+            _build_netcdf_cache(path, key, index, cache_path, dtype, chunk_bytes)
+        distributed.barrier()
+    data = np.load(os.path.join(cache_path, 'data.npy'), mmap_mode='c')
+    mask = np.load(os.path.join(cache_path, 'mask.npy'))
+    return data, mask
+
+
+def crop_origins(mask, size, min_ocean_fraction):
+    """(y, x) origins of the `size` x `size` crops of a (y, x) land mask that are at least `min_ocean_fraction` ocean.
+
+    The ocean fraction of all windows is computed at once from an integral image. Dimensions smaller than `size` are
+    padded at the end, and the padding counts as land.
+    """
+    ocean = ~np.asarray(mask, dtype=bool)
+    ocean = np.pad(ocean, [(0, max(size - n, 0)) for n in ocean.shape])
+    integral = np.pad(ocean.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    counts = (integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size])
+    origins = np.argwhere(counts >= min_ocean_fraction * size ** 2).astype(np.int32)
+    if len(origins) == 0:
+        raise ValueError(f'No {size}x{size} crop is at least {min_ocean_fraction:.0%} ocean.')
+    return origins
+
+
+def get_crop_index(mask, size, min_ocean_fraction, cache_dir=None):
+    """`crop_origins` of `mask`, saved in `cache_dir` (if given) and loaded from there when the mask is unchanged."""
+    if not cache_dir:
+        return crop_origins(mask, size, min_ocean_fraction)
+    mask = np.ascontiguousarray(mask, dtype=bool)
+    digest = hashlib.sha256(mask.tobytes())
+    digest.update(repr((mask.shape, size, min_ocean_fraction)).encode())
+    path = os.path.join(cache_dir, f'crops-{digest.hexdigest()[:16]}.npy')
+    if os.path.exists(path):
+        return np.load(path)
+    origins = crop_origins(mask, size, min_ocean_fraction)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{path}.tmp{os.getpid()}.npy'
+    np.save(tmp_path, origins)
+    os.replace(tmp_path, path)
+    return origins
+
+
+def _mix_seed(*keys):
+    """64-bit hash (splitmix64) of non-negative integer `keys`, elementwise for arrays, as seeds of per-sample and
+    per-batch random draws."""
+    h = np.zeros(np.broadcast(*keys).shape, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for key in keys:
+            h = h ^ np.asarray(key, dtype=np.uint64)
+            h = h + np.uint64(0x9E3779B97F4A7C15)
+            h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            h = h ^ (h >> np.uint64(31))
+    return h
+
+
+class SampleIndex(int):
+    """Dataset index that carries the epoch it was drawn in, so that datasets can seed per-sample random draws."""
+
+    def __new__(cls, index, epoch):
+        self = super().__new__(cls, index)
+        self.epoch = epoch
+        return self
+
+    def __reduce__(self):
+        return SampleIndex, (int(self), self.epoch)
+
+
+class ResumableSampler(Sampler):
+    """Shuffles `data_source` with a fresh permutation per epoch and can resume in the middle of an epoch.
+
+    The permutation of epoch `e` is drawn from a generator seeded with `seed + e`, so the data order only depends on
+    the seed. The training loop reports the samples it consumed with `advance`; the resulting epoch and offset are
+    saved with `state_dict` and after `load_state_dict` the next iteration starts at the first unseen sample instead of
+    replaying the epoch.
+
+    With `window > 1` the permutation shuffles runs of `window` consecutive indices and keeps the order within a run,
+    so that datasets which cache neighbouring samples (`PDEDataset`) read their data sequentially.
+
+    With `num_replicas > 1` each rank iterates over every `num_replicas`-th index of the shared permutation, which is
+    padded by wrapping around so that all ranks see the same number of samples.
+
+    Indices are yielded as `SampleIndex`es that also carry their epoch.
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=0, num_replicas=1, rank=0, window=1):
+        self.dataset_size = len(data_source)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = math.ceil(self.dataset_size / num_replicas)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.window = window
+        self.epoch = 0
+        self.offset = 0
+        self._next_start = (0, 0)
+
+    def __len__(self):
+        return self.num_samples
+
+    def _indices(self, epoch):
+        if not self.shuffle:
+            indices = torch.arange(self.dataset_size)
+        else:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + epoch)
+            if self.window > 1:
+                runs = torch.randperm(math.ceil(self.dataset_size / self.window), generator=generator)
+                indices = (runs[:, None] * self.window + torch.arange(self.window)).flatten()
+                indices = indices[indices < self.dataset_size]
+            else:
+                indices = torch.randperm(self.dataset_size, generator=generator)
+        total_size = self.num_samples * self.num_replicas
+        if total_size > self.dataset_size:
+            indices = indices.repeat(math.ceil(total_size / self.dataset_size))[:total_size]
+        return indices[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        # Data loaders and the prefetcher request indices ahead of consumption, so each iteration continues where the
+        # previous one ended. The start is only claimed on the first `next`, as DataLoader discards one iterator.
+        epoch, offset = self._next_start
+        self._next_start = (epoch + 1, 0)
+        for index in self._indices(epoch)[offset:].tolist():
+            yield SampleIndex(index, epoch)
+
+    def advance(self, num_samples):
+        """Record that `num_samples` more samples were consumed."""
+        self.offset += num_samples
+        while self.offset >= self.num_samples:
+            self.offset -= self.num_samples
+            self.epoch += 1
+
+    def state_dict(self):
+        # The offset is saved as a position in the shared permutation, so the number of ranks may change on resume
+        return dict(epoch=self.epoch, offset=self.offset * self.num_replicas, seed=self.seed)
+
+    def load_state_dict(self, state_dict):
+        self.epoch = int(state_dict['epoch'])
+        self.offset = int(state_dict['offset']) // self.num_replicas
+        self.seed = int(state_dict['seed'])
+        self._next_start = (self.epoch, self.offset)
+
+
+def _map_tensors(fn, batch):
+    """Apply `fn` to every tensor in a (nested) tuple/list batch."""
+    if torch.is_tensor(batch):
+        return fn(batch)
+    elif isinstance(batch, (list, tuple)):
+        return type(batch)(_map_tensors(fn, b) for b in batch)
+    return batch
+
+
+def _batch_size(batch):
+    sizes = []
+    _map_tensors(lambda t: sizes.append(t.shape[0]), batch)
+    return sizes[0]
+
+
+class BatchAugment:
+    """Converts, crops, resizes and flips whole collated batches, on whatever device they are on.
+
+    DataLoader workers only decode samples into uint8 or float tensors of a common size. uint8 images are scaled to
+    [0, 1], with uniform dequantization noise if `dequantize`. Random crop offsets and flips are drawn per sample and
+    applied alike to every image tensor (ndim >= 4) of a batch, so paired fields such as PDE frames stay aligned.
+    With a `seed` all random draws of a batch come from a generator on its device seeded with it, and otherwise from
+    the global RNG.
+    """
+
+    def __init__(self, center_crop=None, resize=None, random_crop=None, flip=False, dequantize=False):
+        self.center_crop = center_crop
+        self.resize = resize
+        self.random_crop = random_crop
+        self.flip = flip
+        self.dequantize = dequantize
+        self._generators = {}
+
+    def _generator(self, device, seed):
+        if seed is None:
+            return None
+        if device not in self._generators:
+            self._generators[device] = torch.Generator(device)
+        return self._generators[device].manual_seed(seed)
+
+    def _to_float(self, x, generator):
+        if x.dtype != torch.uint8:
+            return x
+        x = x.float()
+        if self.dequantize:
+            return (x + torch.rand(x.shape, device=x.device, generator=generator)) / 256.
+        return x / 255.
+
+    def _center_crop(self, x):
+        top, left = (x.shape[-2] - self.center_crop) // 2, (x.shape[-1] - self.center_crop) // 2
+        return x[..., top:top + self.center_crop, left:left + self.center_crop]
+
+    def _resize(self, x):
+        if x.shape[-2:] == (self.resize, self.resize):
+            return x
+        shape = x.shape
+        x = torch.nn.functional.interpolate(x.flatten(0, -4), size=(self.resize, self.resize), mode='bilinear',
+                                            antialias=True, align_corners=False)
+        return x.reshape(shape[:-2] + x.shape[-2:])
+
+    def _random_crop(self, x, top, left):
+        size = self.random_crop
+        # Images smaller than the crop are padded with zeros at the end, like RandomCrop(pad_if_needed=True)
+        x = torch.nn.functional.pad(x, (0, max(size - x.shape[-1], 0), 0, max(size - x.shape[-2], 0)))
+        offsets = torch.arange(size, device=x.device)
+        rows = (top[:, None] + offsets)[:, :, None]
+        cols = (left[:, None] + offsets)[:, None, :]
+        batch = torch.arange(x.shape[0], device=x.device)[:, None, None]
+        # Advanced indexing puts the (batch, y, x) dimensions first
+        crops = x.flatten(1, -3)[batch, :, rows, cols]
+        return crops.permute(0, 3, 1, 2).reshape(x.shape[:-2] + (size, size))
+
+    def _params(self, images, generator):
+        # Drawn once per batch from the first image tensor, on its device
+        x = images[0]
+        params = {}
+        if self.random_crop is not None:
+            height, width = self._geometry(x.shape)
+            params['top'] = torch.randint(max(height - self.random_crop, 0) + 1, (x.shape[0],), device=x.device,
+                                          generator=generator)
+            params['left'] = torch.randint(max(width - self.random_crop, 0) + 1, (x.shape[0],), device=x.device,
+                                           generator=generator)
+        if self.flip:
+            params['flip'] = torch.rand(x.shape[0], device=x.device, generator=generator) < 0.5
+        return params
+
+    def _geometry(self, shape):
+        height, width = shape[-2:]
+        if self.center_crop is not None:
+            height = width = self.center_crop
+        if self.resize is not None:
+            height = width = self.resize
+        return height, width
+
+    def _apply(self, x, params, generator):
+        if x.dim() < 4:
+            return x
+        x = self._to_float(x, generator)
+        if self.center_crop is not None:
+            x = self._center_crop(x)
+        if self.resize is not None:
+            x = self._resize(x)
+        if self.random_crop is not None:
+            x = self._random_crop(x, params['top'], params['left'])
+        if self.flip:
+            flip = params['flip'].reshape((-1,) + (1,) * (x.dim() - 1))
+            x = torch.where(flip, x.flip(-1), x)
+        return x
+
+    def __call__(self, batch, seed=None):
+        images = []
+        _map_tensors(lambda t: images.append(t) if t.dim() >= 4 else None, batch)
+        if not images:
+            return batch
+        generator = self._generator(images[0].device, seed)
+        params = self._params(images, generator)
+        return _map_tensors(lambda t: self._apply(t, params, generator), batch)
+
+
+class AugmentedLoader:
+    """A DataLoader whose collated batches go through `augment`.
+
+    Iterating over it augments batches in the main process; `DevicePrefetcher` instead augments them on the device
+    after the copy. `sampler` is the object that tracks the position in the data (the dataset itself for a
+    `ShardedDataset`); other attributes are those of the wrapped loader.
+
+    Each batch is augmented with a seed that hashes the seed and rank of `sampler` with the epoch and offset of the
+    batch in the data. Augmentations therefore neither depend on how far ahead batches are loaded nor on the global
+    RNG, and continue where they left off when the sampler is resumed.
+    """
+
+    def __init__(self, loader, augment, sampler=None):
+        self.loader = loader
+        self.augment = augment
+        self.sampler = sampler if sampler is not None else loader.sampler
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['loader'], name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def batches(self):
+        """Iterate over the batches of the wrapped loader, before augmentation, with their augmentation seeds."""
+        sampler = self.sampler
+        # The next iteration starts where the sampler's `_next_start` points
+        epoch, offset = sampler._next_start
+        batches = iter(self.loader)
+        if isinstance(self.loader.dataset, IterableDataset) and self.loader.num_workers > 0:
+            # Workers claim the start on their own copies of an iterable dataset; the main process follows along
+            sampler._next_start = (epoch + 1, 0)
+        for batch in batches:
+            yield batch, int(_mix_seed(sampler.seed, sampler.rank, epoch, offset))
+            offset += _batch_size(batch)
+
+    def __iter__(self):
+        for batch, seed in self.batches():
+            yield self.augment(batch, seed)
+
+    def restart(self):
+        """Replace the wrapped loader by an equivalent one, whose workers start from the current state of the data.
+
+        Needed after repositioning an iterable dataset such as `ShardedDataset`, of which persistent workers keep
+        their own copies.
+        """
+        loader = self.loader
+        iterable = isinstance(loader.dataset, IterableDataset)
+        self.loader = DataLoader(loader.dataset, batch_size=loader.batch_size,
+                                 sampler=None if iterable else loader.sampler, num_workers=loader.num_workers,
+                                 collate_fn=loader.collate_fn, pin_memory=loader.pin_memory,
+                                 drop_last=loader.drop_last, worker_init_fn=loader.worker_init_fn,
+                                 generator=loader.generator, persistent_workers=loader.persistent_workers)
+
+
+class DevicePrefetcher:
+    """Endless iterator over `loader` that keeps the next `depth` batches on `device`.
+
+    Host-to-device copies are issued with `non_blocking=True` on a side CUDA stream, so they overlap
+    with the computation on the current batch; `transform` (e.g. the data scaler) is applied to
+    each batch on the device right after the copy, after the seeded `augment` of an `AugmentedLoader`.
+    When the loader is exhausted it is restarted.
+    Without CUDA the batches are transferred synchronously.
+    With a `profiling.StepTimer` as `timer`, fetching a batch from `loader` is timed as phase 'data' and its
+    copy to the device and `transform` as phase 'h2d'.
+    """
+
+    def __init__(self, loader, device, transform=None, depth=2, timer=None):
+        # Augment the batches on the device instead of in the main process
+        self.augment = loader.augment if isinstance(loader, AugmentedLoader) else None
+        self.loader = loader
+        self.device = torch.device(device)
+        self.transform = transform
+        self.depth = depth
+        self.timer = timer
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self._iter = self._seeded_batches()
+        self._batches = collections.deque()
+        for _ in range(depth):
+            self._preload()
+
+    def _seeded_batches(self):
+        if self.augment is not None:
+            return self.loader.batches()
+        return ((batch, None) for batch in self.loader)
+
+    def _next_host_batch(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            self._iter = self._seeded_batches()
+            return next(self._iter)
+
+    def _to_device(self, t):
+        if self.stream is not None and not t.is_pinned():
+            t = t.pin_memory()
+        return t.to(self.device, non_blocking=True)
+
+    def _phase(self, name):
+        return self.timer.phase(name) if self.timer is not None else contextlib.nullcontext()
+
+    def _preload(self):
+        with self._phase('data'):
+            batch, seed = self._next_host_batch()
+        with self._phase('h2d'), torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext():
+            batch = _map_tensors(self._to_device, batch)
+            if self.augment is not None:
+                batch = self.augment(batch, seed)
+            if self.transform is not None:
+                batch = self.transform(batch)
+        self._batches.append(batch)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self._batches.popleft()
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # Keep the caching allocator from reusing the memory while the current stream uses it
+            _map_tensors(lambda t: t.record_stream(current_stream), batch)
+        self._preload()
+        return batch
+
+
+def _netcdf_source(config):
+    """(path, key, index) of the NetCDF variable of the NC and PDE datasets, where `index` selects from each step."""
+    if config.data.dataset == 'NC':
+        path = f'/data1/DATA_PUBLIC/Southern_Ocean/bsose_i122_{config.data.date_range}_{config.data.category}.nc'
+        index = (slice(config.data.depth, config.data.depth + 1), slice(config.data.land_cut, None))
+        return path, config.data.key, index
+    elif config.data.dataset == 'PDE':
+        return '/data1/20000-25-400-200.nc', 'data', (slice(None), slice(5, 300), slice(5, -5))
+    raise NotImplementedError(f'Dataset {config.data.dataset} is not stored in NetCDF.')
+
+
+def get_land_mask(config):
+    """Boolean (y, x) mask of the selected depth and rows of the NC data that is True on land."""
+    path, key, index = _netcdf_source(config)
+    if config.data.cache_dir:
+        _, mask = get_netcdf_cache(path, key, index, config.data.cache_dir, config.data.cache_dtype)
+        return mask[0]
+    data = NetCDFVariable(path, key)
+    # The land mask does not change over time
+    mask = np.ma.getmaskarray(data[(0,) + index])[0]
+    data.close()
+    return mask
+
+
+class RunningStatistics:
+    """Per-channel count, mean, variance, min, max and a uniform sample of the values of (N, C, ...) arrays.
+
+    Statistics of separate parts of the data are combined with `merge`, using the parallel form of Welford's algorithm
+    for the variance. The sample keeps the `sample_size` values with the smallest random keys, which is a uniform
+    sample of all values seen and also mergeable; quantiles are estimated from it.
+    """
+
+    def __init__(self, num_channels, sample_size=100000):
+        self.sample_size = sample_size
+        self.count = np.zeros(num_channels, dtype=np.int64)
+        self.mean = np.zeros(num_channels)
+        self.m2 = np.zeros(num_channels)
+        self.min = np.full(num_channels, np.inf)
+        self.max = np.full(num_channels, -np.inf)
+        self.keys = [np.empty(0) for _ in range(num_channels)]
+        self.sample = [np.empty(0) for _ in range(num_channels)]
+
+    def _keep_smallest(self, c, keys, values):
+        if len(keys) > self.sample_size:
+            keep = np.argpartition(keys, self.sample_size)[:self.sample_size]
+            keys, values = keys[keep], values[keep]
+        self.keys[c], self.sample[c] = keys, values
+
+    def update(self, x, mask=None, rng=None):
+        """Add the values of `x` where `mask` (True for missing values, e.g. land) is False."""
+        rng = np.random.default_rng() if rng is None else rng
+        chunk = RunningStatistics(len(self.count), self.sample_size)
+        for c in range(len(self.count)):
+            values = np.asarray(x[:, c], dtype=np.float64)
+            values = values[~mask[:, c]] if mask is not None else values.ravel()
+            if len(values) == 0:
+                continue
+            chunk.count[c] = len(values)
+            chunk.mean[c] = values.mean()
+            chunk.m2[c] = np.square(values - chunk.mean[c]).sum()
+            chunk.min[c], chunk.max[c] = values.min(), values.max()
+            chunk._keep_smallest(c, rng.random(len(values)), values)
+        self.merge(chunk)
+
+    def merge(self, other):
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = np.where(count > 0, self.mean + delta * other.count / count, 0.)
+            self.m2 = np.where(count > 0, self.m2 + other.m2 + delta ** 2 * self.count * other.count / count, 0.)
+        self.count = count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        for c in range(len(self.count)):
+            self._keep_smallest(c, np.concatenate([self.keys[c], other.keys[c]]),
+                                np.concatenate([self.sample[c], other.sample[c]]))
+        return self
+
+    def result(self, quantiles=()):
+        return dict(count=self.count.tolist(),
+                    mean=self.mean.tolist(),
+                    std=np.sqrt(self.m2 / np.maximum(self.count, 1)).tolist(),
+                    min=self.min.tolist(),
+                    max=self.max.tolist(),
+                    quantiles={str(q): [float(np.quantile(sample, q)) if len(sample) else float('nan')
+                                        for sample in self.sample] for q in quantiles})
+
+
+class _StatisticsChunks(Dataset):
+    """`RunningStatistics` of consecutive blocks of `steps` time steps of `data[:, *index]`."""
+
+    def __init__(self, data, index, steps, mask=None, sample_size=100000, seed=0):
+        self.data = data
+        self.index = index
+        self.steps = steps
+        self.mask = mask
+        self.sample_size = sample_size
+        self.seed = seed
+
+    def __len__(self):
+        return math.ceil(len(self.data) / self.steps)
+
+    def __getitem__(self, i):
+        chunk = self.data[(slice(i * self.steps, (i + 1) * self.steps),) + self.index]
+        mask = np.ma.getmaskarray(chunk)
+        if self.mask is not None:
+            mask = mask | self.mask
+        stats = RunningStatistics(chunk.shape[1], self.sample_size)
+        stats.update(np.ma.getdata(chunk), mask, rng=np.random.default_rng((self.seed, i)))
+        return stats
+
+
+def get_data_statistics(config, chunk_bytes=64 << 20, sample_size=100000):
+    """Per-channel statistics of the NetCDF data of `config`, computed once in a streaming pass and cached.
+
+    The variable is read in chunks of about `chunk_bytes` by `config.data.num_workers` DataLoader workers in parallel,
+    from the memory-mapped cache if `config.data.cache_dir` is set. Masked values (land) are ignored. The result is
+    saved as JSON in `config.data.cache_dir`, keyed by a fingerprint of the file and the selected part of it.
+
+    Returns:
+      A dict of per-channel lists `count`, `mean`, `std`, `min` and `max`, and `quantiles` mapping each quantile in
+      `config.data.normalization_quantiles` (as a string) to per-channel values.
+    """
+    path, key, index = _netcdf_source(config)
+    quantiles = tuple(config.data.normalization_quantiles)
+    cache_dir = config.data.cache_dir or os.path.dirname(path)
+    name = hashlib.sha256(repr((_file_fingerprint(path), key, index, quantiles, sample_size)).encode()).hexdigest()[:16]
+    stats_path = os.path.join(cache_dir, f'{os.path.splitext(os.path.basename(path))[0]}-{key}-stats-{name}.json')
+    if not os.path.exists(stats_path) and distributed.is_main_process():
+        if config.data.cache_dir:
+            data, mask = get_netcdf_cache(path, key, index, config.data.cache_dir, config.data.cache_dtype)
+            chunks_index = ()
+        else:
+            data, mask = NetCDFVariable(path, key, chunk_cache_bytes=config.data.chunk_cache_mb << 20), None
+            chunks_index = index
+        step_bytes = np.prod(data[(slice(0, 1),) + chunks_index].shape) * 4
+        steps = max(int(chunk_bytes // step_bytes), 1)
+        chunks = _StatisticsChunks(data, chunks_index, steps, mask=mask, sample_size=sample_size, seed=config.seed)
+        loader = DataLoader(chunks, batch_size=None, num_workers=_num_workers(config.data.num_workers),
+                            worker_init_fn=netcdf_worker_init_fn)
+        stats = None
+        for chunk in loader:
+            stats = chunk if stats is None else stats.merge(chunk)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{stats_path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as fout:
+            json.dump(stats.result(quantiles), fout)
+        os.replace(tmp_path, stats_path)
+    distributed.barrier()
+    with open(stats_path) as fin:
+        return json.load(fin)
+
+
+def _normalization(config):
+    """Per-channel (shift, scale) of `config.data.normalization`, shaped to broadcast over (B, C, H, W) batches."""
+    stats = get_data_statistics(config)
+    if config.data.normalization == 'standard':
+        shift, scale = stats['mean'], stats['std']
+    elif config.data.normalization == 'minmax':
+        shift, scale = stats['min'], np.subtract(stats['max'], stats['min'])
+    elif config.data.normalization == 'quantile':
+        low, high = (stats['quantiles'][str(q)] for q in config.data.normalization_quantiles)
+        shift, scale = low, np.subtract(high, low)
+    else:
+        raise ValueError(f'Unknown normalization {config.data.normalization}.')
+    shift = torch.tensor(shift, dtype=torch.float32)[:, None, None]
+    scale = torch.tensor(scale, dtype=torch.float32).clamp(min=1e-12)[:, None, None]
+    return shift, scale
+
+
 def get_data_scaler(config):
-    """Data normalizer. Assume data are always in [0, 1]."""
-    if config.data.centered:
+    """Data normalizer. Assume data are always in [0, 1], unless `config.data.normalization` maps them there per channel
+    ('minmax', 'quantile') or to zero mean and unit variance ('standard') with the statistics of the dataset."""
+    if config.data.normalization == 'none':
+        normalize = lambda x: x
+    else:
+        shift, scale = _normalization(config)
+        normalize = lambda x: (x - shift.to(x)) / scale.to(x)
+
+    if config.data.centered and config.data.normalization != 'standard':
         # Rescale to [-1, 1]
-        return lambda x: x * 2. - 1.
+        return lambda x: normalize(x) * 2. - 1.
     else:
-        return lambda x: x
+        return normalize
 
 
 def get_data_inverse_scaler(config):
     """Inverse data normalizer."""
-    if config.data.centered:
+    if config.data.normalization == 'none':
+        denormalize = lambda x: x
+    else:
+        shift, scale = _normalization(config)
+        denormalize = lambda x: x * scale.to(x) + shift.to(x)
+
+    if config.data.centered and config.data.normalization != 'standard':
         # Rescale [-1, 1] to [0, 1]
-        return lambda x: (x + 1.) / 2.
+        return lambda x: denormalize((x + 1.) / 2.)
     else:
-        return lambda x: x
+        return denormalize
 
 
 def central_crop(size):
@@ -178,6 +958,12 @@ def get_dataset(config, uniform_dequantization=False, evaluation=False):
         raise ValueError(f'Batch sizes ({batch_size} must be divided by'
                          f'the number of devices ({torch.cuda.device_count()})')
 
+    # In multi-process training every rank loads its share of the batch
+    world_size = distributed.get_world_size()
+    if batch_size % world_size != 0:
+        raise ValueError(f'Batch size ({batch_size}) must be divided by the number of processes ({world_size})')
+    batch_size //= world_size
+
     # Reduce this when image resolution is too large and data pointer is stored
     shuffle_buffer_size = 10000
     # prefetch_size = tf.data.experimental.AUTOTUNE
@@ -185,10 +971,21 @@ def get_dataset(config, uniform_dequantization=False, evaluation=False):
     train_dataset = test_dataset = None
 
     # Create dataset builders for each dataset.
-    if config.data.dataset == 'CIFAR10':
-        transform = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Resize([config.data.image_size, config.data.image_size], antialias=True)])
+    # Workers only decode samples; conversion, crops, resizing and flips are applied to whole batches
+    flip = config.data.random_flip and not evaluation
+    rank = distributed.get_rank()
+    if config.data.shard_dir:
+        # Preprocessed shards written by shards.py, streamed instead of reading single files
+        train_dataset = ShardedDataset(config.data.shard_dir, 'train', shuffle=True,
+                                       shuffle_buffer_size=shuffle_buffer_size, seed=config.seed,
+                                       num_replicas=world_size, rank=rank)
+        test_dataset = ShardedDataset(config.data.shard_dir, 'test', shuffle=False, seed=config.seed,
+                                      num_replicas=world_size, rank=rank)
+        augment = BatchAugment(flip=flip, dequantize=uniform_dequantization)
+
+    elif config.data.dataset == 'CIFAR10':
+        transform = transforms.PILToTensor()
+        augment = BatchAugment(resize=config.data.image_size, flip=flip, dequantize=uniform_dequantization)
 
         train_dataset = datasets.CIFAR10(root='./data', train=True,
                                          download=True, transform=transform)
@@ -196,9 +993,8 @@ def get_dataset(config, uniform_dequantization=False, evaluation=False):
                                         download=True, transform=transform)
 
     elif config.data.dataset == 'SVHN':
-        transform = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Resize([config.data.image_size, config.data.image_size], antialias=True)])
+        transform = transforms.PILToTensor()
+        augment = BatchAugment(resize=config.data.image_size, flip=flip, dequantize=uniform_dequantization)
 
         train_dataset = datasets.SVHN(root='./data', split='train',
                                       download=True, transform=transform)
@@ -207,10 +1003,9 @@ def get_dataset(config, uniform_dequantization=False, evaluation=False):
 
 
     elif config.data.dataset == 'CELEBA':
-        transform = transforms.Compose([
-            transforms.ToTensor(),
-            central_crop(140),
-            transforms.Resize([config.data.image_size, config.data.image_size], antialias=True)])
+        transform = transforms.PILToTensor()
+        augment = BatchAugment(center_crop=140, resize=config.data.image_size, flip=flip,
+                               dequantize=uniform_dequantization)
 
         train_dataset = datasets.CelebA(root='./data', split='train',
                                         download=True, transform=transform)
@@ -218,16 +1013,18 @@ def get_dataset(config, uniform_dequantization=False, evaluation=False):
                                        download=True, transform=transform)
 
     elif config.data.dataset == 'LSUN':
+        # Images differ in size, so they are brought to a common size before collation
         if config.data.image_size == 128:
             transform = transforms.Compose([
-                transforms.ToTensor(),
+                transforms.PILToTensor(),
                 resize_small(config.data.image_size),
                 central_crop(config.data.image_size)])
 
         else:
             transform = transforms.Compose([
-                transforms.ToTensor(),
+                transforms.PILToTensor(),
                 central_crop(config.data.image_size)])
+        augment = BatchAugment(flip=flip, dequantize=uniform_dequantization)
 
         train_dataset = datasets.LSUN(root='./data', classes=[config.data.category], transform=transform)
         test_dataset = datasets.LSUN(root='./data', classes=[config.data.category], transform=transform)
@@ -237,40 +1034,80 @@ def get_dataset(config, uniform_dequantization=False, evaluation=False):
 
     elif config.data.dataset == 'NC':
 
-        from netCDF4 import Dataset
+        path, key, index = _netcdf_source(config)
 
-        data = Dataset(
-            f'/data1/DATA_PUBLIC/Southern_Ocean/bsose_i122_{config.data.date_range}_{config.data.category}.nc')
-        data = data[config.data.key]
+        transform = transforms.ToTensor()
 
-        transform = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.RandomCrop(config.data.image_size, pad_if_needed=True, padding_mode='constant')])
-
-        train_dataset = CustomDataset(data, split='train', transform=transform, land_cut=config.data.land_cut)
-        test_dataset = CustomDataset(data, split='test', transform=transform, land_cut=config.data.land_cut)
+        if config.data.cache_dir:
+            # The cache keeps the (time, depth, y, x) layout with only the selected depth and the rows past land_cut
+            data, mask = get_netcdf_cache(path, key, index, config.data.cache_dir, config.data.cache_dtype)
+            mask = mask[0]
+            depth, land_cut = 0, 0
+        else:
+            data = NetCDFVariable(path, key, chunk_cache_bytes=config.data.chunk_cache_mb << 20)
+            depth, land_cut = config.data.depth, config.data.land_cut
+            # The land mask does not change over time
+            mask = np.ma.getmaskarray(data[0, depth, land_cut:])
+            data.close()
+
+        augment = BatchAugment(flip=flip)
+        # Crops are drawn from the positions that are mostly ocean instead of uniformly
+        origins = get_crop_index(mask, config.data.image_size, config.data.min_ocean_fraction, config.data.cache_dir)
+        train_dataset = CustomDataset(data, split='train', transform=transform, land_cut=land_cut, depth=depth,
+                                      crop_origins=origins, crop_size=config.data.image_size, seed=config.seed)
+        test_dataset = CustomDataset(data, split='test', transform=transform, land_cut=land_cut, depth=depth,
+                                     crop_origins=origins, crop_size=config.data.image_size, seed=config.seed)
 
     elif config.data.dataset == 'PDE':
 
-        from netCDF4 import Dataset
+        path, key, index = _netcdf_source(config)
 
-        data = Dataset('/data1/20000-25-400-200.nc')
-        data = data['data']
+        transform = None
+        augment = BatchAugment(random_crop=config.data.image_size, flip=flip)
 
-        transform = transforms.Compose([
-            transforms.RandomCrop(config.data.image_size, pad_if_needed=True, padding_mode='constant')])
+        region = index[1:]
+        if config.data.cache_dir:
+            data, _ = get_netcdf_cache(path, key, index, config.data.cache_dir, config.data.cache_dtype)
+            region = (slice(None), slice(None))
+        else:
+            data = NetCDFVariable(path, key, chunk_cache_bytes=config.data.chunk_cache_mb << 20)
 
-        train_dataset = PDEDataset(data, split='train', transform=transform)
-        test_dataset = PDEDataset(data, split='test', transform=transform)
+        # Frames are read in blocks and cached, as each of them is part of two pairs
+        pairs = dict(stride=config.data.pair_stride, cache_frames=config.data.frame_cache,
+                     read_block=config.data.read_block)
+        train_dataset = PDEDataset(data, split='train', transform=transform, region=region, **pairs)
+        test_dataset = PDEDataset(data, split='test', transform=transform, region=region, **pairs)
 
     else:
         raise NotImplementedError(
             f'Dataset {config.data.dataset} not yet supported.')
 
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=4)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=4)
-
-    return train_loader, test_loader
+    # Workers are kept alive across epochs and batches are pinned for asynchronous device copies
+    pin_memory = torch.cuda.is_available()
+    # The data order can be resumed after pre-emption; worker seeds come from a dedicated generator so that
+    # creating the loaders leaves the global RNG untouched
+    sharded = isinstance(train_dataset, ShardedDataset)
+    if sharded:
+        # Sharded datasets split and shuffle the data themselves and keep track of their position like a sampler
+        train_sampler, test_sampler = train_dataset, test_dataset
+    else:
+        train_sampler = ResumableSampler(train_dataset, shuffle=True, seed=config.seed, num_replicas=world_size,
+                                         rank=rank, window=config.data.sample_window)
+        test_sampler = ResumableSampler(test_dataset, shuffle=False, seed=config.seed, num_replicas=world_size,
+                                        rank=rank)
+    generator = torch.Generator()
+    generator.manual_seed(config.seed)
+    # NetCDF files are opened separately in every worker
+    num_workers = _num_workers(config.data.num_workers)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, sampler=None if sharded else train_sampler,
+                              num_workers=num_workers, pin_memory=pin_memory, persistent_workers=num_workers > 0,
+                              generator=generator, worker_init_fn=netcdf_worker_init_fn)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, sampler=None if sharded else test_sampler,
+                             num_workers=num_workers, pin_memory=pin_memory, persistent_workers=num_workers > 0,
+                             generator=generator, worker_init_fn=netcdf_worker_init_fn)
+
+    return (AugmentedLoader(train_loader, augment, sampler=train_sampler),
+            AugmentedLoader(test_loader, augment, sampler=test_sampler))
 
 
 def get_mask_dataset(config):
@@ -0,0 +1,69 @@
+# pylint: skip-file
+"""Multi-process training over `torch.distributed`.
+
+Training runs in one process per device when launched with torchrun, which sets RANK, LOCAL_RANK
+and WORLD_SIZE:
+
+  torchrun --nproc_per_node=4 main.py --config ... --mode train --workdir ...
+
+Without these variables everything below falls back to a single process. CUDA devices use the
+NCCL backend, CPU runs use gloo.
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def is_initialized():
+  return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+  return dist.get_rank() if is_initialized() else 0
+
+
+def get_world_size():
+  return dist.get_world_size() if is_initialized() else 1
+
+
+def is_main_process():
+  """Only the main process writes logs, summaries, samples and checkpoints."""
+  return get_rank() == 0
+
+
+def init_distributed(config):
+  """Join the process group when launched by torchrun; a no-op for single-process runs.
+
+  On CUDA, `config.device` is set to the local device of this process.
+  """
+  if is_initialized() or int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+    return
+  if torch.device(config.device).type == 'cuda':
+    local_rank = int(os.environ['LOCAL_RANK'])
+    torch.cuda.set_device(local_rank)
+    config.device = torch.device('cuda', local_rank)
+    dist.init_process_group(backend='nccl')
+  else:
+    dist.init_process_group(backend='gloo')
+
+
+def all_gather_object(obj):
+  """List of `obj` from every rank, indexed by rank."""
+  if not is_initialized():
+    return [obj]
+  objs = [None] * get_world_size()
+  dist.all_gather_object(objs, obj)
+  return objs
+
+
+def barrier():
+  if is_initialized():
+    dist.barrier()
+
+
+def cleanup():
+  if is_initialized():
+    dist.barrier()
+    dist.destroy_process_group()
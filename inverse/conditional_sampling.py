@@ -1,33 +1,127 @@
+import logging
 import torch
 
-from models.utils import from_flattened_numpy, to_flattened_numpy, get_score_fn
-from scipy import integrate
-from inverse.operators import bcmm, InpaintOperator
+import numpy as np
+
+from models.utils import get_score_fn
 import sde_lib
 from functools import partial
 from utils import Clock
 
-def get_solver(config, ode_func, x0, t1, shape, eps):
-
-    if config.inverse.solver in ['RK45', 'RK23']:
-        solution = integrate.solve_ivp(ode_func, (t1, eps), x0,
-                                       rtol=1e-3, atol=1e-3,
-                                       method=config.inverse.solver, )
-        nfe = solution.nfev
-        x = torch.tensor(solution.y[:, -1]).reshape(shape).to(config.device).type(torch.float32)
-        print(nfe)
-
-        return x
-
-    elif config.inverse.solver == 'fixed':
-        x = x0
-        dt = -.00002 # inverse ODE
-        for t in torch.linspace(t1, eps, 5000):
-            x += ode_func(t, x) * dt
-        return torch.tensor(x).reshape(shape).to(config.device).type(torch.float32)
+# Embedded Runge-Kutta pairs as (C, A, B, E, error order); the last stage is evaluated at the new state (FSAL)
+_TABLEAUS = {
+    'RK45': ([0, 1/5, 3/10, 4/5, 8/9, 1, 1],
+             [[],
+              [1/5],
+              [3/40, 9/40],
+              [44/45, -56/15, 32/9],
+              [19372/6561, -25360/2187, 64448/6561, -212/729],
+              [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+              [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]],
+             [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0],
+             [-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40],
+             4),
+    'RK23': ([0, 1/2, 3/4, 1],
+             [[],
+              [1/2],
+              [0, 3/4],
+              [2/9, 1/3, 4/9]],
+             [2/9, 1/3, 4/9, 0],
+             [5/72, -1/12, -1/9, 1/8],
+             2),
+}
+
+
+def get_timesteps(config, t1, eps, device):
+    """`config.inverse.steps` + 1 times from `t1` down to `eps`, spaced by `config.inverse.schedule`.
+
+    'uniform' steps evenly in t, 'quadratic' evenly in sqrt(t) and 'log' evenly in log(t), which both take smaller
+    steps towards `eps` where the score changes fastest.
+    """
+    steps, schedule = config.inverse.steps, config.inverse.schedule
+    u = torch.linspace(0., 1., steps + 1, device=device, dtype=torch.float64)
+    if schedule == 'uniform':
+        t = t1 + (eps - t1) * u
+    elif schedule == 'quadratic':
+        t = (t1 ** .5 + (eps ** .5 - t1 ** .5) * u) ** 2
+    elif schedule == 'log':
+        t = torch.exp(np.log(t1) + (np.log(eps) - np.log(t1)) * u)
+    else:
+        raise NotImplementedError(f'Schedule {schedule} unknown.')
+    return t.float()
+
+
+def _fixed_step(ode_func, x, timesteps, method):
+    """Euler or Heun steps over `timesteps`."""
+    for t, t_next in zip(timesteps[:-1], timesteps[1:]):
+        dt = t_next - t
+        dx = ode_func(t, x)
+        if method == 'heun':
+            dx = (dx + ode_func(t_next, x + dt * dx)) / 2.
+        x = x + dt * dx
+    nfe = (len(timesteps) - 1) * (2 if method == 'heun' else 1)
+    return x, nfe
+
+
+def _rms(x):
+    return x.pow(2).mean().sqrt()
+
+
+def _adaptive_step(ode_func, x, t1, eps, method, rtol, atol, safety=0.9):
+    """Adaptive embedded Runge-Kutta integration from `t1` to `eps`, controlling the RMS error over the whole batch."""
+    C, A, B, E, order = _TABLEAUS[method]
+    t = torch.as_tensor(t1, dtype=torch.float32, device=x.device)
+    dx = ode_func(t, x)
+    nfe = 1
+    # Initial step from the scales of the state and its derivative, as in scipy
+    scale = atol + rtol * x.abs()
+    d0, d1 = _rms(x / scale), _rms(dx / scale)
+    h = (0.01 * d0 / d1).item() if d0 > 1e-5 and d1 > 1e-5 else 1e-6
+    while t > eps:
+        dt = -min(h, (t - eps).item())
+        k = [dx]
+        for c, a in zip(C[1:], A[1:]):
+            x_stage = x + dt * sum(a_j * k_j for a_j, k_j in zip(a, k) if a_j != 0)
+            k.append(ode_func(t + c * dt, x_stage))
+        nfe += len(C) - 1
+        # The last stage is the new state
+        x_new = x_stage
+        error = dt * sum(e * k_j for e, k_j in zip(E, k) if e != 0)
+        norm = _rms(error / (atol + rtol * torch.maximum(x.abs(), x_new.abs()))).item()
+        if not np.isfinite(norm):
+            raise RuntimeError(f'{method} solver diverged at t={t.item():.6g}: error norm is {norm}.')
+        if norm < 1.:
+            t, x, dx = t + dt, x_new, k[-1]
+            factor = 10. if norm == 0. else min(10., safety * norm ** (-1. / (order + 1)))
+        else:
+            factor = max(0.2, safety * norm ** (-1. / (order + 1)))
+        h = abs(dt) * factor
+        # Below a few float32 ulps of t, steps no longer change t and the loop would never end
+        if t > eps and h < 10 * np.finfo(np.float32).eps * t.abs().item():
+            raise RuntimeError(f'{method} solver step size {h:.3g} underflowed at t={t.item():.6g}.')
+    return x, nfe
 
 
+def get_solver(config, ode_func, x0, t1, shape, eps):
+    """Integrate `ode_func(t, x)` from `t1` to `eps` with torch tensors on the device.
+
+    `config.inverse.solver` is 'euler' ('fixed') or 'heun' with the steps of `get_timesteps`, or the adaptive 'RK45'
+    (Dormand-Prince) or 'RK23' (Bogacki-Shampine) with `config.inverse.rtol` and `config.inverse.atol`. The solvers do
+    not disable autograd, so `ode_func` can differentiate through its input, but they never backpropagate through
+    steps.
+    """
+    x = x0.reshape(shape).to(config.device).type(torch.float32)
+    solver = config.inverse.solver
+    if solver in ['euler', 'fixed', 'heun']:
+        timesteps = get_timesteps(config, t1, eps, config.device)
+        x, nfe = _fixed_step(ode_func, x, timesteps, 'heun' if solver == 'heun' else 'euler')
+    elif solver in _TABLEAUS:
+        x, nfe = _adaptive_step(ode_func, x, t1, eps, solver, config.inverse.rtol, config.inverse.atol)
+    else:
+        raise NotImplementedError(f'Solver {solver} unknown.')
+    logging.info(f'{solver} solver: {nfe} function evaluations.')
 
+    return x
 
 
 def get_sampler(config, obsv_sde, shape, lambda_schedule=lambda t: (1.0-t)*0.8, eps=1e-3):
@@ -35,6 +129,8 @@ def get_sampler(config, obsv_sde, shape, lambda_schedule=lambda t: (1.0-t)*0.8,
         sampler = get_controlled_sampler(config, obsv_sde, shape, lambda_schedule, eps=eps)
     elif config.inverse.sampler == 'dps':
         sampler = get_dps_sampler(config, obsv_sde, shape, eps=eps)
+    elif config.inverse.sampler == 'ddrm':
+        sampler = get_ddrm_sampler(config, obsv_sde, shape, eps=eps)
     else:
         raise NotImplementedError
 
@@ -43,9 +139,7 @@ def get_sampler(config, obsv_sde, shape, lambda_schedule=lambda t: (1.0-t)*0.8,
 def get_controlled_sampler(config, obsv_sde:sde_lib.OBSVSDE, shape, lambda_schedule, eps=1e-3):
     """"""
 
-    A, L, T = obsv_sde.operator.decompose(shape)
-    M1 = L.transpose(2,3) @ A
-    M2 = torch.eye(A.shape[2], device=A.device)-A
+    operator = obsv_sde.operator
     device = config.device
     def drift_fn(model, x, t):
         """Get the drift function of the reverse-time SDE."""
@@ -60,8 +154,9 @@ def get_controlled_sampler(config, obsv_sde:sde_lib.OBSVSDE, shape, lambda_sched
         yt = obsv_sde.observe_sampling(z, t)
         weight = lambda_schedule(t)
 
-        if isinstance(obsv_sde.operator, InpaintOperator):
-            x = weight[:,None,None] * bcmm(M1, yt) + (1.-weight)[:,None,None] * bcmm(A, x) + bcmm(M2, x)
+        # Move the observed part A^+ A x towards A^+ y_t and keep the part in the null space of A
+        observed = operator.pinv(operator(x, keep_shape=False))
+        x = weight[:,None,None] * operator.pinv(yt) + (1.-weight)[:,None,None] * observed + (x - observed)
 
         return x
 
@@ -85,14 +180,12 @@ def get_controlled_sampler(config, obsv_sde:sde_lib.OBSVSDE, shape, lambda_sched
                 x = z
 
             def ode_func(t, x):
-                x_hat = from_flattened_numpy(x, shape).to(device).type(torch.float32)
                 vec_t = torch.ones(shape[0], device=device) * t
-                x_hat = optimize_fn(x_hat, vec_t).reshape(shape)
-                drift = drift_fn(model, x_hat, vec_t)
-                return to_flattened_numpy(drift)
+                x_hat = optimize_fn(x, vec_t).reshape(shape)
+                return drift_fn(model, x_hat, vec_t)
 
             solver = partial(get_solver, config=config, shape=shape, eps=eps)
-            return solver(ode_func=ode_func, x0=to_flattened_numpy(x), t1=obsv_sde.state_sde.T)
+            return solver(ode_func=ode_func, x0=x, t1=obsv_sde.state_sde.T)
 
     return controlled_sampler
 
@@ -102,7 +195,7 @@ def get_dps_sampler(config, obsv_sde:sde_lib.OBSVSDE, shape, eps=1e-3):
 
     device = config.device
     obsv_var = config.inverse.variance
-    observation = obsv_sde.y0 + torch.randn_like(obsv_sde.y0, device=device) * obsv_var**.5
+    observation = obsv_sde.y0 + obsv_sde.operator.observation_noise(obsv_sde.y0, obsv_var**.5)
     clock = Clock(10)
 
     def drift_fn(score, score_cond, x, t):
@@ -124,14 +217,18 @@ def get_dps_sampler(config, obsv_sde:sde_lib.OBSVSDE, shape, eps=1e-3):
         return x0_hat, score
 
     def cond_grad_fn(xt, x0_hat, scale=True):
-        """Gradient of conditional distribution of y on x0_hat."""
+        """Gradient of conditional distribution of y on x0_hat.
+
+        Every sample has its own observation and residual norm; the sum of the log-likelihoods over the batch has the
+        gradient of each sample's log-likelihood with respect to its own state.
+        """
         difference = observation - obsv_sde.operator(x0_hat, keep_shape=False)
-        norm = torch.linalg.norm(difference)
-        logp = - norm**2 / obsv_var
+        norm = torch.linalg.norm(difference.flatten(1), dim=1)
+        logp = - (norm**2).sum() / obsv_var
         norm_grad = torch.autograd.grad(outputs=logp, inputs=xt)[0]
 
         if scale is True:
-            norm_grad /= norm
+            norm_grad /= norm[:, None, None, None]
 
         return norm_grad
 
@@ -153,18 +250,106 @@ def get_dps_sampler(config, obsv_sde:sde_lib.OBSVSDE, shape, eps=1e-3):
             x = z
 
         def ode_func(t, x):
-            x_hat = from_flattened_numpy(x, shape).to(device).type(torch.float32).requires_grad_()
-            vec_t = torch.ones(shape[0], device=device) * t
+            # Guidance differentiates through the model; the graph is dropped after every evaluation
+            with torch.enable_grad():
+                x_hat = x.detach().requires_grad_()
+                vec_t = torch.ones(shape[0], device=device) * t
 
-            x0_hat, score = x0_hat_fn(model, x_hat, vec_t)
-            score_cond = cond_grad_fn(x_hat, x0_hat)
-            drift = drift_fn(score, score_cond, x_hat, vec_t)
+                x0_hat, score = x0_hat_fn(model, x_hat, vec_t)
+                score_cond = cond_grad_fn(x_hat, x0_hat)
+                drift = drift_fn(score, score_cond, x_hat, vec_t)
 
-            clock.tic(f"t = {round(t,5)}")
+            clock.tic(f"t = {round(float(t),5)}")
 
-            return to_flattened_numpy(drift)
+            return drift.detach()
 
         solver = partial(get_solver, config=config, shape=shape, eps=eps)
-        return solver(ode_func=ode_func, x0=to_flattened_numpy(x), t1=obsv_sde.state_sde.T)
+        return solver(ode_func=ode_func, x0=x, t1=obsv_sde.state_sde.T)
+
+    return dps_sampler
+
+
+def get_ddrm_sampler(config, obsv_sde:sde_lib.OBSVSDE, shape, eps=1e-3):
+    """Denoising diffusion restoration models (DDRM, Kawar et al. 2022).
+
+    Denoises in the spectral space of the SVD A = U diag(s) V^T of the operator, which must provide `singular_values`,
+    `support`, `Vt`, `V` and `Ut`. Each coefficient of V^T x is updated on its own: in the null space of A with a DDIM
+    step, elsewhere towards the coefficient of the observation s^-1 U^T y, depending on whether it is noisier than the
+    observation noise. `config.inverse.steps` model evaluations are spread uniformly from T to `eps`; `eta` and `eta_b`
+    weight the fresh noise and the observation.
+    """
+
+    device = config.device
+    operator = obsv_sde.operator
+    sde = obsv_sde.state_sde
+    steps = config.inverse.steps
+    eta, eta_b = config.inverse.eta, config.inverse.eta_b
+    sigma_y = config.inverse.variance ** .5
+    observation = obsv_sde.y0 + operator.observation_noise(obsv_sde.y0, sigma_y)
+
+    s = operator.singular_values()
+    support = operator.support()
+    s_safe = torch.where(support, s, torch.ones_like(s))
+    y_bar = torch.where(support, operator.Ut(observation) / s_safe, torch.zeros_like(s))
+    # Noise level of each coefficient of y_bar; infinite in the null space
+    sigma_obs = torch.where(support, sigma_y / s_safe, torch.full_like(s, float('inf')))
+
+    def x0_hat_fn(model, xt, t):
+        """Estimation of x0."""
+        score_fn = get_score_fn(sde, model, train=False, continuous=True)
+        score = score_fn(xt, t)
+
+        mean, std = sde.marginal_coef(t)
+
+        # Tweedie's formula
+        x0_hat = (xt + std[:,None, None, None]**2 * score) / mean[:,None, None, None]
+        return x0_hat
+
+    def step_fn(x_bar, x0_bar, sigma, sigma_next):
+        """One DDRM step from noise level `sigma` to `sigma_next` of the spectral coefficients."""
+        noise = torch.randn_like(x_bar)
+        null = x0_bar + sigma_next * ((1. - eta ** 2) ** .5 * (x_bar - x0_bar) / sigma + eta * noise)
+        # Less noisy than the observation: keep moving towards y_bar without reaching it
+        below = x0_bar + sigma_next * ((1. - eta ** 2) ** .5 * (y_bar - x0_bar) / sigma_obs + eta * noise)
+        # Noisier than the observation: use y_bar and top the noise up to sigma_next
+        above = (1. - eta_b) * x0_bar + eta_b * y_bar \
+            + (sigma_next ** 2 - (eta_b * sigma_obs) ** 2).clamp(min=0.) ** .5 * noise
+        return torch.where(support, torch.where(sigma_next < sigma_obs, below, above), null)
+
+    def ddrm_sampler(model, z=None):
+        """The DDRM sampler.
+
+        Args:
+          model: A score model.
+          z: If present, generate samples from latent code `z`.
+        Returns:
+          samples.
+        """
+        with torch.no_grad():
+            # Initial sample
+            if z is None:
+                # If not represent, sample the latent code from the prior distibution of the SDE.
+                x = sde.prior_sampling(shape).to(device)
+            else:
+                x = z
 
-    return dps_sampler
\ No newline at end of file
+            timesteps = torch.linspace(sde.T, eps, steps, device=device)
+            view = (-1,) + (1,) * (y_bar.dim() - 1)
+            for i, t in enumerate(timesteps):
+                vec_t = torch.ones(shape[0], device=device) * t
+                x0_hat = x0_hat_fn(model, x, vec_t)
+                mean, std = sde.marginal_coef(vec_t)
+                # x / mean = x0 + sigma * noise with the noise level of the variance exploding SDE
+                sigma = (std / mean).reshape(view)
+                if i + 1 < steps:
+                    mean_next, std_next = sde.marginal_coef(torch.ones(shape[0], device=device) * timesteps[i + 1])
+                    sigma_next = (std_next / mean_next).reshape(view)
+                else:
+                    mean_next, sigma_next = torch.ones_like(mean), torch.zeros_like(sigma)
+
+                x_bar = step_fn(operator.Vt(x / mean[:, None, None, None]), operator.Vt(x0_hat), sigma, sigma_next)
+                x = mean_next[:, None, None, None] * operator.V(x_bar).reshape(shape)
+
+            return x
+
+    return ddrm_sampler
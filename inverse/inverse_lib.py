@@ -1,12 +1,18 @@
 import datasets
-from .operators import InpaintOperator
+from .operators import InpaintOperator, GaussianFilter, SuperResolution, CompressedSensing, Colorization
+from .masks import generate_masks
 from .conditional_sampling import get_sampler
 from models import utils as mutils
 from utils import save_checkpoint, load_checkpoint, restore_checkpoint
 import os
+import logging
 import numpy as np
+import torch
 from torchvision.utils import make_grid, save_image
 
+# Config key of the degradation level of each operator, appended to the name of its working directory
+_OPERATOR_LEVELS = {'inpaint': 'ratio', 'inpaint_rnd': 'ratio', 'cs': 'ratio', 'blur': 'blur_std', 'sr': 'scale'}
+
 
 def _show_result(result):
     from torchvision.utils import make_grid, save_image
@@ -21,14 +27,58 @@ def _show_result(result):
     axe.imshow(image_grid[0])
     plt.show()
 
-def get_operator(config):
+def get_mask_source(config):
+    """Function from seeds to (len(seeds), 1, H, W) masks on the device for the inpainting operators.
+
+    'inpaint' uses MNIST digits, the mask of seed s being digit s modulo the size of the (unshuffled) dataset;
+    'inpaint_rnd' generates the masks of `config.inverse.mask` from the seeds.
+    """
+    if config.inverse.operator == 'inpaint':
+        dataset = datasets.get_mask_dataset(config).dataset
+        # Items are the digit repeated for a batch
+        return lambda seeds: torch.stack([dataset[int(s) % len(dataset)][0][0] for s in seeds]).to(config.device)
+    elif config.inverse.operator == 'inpaint_rnd':
+        return lambda seeds: generate_masks(config, seeds)
+    else:
+        raise NotImplementedError
 
-    if config.inverse.operator in ['inpaint', 'inpaint_rnd']:
-        mask_ds = datasets.get_mask_dataset(config)
-        mask_iter = iter(mask_ds)
-        mask, _ = next(mask_iter)
+def get_operator(config, seeds=None, mask_source=None):
+    """The observation operator of `config.inverse.operator`.
 
-        operator = InpaintOperator(mask=mask.squeeze(0).to(config.device))
+    With `config.inverse.mask_per_sample` the inpainting operators use one mask per seed in `seeds`, so every sample of
+    a batch is observed differently; otherwise the mask of `config.inverse.mask_seed` is shared by the batch. Masks come
+    from `mask_source`, by default `get_mask_source(config)`.
+    """
+    image_shape = (config.data.num_channels, config.data.image_size, config.data.image_size)
+
+    if config.inverse.operator in ['inpaint', 'inpaint_rnd']:
+        # A single mask is broadcast over the batch
+        if seeds is None or not config.inverse.mask_per_sample:
+            seeds = [config.inverse.mask_seed]
+        if mask_source is None:
+            mask_source = get_mask_source(config)
+        mask = mask_source(torch.as_tensor(seeds))
+        # MNIST masks are inverted by the transform of the mask dataset
+        if config.inverse.operator == 'inpaint_rnd' and config.inverse.invert:
+            mask = 1 - mask
+
+        operator = InpaintOperator(mask=mask)
+
+    elif config.inverse.operator == 'blur':
+        kernel_size = config.inverse.kernel_size
+        operator = GaussianFilter(image_shape=image_shape,
+                                  shape=(kernel_size, kernel_size), std=config.inverse.blur_std,
+                                  rcond=config.inverse.rcond, device=config.device)
+
+    elif config.inverse.operator == 'sr':
+        operator = SuperResolution(image_shape, factor=config.inverse.scale, device=config.device)
+
+    elif config.inverse.operator == 'cs':
+        operator = CompressedSensing(image_shape, ratio=config.inverse.ratio, seed=config.inverse.mask_seed,
+                                     device=config.device)
+
+    elif config.inverse.operator == 'colorize':
+        operator = Colorization(image_shape, device=config.device)
 
     else:
         raise NotImplementedError
@@ -40,39 +90,69 @@ def get_obsvsde(config, y0, operator):
     from sde_lib import LOBSVSDE
 
     sde, sampling_eps = _get_sde(config)
-    if config.inverse.sampler in ['controlled', 'dps']:
+    if config.inverse.sampler in ['controlled', 'dps', 'ddrm']:
         obsvsde = LOBSVSDE(sde, y0, operator)
     else:
         raise NotImplementedError
 
     return obsvsde, sampling_eps
 
-def _inverse_fn(config, score_model):
-    sampling_shape = (config.training.batch_size, config.data.num_channels,
-                      config.data.image_size, config.data.image_size)
-
-    _, test_ds = datasets.get_dataset(config)
-    test_iter = iter(test_ds)
-    origin, _ = next(test_iter)
-
-    operator = get_operator(config)
-    observation_vis = operator(origin.to(config.device), keep_shape=True) # for visualization
-    observation = operator(origin.to(config.device), keep_shape=False) # ill-posed observation
+def _inverse_fn(config, score_model, num_batches=1):
+    """Solve the inverse problems of the test split batch by batch.
 
-    obsvsde, sampling_eps = get_obsvsde(config, observation, operator)
-    sampling_fn = get_sampler(config, obsvsde, sampling_shape, eps=sampling_eps)
+    Every batch is one call of the sampler with one observation per sample; with per-sample masks, sample i of the
+    split is observed with the mask of seed `mask_seed + i`, so observations are reproducible.
 
-    sample = sampling_fn(score_model)
-    return origin, observation_vis, sample, operator
+    Yields:
+      (origin, observation for visualization, sample, operator) for the first `num_batches` batches, or for the whole
+      test split if `num_batches` is 0.
+    """
+    _, test_ds = datasets.get_dataset(config)
+    # Built once, as the MNIST masks of 'inpaint' come from a dataset
+    mask_source = get_mask_source(config) if config.inverse.operator in ['inpaint', 'inpaint_rnd'] else None
+    offset = 0
+    for i, (origin, _) in enumerate(test_ds):
+        if num_batches and i >= num_batches:
+            break
+        origin = origin.to(config.device)
+        seeds = config.inverse.mask_seed + offset + torch.arange(origin.shape[0])
+        offset += origin.shape[0]
+
+        operator = get_operator(config, seeds, mask_source)
+        observation_vis = operator(origin, keep_shape=True) # for visualization
+        observation = operator(origin, keep_shape=False) # ill-posed observation
+
+        obsvsde, sampling_eps = get_obsvsde(config, observation, operator)
+        sampling_fn = get_sampler(config, obsvsde, tuple(origin.shape), eps=sampling_eps)
+
+        sample = sampling_fn(score_model)
+        yield origin, observation_vis, sample, operator
 
 def inverse(config, ckptdir, workdir, visualize=True):
     score_model = mutils.create_model(config)
     score_model = load_checkpoint(ckptdir, score_model, config.device)
 
-    origin, observation, sample, operator = _inverse_fn(config, score_model)
-
-    workdir = os.path.join(workdir, f"{config.inverse.operator}-{config.inverse.ratio}")
+    # e.g. inpaint-0.5, blur-4.0, sr-4, colorize; only operators with a degradation level get one
+    level = _OPERATOR_LEVELS.get(config.inverse.operator)
+    name = config.inverse.operator if level is None else f"{config.inverse.operator}-{config.inverse[level]}"
+    workdir = os.path.join(workdir, name)
     os.makedirs(workdir, exist_ok=True)
+
+    errors = []
+    for i, (origin, observation, sample, operator) in enumerate(
+            _inverse_fn(config, score_model, config.inverse.num_batches)):
+        errors.append(evaluate_inverse(config, origin, sample, operator, reduce=False))
+        np.savez_compressed(os.path.join(workdir, f"inverse_{i:05d}.npz"), origin=origin.cpu().numpy(),
+                            observation=observation.cpu().numpy(), sample=sample.cpu().numpy())
+        logging.info("batch %d, MSE %.6f" % (i, errors[-1].mean().item()))
+        if i == 0:
+            _save_grids(workdir, observation, sample, visualize)
+
+    errors = torch.cat(errors)
+    logging.info("MSE %.6f over %d samples" % (errors.mean().item(), errors.shape[0]))
+
+
+def _save_grids(workdir, observation, sample, visualize):
     nrow = int(np.sqrt(sample.shape[0]))
     obsv_grid = make_grid(observation, nrow, padding=2)
     image_grid = make_grid(sample, nrow, padding=2)
@@ -91,19 +171,18 @@ def inverse(config, ckptdir, workdir, visualize=True):
         plt.show()
         plt.savefig(os.path.join(workdir, "visualize.png"))
 
-def evaluate_inverse(config, origin, inv, operator):
-    import torch
-
-    loss = torch.nn.MSELoss()
+def evaluate_inverse(config, origin, inv, operator, reduce=True):
+    loss = torch.nn.MSELoss(reduction='mean' if reduce else 'none')
     device = config.device
 
-    if config.inverse.operator in ['inpaint', 'inpaint_rnd']:
+    if config.inverse.operator in ['inpaint', 'inpaint_rnd', 'blur', 'sr', 'cs', 'colorize']:
 
         # mask the masked area and left inverted area
         #origin = operator(origin.to(config.device), keep_shape=False, invert=True)
         #inv = operator(inv.to(config.device), keep_shape=False, invert=True)
 
-        return loss(origin.to(device), inv.to(device)).item()
+        error = loss(origin.to(device), inv.to(device))
+        return error.item() if reduce else error.flatten(1).mean(1)
 
     else:
         raise NotImplementedError
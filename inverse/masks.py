@@ -0,0 +1,122 @@
+"""Batched generation of inpainting masks on the device.
+
+Every mask function maps a 1-D integer tensor of seeds to a (len(seeds), 1, size, size) float
+tensor of masks on the device of the seeds, with 1 for observed and 0 for missing pixels. Random
+numbers come from a counter-based hash of the seed, so each mask only depends on its own seed
+(not on the batch it is generated in) and no generator state, DataLoader or file is involved.
+"""
+import functools
+import math
+
+import torch
+
+
+def _hash(x):
+    """lowbias32 integer hash of int64 tensors holding 32-bit values."""
+    x = x ^ (x >> 16)
+    x = (x * 0x7feb352d) & 0xffffffff
+    x = x ^ (x >> 15)
+    x = (x * 0x846ca68b) & 0xffffffff
+    return x ^ (x >> 16)
+
+
+def uniform(seeds, n):
+    """(len(seeds), n) uniform numbers in [0, 1) that only depend on the seed of each row."""
+    counter = torch.arange(n, device=seeds.device)
+    x = _hash(_hash(seeds.long()[:, None] & 0xffffffff) ^ counter)
+    # 24 bits are exactly representable in float32
+    return (x >> 8).float() / 2 ** 24
+
+
+def random_pixels(seeds, size, ratio=0.5):
+    """Each pixel is observed with probability `ratio`."""
+    u = uniform(seeds, size * size).reshape(-1, 1, size, size)
+    return (u < ratio).float()
+
+
+def boxes(seeds, size, num_boxes=1, min_size=0.25, max_size=0.5):
+    """`num_boxes` missing rectangles with sides between `min_size` and `max_size` of the image."""
+    u = uniform(seeds, 4 * num_boxes).reshape(-1, num_boxes, 4)
+    height = (min_size + (max_size - min_size) * u[..., 0]) * size
+    width = (min_size + (max_size - min_size) * u[..., 1]) * size
+    top, left = u[..., 2] * (size - height), u[..., 3] * (size - width)
+    centers = torch.arange(size, device=seeds.device) + 0.5
+    rows = (centers >= top[..., None]) & (centers < (top + height)[..., None])
+    cols = (centers >= left[..., None]) & (centers < (left + width)[..., None])
+    missing = (rows[..., :, None] & cols[..., None, :]).any(1)
+    return (~missing).float()[:, None]
+
+
+def strokes(seeds, size, num_strokes=4, num_vertices=5, max_length=0.25, width=0.05):
+    """Free-form brush strokes of `num_strokes` polylines with `num_vertices` random segments each.
+
+    Segment lengths are at most `max_length` and the brush is `width` wide, both relative to the
+    image size. The distance of every pixel to every segment is computed at once, so memory grows
+    with len(seeds) * num_strokes * num_vertices * size ** 2.
+    """
+    u = uniform(seeds, num_strokes * (2 + 2 * num_vertices)).reshape(-1, num_strokes, 2 + 2 * num_vertices)
+    start = u[..., :2] * size
+    angles = u[..., 2:2 + num_vertices] * 2 * math.pi
+    lengths = u[..., 2 + num_vertices:] * max_length * size
+    steps = torch.stack([torch.cos(angles), torch.sin(angles)], dim=-1) * lengths[..., None]
+    points = torch.cat([start[:, :, None], start[:, :, None] + steps.cumsum(2)], dim=2).clamp(0, size)
+    a = points[:, :, :-1].reshape(len(seeds), -1, 1, 2)
+    b = points[:, :, 1:].reshape(len(seeds), -1, 1, 2)
+
+    centers = torch.arange(size, device=seeds.device) + 0.5
+    pixels = torch.stack(torch.meshgrid(centers, centers, indexing='ij'), dim=-1).reshape(1, 1, -1, 2)
+    # Distance of each pixel to the closest point of each segment
+    ab = b - a
+    t = (((pixels - a) * ab).sum(-1) / (ab * ab).sum(-1).clamp(min=1e-12)).clamp(0, 1)
+    distance = (pixels - (a + t[..., None] * ab)).norm(dim=-1).min(1).values
+    missing = distance < width * size / 2
+    return (~missing).float().reshape(-1, 1, size, size)
+
+
+def land(seeds, size, ocean, origins):
+    """Crops of the ocean mask of the NC data (observed on ocean, missing on land).
+
+    `ocean` is the (y, x) float ocean mask on the device and `origins` the (n, 2) crop origins to
+    choose from, e.g. `datasets.get_crop_index`.
+    """
+    choice = (uniform(seeds, 1)[:, 0] * len(origins)).long()
+    top, left = origins[choice, 0], origins[choice, 1]
+    offsets = torch.arange(size, device=seeds.device)
+    rows = (top[:, None] + offsets)[:, :, None]
+    cols = (left[:, None] + offsets)[:, None, :]
+    return ocean[rows, cols][:, None]
+
+
+def get_mask_fn(config):
+    """Mask function of kind `config.inverse.mask` at `config.data.image_size` on `config.device`.
+
+    Returns:
+      A function that maps a 1-D tensor of seeds to a batch of masks.
+    """
+    size = config.data.image_size
+    kind = config.inverse.mask
+    if kind == 'random':
+        return functools.partial(random_pixels, size=size, ratio=config.inverse.ratio)
+    elif kind == 'box':
+        return functools.partial(boxes, size=size)
+    elif kind == 'stroke':
+        return functools.partial(strokes, size=size)
+    elif kind == 'land':
+        import datasets
+
+        mask = datasets.get_land_mask(config)
+        origins = datasets.get_crop_index(mask, size, config.data.min_ocean_fraction, config.data.cache_dir)
+        # Crops reaching past the domain are padded with land, as in crop_origins
+        pad = [(0, max(size - n, 0)) for n in mask.shape]
+        ocean = torch.from_numpy(~mask).float()
+        ocean = torch.nn.functional.pad(ocean, (0, pad[1][1], 0, pad[0][1]))
+        return functools.partial(land, size=size, ocean=ocean.to(config.device),
+                                 origins=torch.from_numpy(origins).long().to(config.device))
+    else:
+        raise NotImplementedError(f'Mask {kind} unknown.')
+
+
+def generate_masks(config, seeds):
+    """Masks of kind `config.inverse.mask` for the given seeds, on `config.device`."""
+    seeds = torch.as_tensor(seeds, device=config.device)
+    return get_mask_fn(config)(seeds)
@@ -29,6 +29,18 @@ class LinearOperators(ABC):
         """return p(\Gamma), T"""
         pass
 
+    def adjoint(self, y, **kwargs):
+        # calculate A^T y
+        raise NotImplementedError
+
+    def pinv(self, y, **kwargs):
+        # calculate A^+ y
+        raise NotImplementedError
+
+    def observation_noise(self, y, std):
+        # Gaussian noise of `std` on the observed entries of y
+        return torch.randn_like(y) * std
+
     def ortho_project(self, data, **kwargs):
         # calculate (I - A^T * A)X
         pass
@@ -54,53 +66,319 @@ class MatrixMult(LinearOperators):
         return self.params['matrix']
 
 
-class GaussianFilter(LinearOperators):
+class SVDOperator(LinearOperators):
+    """A linear operator A = U diag(s) V^T given by an implicit SVD.
 
-    def get_kernel(self):
-        from scipy.stats import multivariate_normal
+    Subclasses implement `Vt`, `V`, `Ut` and `U` without building matrices. The spectral vectors they exchange are
+    (B, D) with D = C*H*W, one entry per singular value in `singular_values()`, which are zero in the null space of A;
+    `Ut` returns zeros there and `U` ignores those entries. Images are (B, C, H, W), or flattened to (B, C, H*W);
+    `V`, the adjoint and the pseudo-inverse return flattened images like the inpainting operator.
+    """
 
-        gaus = multivariate_normal([0, 0], self.params['std'] * np.eye(2, 2))
+    def __init__(self, image_shape, rcond=1e-3, device='cpu', **kwargs):
+        self.params = dict(kwargs, image_shape=image_shape, rcond=rcond)
+        self.image_shape = tuple(image_shape)
+        self.rcond = rcond
+        self.device = device
+        self._dense = None
 
-        w, h = self.params['shape']
-        xa = np.arange(0, w) - w // 2
-        ya = np.arange(0, h) - h // 2
-        axis = np.meshgrid(xa, ya)
-        axis = np.stack(axis, axis=-1).reshape(w, h, -2)
-        kernel = gaus.pdf(axis)
-        return kernel / kernel.sum()
+    @abstractmethod
+    def singular_values(self):
+        pass
+
+    @abstractmethod
+    def Vt(self, x):
+        pass
+
+    @abstractmethod
+    def V(self, z):
+        pass
+
+    @abstractmethod
+    def Ut(self, y):
+        pass
+
+    @abstractmethod
+    def U(self, z):
+        pass
+
+    def support(self):
+        """Singular values treated as nonzero: larger than `rcond` times the largest one."""
+        s = self.singular_values()
+        return s > self.rcond * s.max()
 
     def __call__(self, x, keep_shape=False):
-        from scipy import signal
+        return self.forward(x)
 
-        kernel = self.get_kernel()
-        return signal.convolve2d(x, kernel, boundary='symm', mode='same')
+    def forward(self, x):
+        return self.U(self.singular_values() * self.Vt(x))
+
+    def adjoint(self, y, **kwargs):
+        return self.V(self.singular_values() * self.Ut(y))
+
+    def pinv(self, y, **kwargs):
+        s = self.singular_values()
+        s_inv = torch.where(self.support(), 1. / s, torch.zeros_like(s))
+        return self.V(s_inv * self.Ut(y))
+
+    def ortho_project(self, data, **kwargs):
+        """(I - A^+ A) x in the shape of `data`."""
+        row_space = self.V(self.support() * self.Vt(data))
+        return data - row_space.reshape(data.shape)
+
+    def project(self, data, measurement, **kwargs):
+        """(I - A^+ A) x + A^+ y in the shape of `data`."""
+        return self.ortho_project(data) + self.pinv(measurement).reshape(data.shape)
 
     def to_matrix(self, shape):
-        from scipy.linalg import convolution_matrix
+        return self.decompose(shape)[0]
 
-        kernel = self.get_kernel()
-        W, H = shape
-        kW, kH = kernel.shape
-        mW, mH = W-kW+1, H-kH+1
-
-        #print(mW, mH)
-
-        mat = np.zeros((mW*mH, W*H))
-        #print(mat.shape)
-        for i in range(mW*mH):    # for each pixel
-            y_offset = i %  mH
-            x_offset = i // mH
-            offset = x_offset*H + y_offset
-            #print(f"{i}/{mW * mH}, {x_offset}, {y_offset}")
-            for r in range(kW):   # for each column in kernel
-                #assert len(kernel[r]) == kH
-                #print(r, r*H + offset, r*H + offset + kH)
-                mat[i, r*H + offset:r*H + offset + kH] = kernel[r]
-
-        return mat
+    def _decompose(self, shape):
+        basis = torch.eye(int(np.prod(self.image_shape)), device=self.device)
+        A = self.forward(basis.reshape(-1, *self.image_shape)).reshape(basis.shape[0], -1).T
+        return A, A, 1
 
     def decompose(self, shape):
-        pass
+        """Dense A (observation size, C*H*W) as A = pL with T = 1, for small images only."""
+        if self._dense is None:
+            self._dense = self._decompose(shape)
+        return self._dense
+
+
+def _dht2(x):
+    """Orthonormal 2D discrete Hartley transform over the last two dimensions; it is its own inverse."""
+    f = torch.fft.fft2(x, norm='ortho')
+    return f.real - f.imag
+
+
+class GaussianFilter(SVDOperator):
+    """Gaussian blur of every channel with periodic boundaries, computed with FFTs on whole batches.
+
+    The kernel of size `shape` (odd sides) is the Gaussian with covariance `std` * I. With periodic boundaries the blur
+    is a circular convolution with a symmetric kernel, so A = H diag(k) H for the orthonormal Hartley transform H and
+    the real spectrum k of the kernel. The SVD then is V = H, s = |k| and U = H diag(sign(k)), and the pseudo-inverse is
+    a division in the Fourier domain.
+    """
+
+    def __init__(self, image_shape, shape=(3, 3), std=1., rcond=1e-3, device='cpu'):
+        if shape[0] % 2 == 0 or shape[1] % 2 == 0:
+            raise ValueError(f'Kernel sides must be odd, got {shape}.')
+        super().__init__(image_shape, rcond=rcond, device=device, shape=shape, std=std)
+        self.spectrum = self._kernel_spectrum().to(device)
+        k = self.spectrum.abs()
+        self._sign = torch.sign(self.spectrum).flatten().repeat(self.image_shape[0])
+        self._k_inv = torch.where(k > rcond * k.max(), 1. / self.spectrum, torch.zeros_like(k))
+
+    def get_kernel(self):
+        h, w = self.params['shape']
+        ya = torch.arange(h) - h // 2
+        xa = torch.arange(w) - w // 2
+        r2 = ya[:, None] ** 2 + xa[None, :] ** 2
+        kernel = torch.exp(-r2 / (2. * self.params['std']))
+        return kernel / kernel.sum()
+
+    def _kernel_spectrum(self):
+        """Real (H, W) Fourier spectrum of the kernel placed with its center at pixel (0, 0)."""
+        kernel = self.get_kernel()
+        h, w = kernel.shape
+        H, W = self.image_shape[1:]
+        padded = torch.zeros(H, W)
+        padded[:h, :w] = kernel
+        padded = torch.roll(padded, (-(h // 2), -(w // 2)), dims=(0, 1))
+        return torch.fft.fft2(padded).real
+
+    def _image(self, x):
+        return x.reshape(x.shape[0], -1, *self.image_shape[1:])
+
+    def __call__(self, x, keep_shape=False):
+        y = self.forward(x)
+        return y.reshape(x.shape[0], -1, *self.image_shape[1:]) if keep_shape else y
+
+    def forward(self, x):
+        """A x as flattened images (B, C, H*W)."""
+        x = self._image(x)
+        H, W = x.shape[-2:]
+        y = torch.fft.irfft2(torch.fft.rfft2(x) * self.spectrum[:, :W // 2 + 1], s=(H, W))
+        return y.flatten(2)
+
+    def adjoint(self, y, **kwargs):
+        # The kernel is symmetric
+        return self.forward(y)
+
+    def singular_values(self):
+        return self.spectrum.abs().flatten().repeat(self.image_shape[0])
+
+    def Vt(self, x):
+        return _dht2(self._image(x)).reshape(x.shape[0], -1)
+
+    def V(self, z):
+        return _dht2(self._image(z)).flatten(2)
+
+    def Ut(self, y):
+        return self.Vt(y) * self._sign
+
+    def U(self, z):
+        return self.V(z * self._sign)
+
+    def pinv(self, y, **kwargs):
+        """A^+ y as a division by the thresholded spectrum of the kernel."""
+        y = self._image(y)
+        H, W = y.shape[-2:]
+        x = torch.fft.irfft2(torch.fft.rfft2(y) * self._k_inv[:, :W // 2 + 1], s=(H, W))
+        return x.flatten(2)
+
+
+def _averaging_basis(n, device='cpu'):
+    """Orthonormal (n, n) basis whose first column is the normalized all-ones vector."""
+    m = torch.eye(n)
+    m[:, 0] = 1.
+    q, r = torch.linalg.qr(m)
+    return (q * torch.sign(torch.diagonal(r))).to(device)
+
+
+class SuperResolution(SVDOperator):
+    """Average pooling of every channel over `factor` x `factor` blocks.
+
+    Every block is averaged by the row 1^T / factor^2, so per block V has the normalized all-ones vector as its first
+    column with singular value 1 / factor and an orthonormal complement in the null space, and U = I. The spectral
+    vectors hold the C*h*w block means (scaled) first and the in-block details after them. Observations are the
+    flattened low-resolution images (B, C, h*w).
+    """
+
+    def __init__(self, image_shape, factor=4, device='cpu'):
+        C, H, W = image_shape
+        if H % factor != 0 or W % factor != 0:
+            raise ValueError(f'Image size {H}x{W} is not divisible by {factor}.')
+        super().__init__(image_shape, rcond=0., device=device, factor=factor)
+        self.factor = factor
+        self.low_shape = (C, H // factor, W // factor)
+        self.basis = _averaging_basis(factor * factor, device)
+        self._s = torch.zeros(int(np.prod(image_shape)), device=device)
+        self._s[:int(np.prod(self.low_shape))] = 1. / factor
+
+    def __call__(self, x, keep_shape=False):
+        if keep_shape:
+            low = self.forward(x).reshape(x.shape[0], *self.low_shape)
+            return low.repeat_interleave(self.factor, 2).repeat_interleave(self.factor, 3)
+        return self.forward(x)
+
+    def forward(self, x):
+        x = x.reshape(x.shape[0], *self.image_shape)
+        return torch.nn.functional.avg_pool2d(x, self.factor).flatten(2)
+
+    def singular_values(self):
+        return self._s
+
+    def Vt(self, x):
+        B, (C, h, w), r = x.shape[0], self.low_shape, self.factor
+        blocks = x.reshape(B, C, h, r, w, r).permute(0, 1, 2, 4, 3, 5).reshape(B, C, h, w, r * r)
+        return (blocks @ self.basis).permute(0, 4, 1, 2, 3).reshape(B, -1)
+
+    def V(self, z):
+        B, (C, h, w), r = z.shape[0], self.low_shape, self.factor
+        blocks = z.reshape(B, r * r, C, h, w).permute(0, 2, 3, 4, 1) @ self.basis.T
+        return blocks.reshape(B, C, h, w, r, r).permute(0, 1, 2, 4, 3, 5).reshape(B, C, -1)
+
+    def Ut(self, y):
+        z = y.new_zeros(y.shape[0], self._s.shape[0])
+        z[:, :y[0].numel()] = y.reshape(y.shape[0], -1)
+        return z
+
+    def U(self, z):
+        return z[:, :int(np.prod(self.low_shape))].reshape(z.shape[0], self.low_shape[0], -1)
+
+
+class CompressedSensing(SVDOperator):
+    """Observes a random `ratio` of the orthonormal 2D Hartley coefficients of every channel.
+
+    The Hartley transform is the real counterpart of the unitary DFT, so the operator is a subsampled Fourier transform
+    with real observations. Its rows are orthonormal: the SVD has s = 1 on the observed frequencies, V = H with the
+    observed frequencies first and U = I. The frequencies are drawn with `seed`; observations are (B, C, m).
+    """
+
+    def __init__(self, image_shape, ratio=0.25, seed=0, device='cpu'):
+        C, H, W = image_shape
+        super().__init__(image_shape, rcond=0., device=device, ratio=ratio, seed=seed)
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        self.num_observed = max(int(round(ratio * H * W)), 1)
+        self.order = torch.randperm(H * W, generator=generator).to(device)
+        self.inverse_order = torch.argsort(self.order)
+        self._s = torch.zeros(C * H * W, device=device)
+        self._s[:C * self.num_observed] = 1.
+
+    def __call__(self, x, keep_shape=False):
+        y = self.forward(x)
+        return self.pinv(y).reshape(x.shape[0], *self.image_shape) if keep_shape else y
+
+    def forward(self, x):
+        coefficients = _dht2(x.reshape(x.shape[0], *self.image_shape)).flatten(2)
+        return coefficients[..., self.order[:self.num_observed]]
+
+    def singular_values(self):
+        return self._s
+
+    def Vt(self, x):
+        coefficients = _dht2(x.reshape(x.shape[0], *self.image_shape)).flatten(2)[..., self.order]
+        m = self.num_observed
+        return torch.cat([coefficients[..., :m].flatten(1), coefficients[..., m:].flatten(1)], dim=1)
+
+    def V(self, z):
+        C, H, W = self.image_shape
+        m = C * self.num_observed
+        observed = z[:, :m].reshape(-1, C, self.num_observed)
+        coefficients = torch.cat([observed, z[:, m:].reshape(-1, C, H * W - self.num_observed)], dim=2)
+        return _dht2(coefficients[..., self.inverse_order].reshape(-1, C, H, W)).flatten(2)
+
+    def Ut(self, y):
+        z = y.new_zeros(y.shape[0], self._s.shape[0])
+        z[:, :y[0].numel()] = y.reshape(y.shape[0], -1)
+        return z
+
+    def U(self, z):
+        return z[:, :self.image_shape[0] * self.num_observed].reshape(z.shape[0], self.image_shape[0], -1)
+
+
+class Colorization(SVDOperator):
+    """Averages the channels into a grayscale image.
+
+    Per pixel the row is 1^T / C, so V has the normalized all-ones vector over the channels as its first column with
+    singular value 1 / sqrt(C), and U = I. The spectral vectors hold the H*W gray values (scaled) first and the chroma
+    after them. Observations are (B, 1, H*W).
+    """
+
+    def __init__(self, image_shape, device='cpu'):
+        super().__init__(image_shape, rcond=0., device=device)
+        C, H, W = image_shape
+        self.basis = _averaging_basis(C, device)
+        self._s = torch.zeros(C * H * W, device=device)
+        self._s[:H * W] = C ** -.5
+
+    def __call__(self, x, keep_shape=False):
+        y = self.forward(x)
+        return y.reshape(x.shape[0], 1, *self.image_shape[1:]).expand(-1, self.image_shape[0], -1, -1) if keep_shape else y
+
+    def forward(self, x):
+        return x.reshape(x.shape[0], self.image_shape[0], -1).mean(1, keepdim=True)
+
+    def singular_values(self):
+        return self._s
+
+    def Vt(self, x):
+        x = x.reshape(x.shape[0], self.image_shape[0], -1)
+        return (self.basis.T @ x).reshape(x.shape[0], -1)
+
+    def V(self, z):
+        return self.basis @ z.reshape(z.shape[0], self.image_shape[0], -1)
+
+    def Ut(self, y):
+        z = y.new_zeros(y.shape[0], self._s.shape[0])
+        z[:, :y[0].numel()] = y.reshape(y.shape[0], -1)
+        return z
+
+    def U(self, z):
+        return z[:, :int(np.prod(self.image_shape[1:]))].reshape(z.shape[0], 1, -1)
+
 
 def bcmm(m, v):
     """batched channelled matrix multiplication"""
@@ -110,66 +388,107 @@ def bcmm(m, v):
     return torch.bmm(v_, m_).reshape(B, C, N)
 
 class InpaintOperator(LinearOperators):
+    """Keeps the pixels where `mask` is 1, without building matrices.
 
-    def __call__(self, x, keep_shape=True, invert=False):
-        assert self.params['mask'].shape == x.shape
+    `mask` is (H, W), or (N, 1, H, W) with one mask per sample. The observation A x of a (B, C, H, W) batch is the
+    (B, C, K) tensor of the observed pixels of every sample in row-major order, where K is the largest number of
+    observed pixels of a mask; observations of masks with fewer pixels are zero-padded. A, its adjoint, pseudo-inverse
+    and projections gather or scatter along per-mask index lists, so memory is O(pixels) rather than the O(pixels ** 2)
+    of the dense matrices that `to_matrix` and `decompose` still build on request.
+    """
 
+    def __init__(self, **kwargs):
+        self.params = kwargs
+        mask = kwargs['mask']
+        self.mask = (mask if mask.dim() == 4 else mask[None, None]) != 0
+        self._lists = {False: self._index_lists(self.mask)}
+        self._dense = None
+
+    @staticmethod
+    def _index_lists(mask):
+        flat = mask.flatten(1)
+        counts = flat.sum(1)
+        # A stable sort puts the observed pixels first, in row-major order
+        index = torch.sort((~flat).to(torch.uint8), dim=1, stable=True).indices[:, :int(counts.max())]
+        valid = torch.arange(index.shape[1], device=mask.device) < counts[:, None]
+        return index, valid
+
+    def _index(self, x, invert):
+        if invert not in self._lists:
+            self._lists[invert] = self._index_lists(~self.mask)
+        index, valid = self._lists[invert]
+        return index[:, None].expand(x.shape[0], x.shape[1], -1), valid[:, None]
+
+    def __call__(self, x, keep_shape=True, invert=False):
         if keep_shape:
-            if invert:
-                return (1-self.params['mask']) * x
-            else:
-                return self.params['mask'] * x
-        else:
-            if invert:
-                assert self.params['mask'].ndim == 4
-                N, _, A, B = self.params['mask'].shape
-                mat = torch.zeros((N, A * B, A * B)).to(self.params['mask'].device)
-                for i in range(N):
-                    mat[i] = self._get_single_mat(1-self.params['mask'][i])
-                L = [self._get_single_decomposed_mat(m)[0] for m in mat.squeeze()]
-                L = torch.stack(L)[:,None,:,:]
-
-                return bcmm(L, x)
-            else:
-                return bcmm(self.pL, x)
-
-    def _get_single_mat(self, mat):
-        return torch.diag(mat.flatten()).to(self.params['mask'].device)
-
-    def _get_single_decomposed_mat(self, mat):
-        return (mat[torch.where(mat.sum(axis=1) == 1)[0]].T,
-                1)
-
-    def _to_matrix(self, shape):
-        if self.params['mask'].ndim == 2:
-            return self._get_single_mat(self.params['mask'])
-        elif self.params['mask'].ndim == 4:
-            N, _, A, B = self.params['mask'].shape
-            mat = torch.zeros((N, A*B, A*B)).to(self.params['mask'].device)
-            for i in range(N):
-                mat[i] = self._get_single_mat(self.params['mask'][i])
-
-            return mat[:,None,:,:]
-        else:
-            raise ValueError('wrong shape')
-    def _decompose(self, shape):
-        mat = self._to_matrix(shape)
-        if self.params['mask'].ndim == 2:
-            return (mat,
-                    *self._get_single_decomposed_mat(mat))
-        elif self.params['mask'].ndim == 4:
-            L = [self._get_single_decomposed_mat(m)[0] for m in mat.squeeze()]
-            return (mat,
-                    torch.stack(L)[:,None,:,:],
-                    1)
+            mask = ~self.mask if invert else self.mask
+            return mask * x
         else:
-            raise ValueError('wrong shape')
+            return self.forward(x, invert)
+
+    def forward(self, x, invert=False):
+        """A x for images (B, C, H, W) or flattened images (B, C, H*W); returns (B, C, K)."""
+        flat = x.reshape(x.shape[0], x.shape[1], -1)
+        index, valid = self._index(flat, invert)
+        return flat.gather(2, index) * valid
+
+    def adjoint(self, y, invert=False):
+        """A^T y: the flattened (B, C, H*W) images that are `y` on the observed pixels and zero elsewhere."""
+        index, valid = self._index(y, invert)
+        out = y.new_zeros(y.shape[0], y.shape[1], self.mask[0].numel())
+        # Padded entries point at distinct unobserved pixels and scatter zeros
+        return out.scatter(2, index, y * valid)
+
+    def pinv(self, y, invert=False):
+        """A^+ y, which equals A^T y as the rows of A are orthonormal."""
+        return self.adjoint(y, invert)
+
+    def observation_noise(self, y, std):
+        """Gaussian noise of `std` that leaves the padding of the observations `y` at zero."""
+        return torch.randn_like(y) * std * self._lists[False][1][:, None]
+
+    def ortho_project(self, data, **kwargs):
+        """(I - A^+ A) x: `data` with the observed pixels set to zero, in the shape of `data`."""
+        mask = self.mask.flatten(2) if data.dim() == 3 else self.mask
+        return ~mask * data
+
+    def project(self, data, measurement, **kwargs):
+        """(I - A^+ A) x + A^+ y: `data` with the observed pixels replaced by `measurement`."""
+        return self.ortho_project(data) + self.pinv(measurement).reshape(data.shape)
+
+    def singular_values(self):
+        """(N, 1, H*W): 1 on the observed pixels. Spectral vectors are (B, C, H*W) images, as V = I."""
+        return self.mask.flatten(2).float()
+
+    def support(self):
+        return self.mask.flatten(2)
+
+    def Vt(self, x):
+        return x.reshape(x.shape[0], x.shape[1], -1)
+
+    def V(self, z):
+        return z
+
+    def Ut(self, y):
+        return self.adjoint(y)
+
+    def U(self, z):
+        return self.forward(z)
 
     def to_matrix(self, shape):
-        return self.A
+        return self.decompose(shape)[0]
+
+    def _decompose(self, shape):
+        mask = self.mask.flatten(1).float()
+        A = torch.diag_embed(mask)[:, None]
+        pL = torch.eye(mask.shape[1], device=mask.device)[self._lists[False][0]].transpose(1, 2)[:, None]
+        return A, pL * self._lists[False][1][:, None, None].float(), 1
 
     def decompose(self, shape):
-        return self.A, self.pL, self.T
+        """Dense A (N, 1, P, P) and pL (N, 1, P, K) with A = pL pL^T, for small images only."""
+        if self._dense is None:
+            self._dense = self._decompose(shape)
+        return self._dense
 
 
 
@@ -190,14 +509,14 @@ if __name__ == '__main__':
     axe[0].imshow(data)
 
     k = 3
-    operator = GaussianFilter(shape=(k, k), std=k)
-    filtered = operator(data)
+    operator = GaussianFilter(image_shape=(1, w, w), shape=(k, k), std=k)
+    filtered = operator(torch.from_numpy(data).float()[None, None], keep_shape=True)[0, 0]
 
     axe[1].imshow(filtered)
 
     mat = operator.to_matrix(data.shape)
     print(mat.shape, data.flatten().shape)
-    transformed = (mat @ data.flatten()).reshape(w-k+1,w-k+1)
+    transformed = (mat @ torch.from_numpy(data).float().flatten()).reshape(data.shape)
     axe[2].imshow(transformed)
     plt.show()
 
@@ -16,33 +16,216 @@
 """All functions related to loss computation and optimization.
 """
 
+import contextlib
+import math
+
 import torch
 import torch.optim as optim
+from torch.distributed.optim import ZeroRedundancyOptimizer
 import numpy as np
+import distributed
 from models import utils as mutils
 from sde_lib import VESDE, VPSDE
 
 
+_OPTIMIZERS = {}
+_SCHEDULES = {}
+
+
+def register_optimizer(name):
+    """A decorator for registering optimizers.
+
+    The decorated function maps `config` to an optimizer class and its keyword arguments except the parameters.
+    """
+
+    def _register(fn):
+        if name in _OPTIMIZERS:
+            raise ValueError(f'Already registered optimizer with name: {name}')
+        _OPTIMIZERS[name] = fn
+        return fn
+
+    return _register
+
+
+def register_schedule(name):
+    """A decorator for registering learning-rate schedules.
+
+    The decorated function maps `config` to a function from the step to the learning rate.
+    """
+
+    def _register(fn):
+        if name in _SCHEDULES:
+            raise ValueError(f'Already registered schedule with name: {name}')
+        _SCHEDULES[name] = fn
+        return fn
+
+    return _register
+
+
+def _implementation_kwargs(config, fused=True):
+    """Keyword arguments that select the PyTorch implementation of an optimizer.
+
+    'default' leaves the choice to PyTorch, 'foreach' updates all parameters with multi-tensor kernels, 'fused' in a
+    single fused kernel per group and 'loop' one parameter at a time.
+    """
+    implementation = config.optim.implementation
+    if implementation == 'default':
+        return {}
+    elif implementation == 'foreach':
+        return dict(foreach=True)
+    elif implementation == 'fused' and fused:
+        return dict(fused=True)
+    elif implementation == 'loop':
+        return dict(foreach=False)
+    raise ValueError(f'Optimizer implementation {implementation} not supported for {config.optim.optimizer}.')
+
+
+@register_optimizer('Adam')
+def _adam(config):
+    return optim.Adam, dict(lr=config.optim.lr, betas=(config.optim.beta1, config.optim.beta2), eps=config.optim.eps,
+                            weight_decay=config.optim.weight_decay, **_implementation_kwargs(config))
+
+
+@register_optimizer('AdamW')
+def _adamw(config):
+    return optim.AdamW, dict(lr=config.optim.lr, betas=(config.optim.beta1, config.optim.beta2), eps=config.optim.eps,
+                             weight_decay=config.optim.weight_decay, **_implementation_kwargs(config))
+
+
+class Lion(optim.Optimizer):
+    """Lion (Chen et al., 2023, "Symbolic Discovery of Optimization Algorithms").
+
+    Updates each parameter by the sign of an interpolation between its momentum and gradient, with decoupled weight
+    decay. It keeps a single state tensor per parameter, half of Adam's. Lion needs a smaller learning rate and a
+    larger weight decay than Adam; betas of (0.9, 0.99) are recommended.
+    """
+
+    def __init__(self, params, lr=1e-4, betas=(0.9, 0.99), weight_decay=0., foreach=True):
+        defaults = dict(lr=lr, betas=betas, weight_decay=weight_decay, foreach=foreach)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            grads = [p.grad for p in params]
+            exp_avgs = []
+            for p in params:
+                state = self.state[p]
+                if len(state) == 0:
+                    state['exp_avg'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                exp_avgs.append(state['exp_avg'])
+
+            lr, weight_decay = group['lr'], group['weight_decay']
+            beta1, beta2 = group['betas']
+            if group['foreach']:
+                if weight_decay != 0:
+                    torch._foreach_mul_(params, 1 - lr * weight_decay)
+                updates = torch._foreach_mul(exp_avgs, beta1)
+                torch._foreach_add_(updates, grads, alpha=1 - beta1)
+                torch._foreach_sign_(updates)
+                torch._foreach_add_(params, updates, alpha=-lr)
+                torch._foreach_mul_(exp_avgs, beta2)
+                torch._foreach_add_(exp_avgs, grads, alpha=1 - beta2)
+            else:
+                for p, grad, exp_avg in zip(params, grads, exp_avgs):
+                    if weight_decay != 0:
+                        p.mul_(1 - lr * weight_decay)
+                    update = exp_avg.mul(beta1).add_(grad, alpha=1 - beta1).sign_()
+                    p.add_(update, alpha=-lr)
+                    exp_avg.mul_(beta2).add_(grad, alpha=1 - beta2)
+
+        return loss
+
+
+@register_optimizer('Lion')
+def _lion(config):
+    if config.optim.implementation == 'fused':
+        raise ValueError('Optimizer implementation fused not supported for Lion.')
+    return Lion, dict(lr=config.optim.lr, betas=(config.optim.beta1, config.optim.beta2),
+                      weight_decay=config.optim.weight_decay, foreach=config.optim.implementation != 'loop')
+
+
 def get_optimizer(config, params):
-    """Returns a flax optimizer object based on `config`."""
-    if config.optim.optimizer == 'Adam':
-        optimizer = optim.Adam(params, lr=config.optim.lr, betas=(config.optim.beta1, 0.999), eps=config.optim.eps,
-                               weight_decay=config.optim.weight_decay)
-    else:
+    """Returns a flax optimizer object based on `config`.
+
+    In multi-process training with `config.optim.zero_redundancy`, the optimizer state is sharded across the ranks
+    (ZeRO stage 1): each rank keeps and updates the state of its shard of the parameters only and broadcasts the
+    updated parameters to the other ranks.
+    """
+    if config.optim.optimizer not in _OPTIMIZERS:
         raise NotImplementedError(f'Optimizer {config.optim.optimizer} not supported yet!')
+    optimizer_class, kwargs = _OPTIMIZERS[config.optim.optimizer](config)
+
+    if distributed.is_initialized() and config.optim.zero_redundancy:
+        return ZeroRedundancyOptimizer(params, optimizer_class=optimizer_class, **kwargs)
+    return optimizer_class(params, **kwargs)
+
+
+@register_schedule('warmup')
+def _warmup_schedule(config):
+    """Linear warmup over `optim.warmup` steps, constant afterwards."""
+    lr, warmup = config.optim.lr, config.optim.warmup
+
+    def schedule(step):
+        return lr * min(step / warmup, 1.) if warmup > 0 else lr
+
+    return schedule
+
+
+@register_schedule('warmup_cosine')
+def _warmup_cosine_schedule(config):
+    """Linear warmup, then cosine decay to `optim.lr * optim.min_lr_ratio` at `training.n_iters`."""
+    lr, warmup, min_lr = config.optim.lr, config.optim.warmup, config.optim.lr * config.optim.min_lr_ratio
+    decay_steps = max(config.training.n_iters - warmup, 1)
+
+    def schedule(step):
+        if step < warmup:
+            return lr * step / warmup
+        progress = min((step - warmup) / decay_steps, 1.)
+        return min_lr + 0.5 * (lr - min_lr) * (1. + math.cos(math.pi * progress))
 
-    return optimizer
+    return schedule
+
+
+@register_schedule('inverse_sqrt')
+def _inverse_sqrt_schedule(config):
+    """Linear warmup, then decay proportional to the inverse square root of the step."""
+    lr, warmup = config.optim.lr, config.optim.warmup
+    if warmup <= 0:
+        raise ValueError('The inverse_sqrt schedule needs optim.warmup > 0.')
+
+    def schedule(step):
+        return lr * min(step / warmup, math.sqrt(warmup / max(step, 1)))
+
+    return schedule
+
+
+def get_schedule(config):
+    """Returns the learning rate as a function of the step, selected by `config.optim.schedule`."""
+    if config.optim.schedule not in _SCHEDULES:
+        raise NotImplementedError(f'Schedule {config.optim.schedule} not supported yet!')
+    return _SCHEDULES[config.optim.schedule](config)
 
 
 def optimization_manager(config):
     """Returns an optimize_fn based on `config`."""
+    schedule = get_schedule(config)
 
-    def optimize_fn(optimizer, params, step, lr=config.optim.lr, warmup=config.optim.warmup,
-                    grad_clip=config.optim.grad_clip):
-        """Optimizes with warmup and gradient clipping (disabled if negative)."""
-        if warmup > 0:
+    def optimize_fn(optimizer, params, step, grad_clip=config.optim.grad_clip):
+        """Optimizes with the learning-rate schedule and gradient clipping (disabled if negative)."""
+        lr = schedule(int(step))
+        # The param groups are only rewritten when the learning rate changes, e.g. not after a warmup
+        if optimizer.param_groups[0]['lr'] != lr:
             for g in optimizer.param_groups:
-                g['lr'] = lr * np.minimum(step / warmup, 1.0)
+                g['lr'] = lr
         if grad_clip >= 0:
             torch.nn.utils.clip_grad_norm_(params, max_norm=grad_clip)
         optimizer.step()
@@ -50,7 +233,121 @@ def optimization_manager(config):
     return optimize_fn
 
 
-def get_sde_loss_fn(sde, train, reduce_mean=True, continuous=True, likelihood_weighting=True, eps=1e-5):
+class ImportanceTimestepSampler:
+    """Adaptive importance sampler for the time steps of the continuous SDE loss.
+
+    [eps, T] is split into `num_bins` equal bins. The sampler keeps an exponential moving average of the
+    per-sample loss (`mode='loss'`) or squared loss (`mode='loss2'`) in each bin and draws t with probability
+    proportional to that average (its square root for 'loss2', which minimizes the variance of the estimate).
+    The returned weights undo the change of density so that the weighted loss stays an unbiased estimate of the
+    loss under uniform t. Until every bin has seen `warmup` samples, t is drawn uniformly; afterwards a fraction
+    `uniform_mix` of uniform probability is kept so that no bin is starved.
+    """
+
+    def __init__(self, T, eps=1e-5, num_bins=100, mode='loss2', decay=0.99, uniform_mix=0.1, warmup=10):
+        assert mode in ['loss', 'loss2'], f"Importance sampling mode {mode} unknown."
+        self.T = T
+        self.eps = eps
+        self.num_bins = num_bins
+        self.mode = mode
+        self.decay = decay
+        self.uniform_mix = uniform_mix
+        self.warmup = warmup
+        self.history = None
+        self.counts = None
+        self.ready = False
+
+    def _init(self, device):
+        if self.history is None:
+            self.history = torch.zeros(self.num_bins, device=device)
+            self.counts = torch.zeros(self.num_bins, dtype=torch.long, device=device)
+
+    def probs(self, device='cpu'):
+        """Probability of drawing t from each bin."""
+        self._init(device)
+        if not self.ready:
+            return torch.full((self.num_bins,), 1. / self.num_bins, device=self.history.device)
+        weights = self.history.sqrt() if self.mode == 'loss2' else self.history
+        return (1. - self.uniform_mix) * weights / weights.sum() + self.uniform_mix / self.num_bins
+
+    def sample(self, batch_size, device):
+        """Draw `batch_size` time steps and their importance weights."""
+        p = self.probs(device)
+        bins = torch.multinomial(p, batch_size, replacement=True)
+        width = (self.T - self.eps) / self.num_bins
+        t = self.eps + (bins + torch.rand(batch_size, device=p.device)) * width
+        weights = 1. / (self.num_bins * p[bins])
+        return t.to(device), weights.to(device)
+
+    def update(self, t, losses):
+        """Add the per-sample `losses` at time steps `t` to the running loss histogram."""
+        self._init(t.device)
+        t = t.detach().to(self.history.device)
+        values = losses.detach().to(self.history.device).float()
+        if self.mode == 'loss2':
+            values = values ** 2
+        bins = ((t - self.eps) / (self.T - self.eps) * self.num_bins).long().clamp(0, self.num_bins - 1)
+        counts = torch.bincount(bins, minlength=self.num_bins)
+        means = torch.bincount(bins, weights=values, minlength=self.num_bins) / counts.clamp(min=1)
+        decay = torch.where(self.counts == 0, torch.zeros_like(self.history), torch.full_like(self.history, self.decay))
+        self.history = torch.where(counts > 0, decay * self.history + (1. - decay) * means, self.history)
+        self.counts += counts
+        if not self.ready:
+            # Only synchronizes with the device until the warmup is over
+            self.ready = bool((self.counts >= self.warmup).all())
+
+    def state_dict(self):
+        # Each process keeps its own histogram; checkpoints hold the one of the process that writes them
+        return dict(history=self.history, counts=self.counts, ready=self.ready)
+
+    def load_state_dict(self, state_dict):
+        self.history = state_dict['history']
+        self.counts = state_dict['counts']
+        self.ready = bool(state_dict['ready'])
+
+
+def get_timestep_sampler(config, sde, eps=1e-5):
+    """Returns the `ImportanceTimestepSampler` configured by `config.training`, or None for uniform t."""
+    mode = config.training.importance_sampling.lower()
+    if mode == 'none':
+        return None
+    return ImportanceTimestepSampler(sde.T, eps=eps, num_bins=config.training.importance_bins, mode=mode)
+
+
+def _sample_unit_interval(n, device, method='uniform'):
+    """Draw `n` numbers in [0, 1) used as time steps or noise levels.
+
+    'stratified' draws one number uniformly from each of `n` equal strata and 'lowdiscrepancy' shifts the regular grid
+    `i / n` by a single uniform offset (modulo 1). Both cover [0, 1) more evenly than i.i.d. 'uniform' draws, which lowers
+    the variance of the loss estimate.
+    """
+    if method == 'uniform':
+        return torch.rand(n, device=device)
+    grid = torch.arange(n, device=device) / n
+    if method == 'stratified':
+        return grid + torch.rand(n, device=device) / n
+    elif method == 'lowdiscrepancy':
+        return torch.remainder(grid + torch.rand(1, device=device), 1.)
+    else:
+        raise ValueError(f"Time step sampling method {method} unknown.")
+
+
+def _sample_labels(n, N, device, method='uniform'):
+    """Draw `n` discrete noise levels in [0, N)."""
+    if method == 'uniform':
+        return torch.randint(0, N, (n,), device=device)
+    return (_sample_unit_interval(n, device, method) * N).long().clamp(max=N - 1)
+
+
+def _repeat_batch(batch, num_noise_draws):
+    """Stack `num_noise_draws` copies of `batch` so that each example is perturbed with several noise draws."""
+    if num_noise_draws == 1:
+        return batch
+    return batch.repeat(num_noise_draws, *([1] * (batch.ndim - 1)))
+
+
+def get_sde_loss_fn(sde, train, reduce_mean=True, continuous=True, likelihood_weighting=True, eps=1e-5,
+                    t_sampler=None, num_noise_draws=1, t_sampling='uniform'):
     """Create a loss function for training with arbirary SDEs.
 
     Args:
@@ -62,6 +359,10 @@ def get_sde_loss_fn(sde, train, reduce_mean=True, continuous=True, likelihood_we
       likelihood_weighting: If `True`, weight the mixture of score matching losses
         according to https://arxiv.org/abs/2101.09258; otherwise use the weighting recommended in our paper.
       eps: A `float` number. The smallest time step to sample from.
+      t_sampler: An optional `ImportanceTimestepSampler`. If given, training time steps are drawn from it and the
+        loss is reweighted accordingly; evaluation always uses uniform time steps.
+      num_noise_draws: Number of independent time step/noise draws per example, evaluated in one forward pass.
+      t_sampling: 'uniform', 'stratified' or 'lowdiscrepancy'; how time steps are drawn without `t_sampler`.
 
     Returns:
       A loss function.
@@ -79,7 +380,12 @@ def get_sde_loss_fn(sde, train, reduce_mean=True, continuous=True, likelihood_we
           loss: A scalar that represents the average loss value across the mini-batch.
         """
         score_fn = mutils.get_score_fn(sde, model, train=train, continuous=continuous)
-        t = torch.rand(batch.shape[0], device=batch.device) * (sde.T - eps) + eps
+        batch = _repeat_batch(batch, num_noise_draws)
+        if train and t_sampler is not None:
+            t, weights = t_sampler.sample(batch.shape[0], batch.device)
+        else:
+            t = _sample_unit_interval(batch.shape[0], batch.device, t_sampling) * (sde.T - eps) + eps
+            weights = None
         z = torch.randn_like(batch)
         mean, std = sde.marginal_prob(batch, t)
         perturbed_data = mean + std[:, None, None, None] * z
@@ -93,13 +399,17 @@ def get_sde_loss_fn(sde, train, reduce_mean=True, continuous=True, likelihood_we
             losses = torch.square(score + z / std[:, None, None, None])
             losses = reduce_op(losses.reshape(losses.shape[0], -1), dim=-1) * g2
 
+        if weights is not None:
+            t_sampler.update(t, losses)
+            losses = losses * weights
+
         loss = torch.mean(losses)
         return loss
 
     return loss_fn
 
 
-def get_smld_loss_fn(vesde, train, reduce_mean=False):
+def get_smld_loss_fn(vesde, train, reduce_mean=False, num_noise_draws=1, t_sampling='uniform'):
     """Legacy code to reproduce previous results on SMLD(NCSN). Not recommended for new work."""
     assert isinstance(vesde, VESDE), "SMLD training only works for VESDEs."
 
@@ -109,7 +419,8 @@ def get_smld_loss_fn(vesde, train, reduce_mean=False):
 
     def loss_fn(model, batch):
         model_fn = mutils.get_model_fn(model, train=train)
-        labels = torch.randint(0, vesde.N, (batch.shape[0],), device=batch.device)
+        batch = _repeat_batch(batch, num_noise_draws)
+        labels = _sample_labels(batch.shape[0], vesde.N, batch.device, t_sampling)
         sigmas = smld_sigma_array.to(batch.device)[labels]
         noise = torch.randn_like(batch) * sigmas[:, None, None, None]
         perturbed_data = noise + batch
@@ -123,7 +434,7 @@ def get_smld_loss_fn(vesde, train, reduce_mean=False):
     return loss_fn
 
 
-def get_ddpm_loss_fn(vpsde, train, reduce_mean=True):
+def get_ddpm_loss_fn(vpsde, train, reduce_mean=True, num_noise_draws=1, t_sampling='uniform'):
     """Legacy code to reproduce previous results on DDPM. Not recommended for new work."""
     assert isinstance(vpsde, VPSDE), "DDPM training only works for VPSDEs."
 
@@ -131,7 +442,8 @@ def get_ddpm_loss_fn(vpsde, train, reduce_mean=True):
 
     def loss_fn(model, batch):
         model_fn = mutils.get_model_fn(model, train=train)
-        labels = torch.randint(0, vpsde.N, (batch.shape[0],), device=batch.device)
+        batch = _repeat_batch(batch, num_noise_draws)
+        labels = _sample_labels(batch.shape[0], vpsde.N, batch.device, t_sampling)
         sqrt_alphas_cumprod = vpsde.sqrt_alphas_cumprod.to(batch.device)
         sqrt_1m_alphas_cumprod = vpsde.sqrt_1m_alphas_cumprod.to(batch.device)
         noise = torch.randn_like(batch)
@@ -146,7 +458,15 @@ def get_ddpm_loss_fn(vpsde, train, reduce_mean=True):
     return loss_fn
 
 
-def get_step_fn(sde, train, optimize_fn=None, reduce_mean=False, continuous=True, likelihood_weighting=False):
+def _get_phase_fn(timer):
+    """Phase context of a `profiling.StepTimer`, or a no-op when no timer is given."""
+    if timer is None:
+        return lambda name: contextlib.nullcontext()
+    return timer.phase
+
+
+def get_step_fn(sde, train, optimize_fn=None, reduce_mean=False, continuous=True, likelihood_weighting=False,
+                timer=None, t_sampler=None, num_noise_draws=1, t_sampling='uniform'):
     """Create a one-step training/evaluation function.
 
     Args:
@@ -156,22 +476,32 @@ def get_step_fn(sde, train, optimize_fn=None, reduce_mean=False, continuous=True
       continuous: `True` indicates that the model is defined to take continuous time steps.
       likelihood_weighting: If `True`, weight the mixture of score matching losses according to
         https://arxiv.org/abs/2101.09258; otherwise use the weighting recommended by our paper.
+      timer: An optional `profiling.StepTimer` that records the forward, backward, optimizer and EMA phases.
+      t_sampler: An optional `ImportanceTimestepSampler` for the time steps of continuous training.
+      num_noise_draws: Number of independent noise draws per example; the batch is stacked this many times.
+      t_sampling: 'uniform', 'stratified' or 'lowdiscrepancy' sampling of time steps/noise levels.
 
     Returns:
       A one-step function for training or evaluation.
     """
     if continuous:
         loss_fn = get_sde_loss_fn(sde, train, reduce_mean=reduce_mean, continuous=True,
-                                  likelihood_weighting=likelihood_weighting)
+                                  likelihood_weighting=likelihood_weighting, t_sampler=t_sampler,
+                                  num_noise_draws=num_noise_draws, t_sampling=t_sampling)
     else:
         assert not likelihood_weighting, "Likelihood weighting is not supported for original SMLD/DDPM training."
+        assert t_sampler is None, "Importance sampling of time steps is only supported for continuous training."
         if isinstance(sde, VESDE):
-            loss_fn = get_smld_loss_fn(sde, train, reduce_mean=reduce_mean)
+            loss_fn = get_smld_loss_fn(sde, train, reduce_mean=reduce_mean,
+                                       num_noise_draws=num_noise_draws, t_sampling=t_sampling)
         elif isinstance(sde, VPSDE):
-            loss_fn = get_ddpm_loss_fn(sde, train, reduce_mean=reduce_mean)
+            loss_fn = get_ddpm_loss_fn(sde, train, reduce_mean=reduce_mean,
+                                       num_noise_draws=num_noise_draws, t_sampling=t_sampling)
         else:
             raise ValueError(f"Discrete training for {sde.__class__.__name__} is not recommended.")
 
+    phase = _get_phase_fn(timer)
+
     def step_fn(state, batch):
         """Running one step of training or evaluation.
 
@@ -190,11 +520,15 @@ def get_step_fn(sde, train, optimize_fn=None, reduce_mean=False, continuous=True
         if train:
             optimizer = state['optimizer']
             optimizer.zero_grad()
-            loss = loss_fn(model, batch)
-            loss.backward()
-            optimize_fn(optimizer, model.parameters(), step=state['step'])
+            with phase('forward'):
+                loss = loss_fn(model, batch)
+            with phase('backward'):
+                loss.backward()
+            with phase('optimizer'):
+                optimize_fn(optimizer, model.parameters(), step=state['step'])
             state['step'] += 1
-            state['ema'].update(model.parameters())
+            with phase('ema'):
+                state['ema'].update(model.parameters())
         else:
             with torch.no_grad():
                 ema = state['ema']
@@ -208,7 +542,9 @@ def get_step_fn(sde, train, optimize_fn=None, reduce_mean=False, continuous=True
     return step_fn
 
 
-def get_pinn_step_fn(config, train, optimize_fn):
+def get_pinn_step_fn(config, train, optimize_fn, timer=None):
+    phase = _get_phase_fn(timer)
+
     def loss_fn(model, batch):
 
         f1, f2, coord, t, target = batch
@@ -229,11 +565,15 @@ def get_pinn_step_fn(config, train, optimize_fn):
 
             optimizer = state['optimizer']
             optimizer.zero_grad()
-            loss, loss_e, loss_d = loss_fn(model, batch)
-            loss.backward()
-            optimize_fn(optimizer, model.parameters(), step=state['step'])
+            with phase('forward'):
+                loss, loss_e, loss_d = loss_fn(model, batch)
+            with phase('backward'):
+                loss.backward()
+            with phase('optimizer'):
+                optimize_fn(optimizer, model.parameters(), step=state['step'])
             state['step'] += 1
-            state['ema'].update(model.parameters())
+            with phase('ema'):
+                state['ema'].update(model.parameters())
         else:
             model.eval()
 
@@ -104,6 +104,7 @@ class DDPM(nn.Module):
     modules.append(nn.GroupNorm(num_channels=in_ch, num_groups=32, eps=1e-6))
     modules.append(conv3x3(in_ch, channels, init_scale=0.))
     self.all_modules = nn.ModuleList(modules)
+    self.checkpoint = utils.ActivationCheckpointing(config)
 
     self.scale_by_sigma = config.model.scale_by_sigma
 
@@ -134,10 +135,10 @@ class DDPM(nn.Module):
     for i_level in range(self.num_resolutions):
       # Residual blocks for this resolution
       for i_block in range(self.num_res_blocks):
-        h = modules[m_idx](hs[-1], temb)
+        h = self.checkpoint('resblock', modules[m_idx], hs[-1], temb)
         m_idx += 1
         if h.shape[-1] in self.attn_resolutions:
-          h = modules[m_idx](h)
+          h = self.checkpoint('attn', modules[m_idx], h)
           m_idx += 1
         hs.append(h)
       if i_level != self.num_resolutions - 1:
@@ -145,20 +146,20 @@ class DDPM(nn.Module):
         m_idx += 1
 
     h = hs[-1]
-    h = modules[m_idx](h, temb)
+    h = self.checkpoint('resblock', modules[m_idx], h, temb)
     m_idx += 1
-    h = modules[m_idx](h)
+    h = self.checkpoint('attn', modules[m_idx], h)
     m_idx += 1
-    h = modules[m_idx](h, temb)
+    h = self.checkpoint('resblock', modules[m_idx], h, temb)
     m_idx += 1
 
     # Upsampling block
     for i_level in reversed(range(self.num_resolutions)):
       for i_block in range(self.num_res_blocks + 1):
-        h = modules[m_idx](torch.cat([h, hs.pop()], dim=1), temb)
+        h = self.checkpoint('resblock', modules[m_idx], torch.cat([h, hs.pop()], dim=1), temb)
         m_idx += 1
       if h.shape[-1] in self.attn_resolutions:
-        h = modules[m_idx](h)
+        h = self.checkpoint('attn', modules[m_idx], h)
         m_idx += 1
       if i_level != 0:
         h = modules[m_idx](h)
@@ -76,7 +76,8 @@ class FeatureExtractor(nn.Module):
 class Matching(nn.Module):
     def __init__(self, config, level):
         super(Matching, self).__init__()
-        self.dt = config.data.dt * 0.5**level
+        # Paired frames are pair_stride time steps apart
+        self.dt = config.data.dt * config.data.pair_stride * 0.5**level
 
         # up-sampling flow field from previous level except the highest level
         if level < len(config.model.feature_nums):
@@ -112,7 +113,7 @@ class SubpixelRefinement(nn.Module):
     def __init__(self, config, level):
         super(SubpixelRefinement, self).__init__()
 
-        self.dt = config.data.dt * 0.5 ** level
+        self.dt = config.data.dt * config.data.pair_stride * 0.5 ** level
 
         block_depth = config.model.feature_nums[level]*2 + 2  # feature1 + feature2 + flow(2)
         self.flow_conv = get_conv_flow_layer(block_depth)
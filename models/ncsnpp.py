@@ -228,6 +228,7 @@ class NCSNpp(nn.Module):
       modules.append(conv3x3(in_ch, channels, init_scale=init_scale))
 
     self.all_modules = nn.ModuleList(modules)
+    self.checkpoint = utils.ActivationCheckpointing(config)
 
   def forward(self, x, time_cond):
     # timestep/noise_level embedding; only for continuous training
@@ -270,10 +271,10 @@ class NCSNpp(nn.Module):
     for i_level in range(self.num_resolutions):
       # Residual blocks for this resolution
       for i_block in range(self.num_res_blocks):
-        h = modules[m_idx](hs[-1], temb)
+        h = self.checkpoint('resblock', modules[m_idx], hs[-1], temb)
         m_idx += 1
         if h.shape[-1] in self.attn_resolutions:
-          h = modules[m_idx](h)
+          h = self.checkpoint('attn', modules[m_idx], h)
           m_idx += 1
 
         hs.append(h)
@@ -283,7 +284,7 @@ class NCSNpp(nn.Module):
           h = modules[m_idx](hs[-1])
           m_idx += 1
         else:
-          h = modules[m_idx](hs[-1], temb)
+          h = self.checkpoint('resblock', modules[m_idx], hs[-1], temb)
           m_idx += 1
 
         if self.progressive_input == 'input_skip':
@@ -303,11 +304,11 @@ class NCSNpp(nn.Module):
         hs.append(h)
 
     h = hs[-1]
-    h = modules[m_idx](h, temb)
+    h = self.checkpoint('resblock', modules[m_idx], h, temb)
     m_idx += 1
-    h = modules[m_idx](h)
+    h = self.checkpoint('attn', modules[m_idx], h)
     m_idx += 1
-    h = modules[m_idx](h, temb)
+    h = self.checkpoint('resblock', modules[m_idx], h, temb)
     m_idx += 1
 
     pyramid = None
@@ -315,11 +316,11 @@ class NCSNpp(nn.Module):
     # Upsampling block
     for i_level in reversed(range(self.num_resolutions)):
       for i_block in range(self.num_res_blocks + 1):
-        h = modules[m_idx](torch.cat([h, hs.pop()], dim=1), temb)
+        h = self.checkpoint('resblock', modules[m_idx], torch.cat([h, hs.pop()], dim=1), temb)
         m_idx += 1
 
       if h.shape[-1] in self.attn_resolutions:
-        h = modules[m_idx](h)
+        h = self.checkpoint('attn', modules[m_idx], h)
         m_idx += 1
 
       if self.progressive != 'none':
@@ -360,7 +361,7 @@ class NCSNpp(nn.Module):
           h = modules[m_idx](h)
           m_idx += 1
         else:
-          h = modules[m_idx](h, temb)
+          h = self.checkpoint('resblock', modules[m_idx], h, temb)
           m_idx += 1
 
     assert not hs
@@ -17,6 +17,8 @@
 """
 
 import torch
+import torch.utils.checkpoint
+import distributed
 import sde_lib
 import numpy as np
 
@@ -85,12 +87,46 @@ def get_ddpm_params(config):
   }
 
 
+class ActivationCheckpointing:
+  """Decides which blocks of a U-Net recompute their activations in the backward pass.
+
+  Checkpointed blocks store only their inputs during the forward pass and are run again when
+  gradients are computed, trading extra compute for activation memory. Blocks are selected by kind
+  (`config.model.checkpoint_modules`, a subset of ('resblock', 'attn')) and by the spatial
+  resolution of their input (`config.model.checkpoint_resolutions`; empty means every resolution).
+  """
+
+  KINDS = ('resblock', 'attn')
+
+  def __init__(self, config):
+    self.kinds = tuple(config.model.checkpoint_modules)
+    self.resolutions = tuple(config.model.checkpoint_resolutions)
+    for kind in self.kinds:
+      if kind not in self.KINDS:
+        raise ValueError(f'Checkpointing for module kind {kind} not supported.')
+
+  def enabled(self, kind, h):
+    return kind in self.kinds and (not self.resolutions or h.shape[-1] in self.resolutions)
+
+  def __call__(self, kind, module, h, *args):
+    """Compute `module(h, *args)`, checkpointed if the policy selects it and gradients are recorded."""
+    if torch.is_grad_enabled() and self.enabled(kind, h):
+      return torch.utils.checkpoint.checkpoint(module, h, *args, use_reentrant=False)
+    return module(h, *args)
+
+
 def create_model(config):
   """Create the score model."""
   model_name = config.model.name
   score_model = get_model(model_name)(config)
   score_model = score_model.to(config.device)
-  score_model = torch.nn.DataParallel(score_model)
+  if distributed.is_initialized():
+    # One device per process; buffers such as the noise levels are constant and need no broadcast
+    device_ids = [config.device] if torch.device(config.device).type == 'cuda' else None
+    score_model = torch.nn.parallel.DistributedDataParallel(score_model, device_ids=device_ids,
+                                                            broadcast_buffers=False)
+  else:
+    score_model = torch.nn.DataParallel(score_model)
   return score_model
 
 
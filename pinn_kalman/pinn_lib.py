@@ -8,18 +8,20 @@ import sampling
 from models import utils as mutils
 from models.ema import ExponentialMovingAverage
 import datasets
+import profiling
 from torch.utils import tensorboard
 from torchvision.utils import make_grid, save_image
-from utils import save_checkpoint, load_checkpoint, restore_checkpoint
+from utils import save_checkpoint, load_checkpoint, restore_checkpoint, AsyncCheckpointWriter, CheckpointManager, \
+    RNGState, set_seed
 
 
-def unbatch(config, batch):
+def unbatch(batch):
     f1, f2, coord, t, target = batch
-    return (f1.to(config.device).float(),
-            f2.to(config.device).float(),
-            coord.to(config.device).float(),
-            t.to(config.device).float(),
-            target.to(config.device).float())
+    return (f1.float(),
+            f2.float(),
+            coord.float(),
+            t.float(),
+            target.float())
 
 def train(config, workdir):
     # Create directories for experimental logs
@@ -29,11 +31,18 @@ def train(config, workdir):
     tb_dir = os.path.join(workdir, "tensorboard")
     os.makedirs(tb_dir, exist_ok=True)
     writer = tensorboard.SummaryWriter(tb_dir)
+    set_seed(config.seed)
+
+    # Build data loaders
+    train_ds, eval_ds = datasets.get_dataset(config,
+                                             uniform_dequantization=config.data.uniform_dequantization)
 
     model = PINN_Net(config)
     ema = ExponentialMovingAverage(model.parameters(), decay=config.model.ema_rate)
     optimizer = losses.get_optimizer(config, model.parameters())
-    state = dict(optimizer=optimizer, model=model, ema=ema, step=0)
+    # The position in the training data and the RNG states are checkpointed for reproducible resumption
+    state = dict(optimizer=optimizer, model=model, ema=ema, step=0,
+                 sampler=train_ds.sampler, eval_sampler=eval_ds.sampler, rng=RNGState())
 
     # Create checkpoints directory
     checkpoint_dir = os.path.join(workdir, "checkpoints")
@@ -44,19 +53,27 @@ def train(config, workdir):
     # Resume training when intermediate checkpoints are detected
     state = restore_checkpoint(checkpoint_meta_dir, state, config.device)
     initial_step = int(state['step'])
-
-    # Build data iterators
-    train_ds, eval_ds = datasets.get_dataset(config,
-                                             uniform_dequantization=config.data.uniform_dequantization)
-    train_iter = iter(train_ds)  # pytype: disable=wrong-arg-types
-    eval_iter = iter(eval_ds)  # pytype: disable=wrong-arg-types
+    # Checkpoints are written in the background so that training is not blocked by disk I/O
+    ckpt_writer = AsyncCheckpointWriter()
+    ckpt_manager = CheckpointManager(checkpoint_dir, writer=ckpt_writer,
+                                     keep_last=config.training.keep_last,
+                                     keep_best=config.training.keep_best,
+                                     export_ema=config.training.export_ema,
+                                     export_fp16=config.training.export_fp16)
+
+    # Opt-in breakdown of the wall time of each training step
+    timer = profiling.get_step_timer(config, workdir, writer)
+    # Batches are copied to the device ahead of time; the training prefetcher times the 'data'
+    # and 'h2d' phases itself
+    train_iter = datasets.DevicePrefetcher(train_ds, config.device, transform=unbatch, timer=timer)
+    eval_iter = datasets.DevicePrefetcher(eval_ds, config.device, transform=unbatch, depth=1)
 
     # Build one-step training and evaluation functions
     optimize_fn = losses.optimization_manager(config)
     #continuous = config.training.continuous
     #reduce_mean = config.training.reduce_mean
     #likelihood_weighting = config.training.likelihood_weighting
-    train_step_fn = losses.get_pinn_step_fn(config, train=True, optimize_fn=optimize_fn)
+    train_step_fn = losses.get_pinn_step_fn(config, train=True, optimize_fn=optimize_fn, timer=timer)
     eval_step_fn = losses.get_pinn_step_fn(config, train=False, optimize_fn=optimize_fn)
 
 
@@ -66,42 +83,47 @@ def train(config, workdir):
     # In case there are multiple hosts (e.g., TPU pods), only log to host 0
     logging.info("Starting training loop at step %d." % (initial_step,))
 
+    # Latest evaluation metrics, recorded with each checkpoint for retention
+    metrics = {}
     for step in range(initial_step, num_train_steps + 1):
-        try:
-            batch = next(train_iter)
-        except StopIteration:
-            train_iter = iter(train_ds)
-            batch = next(train_iter)
+        batch = next(train_iter)
+        train_ds.sampler.advance(batch[0].shape[0])
 
         # Execute one training step
-        loss, loss_e, loss_d = train_step_fn(state, unbatch(config, batch))
+        loss, loss_e, loss_d = train_step_fn(state, batch)
 
         if step % config.training.log_freq == 0:
             logging.info("step: %d, training_loss: %.5e = (%.5e, %.5e)" % (step, loss.item(), loss_e.item(), loss_d.item()))
             writer.add_scalar("training_loss", loss, step)
 
-        # Save a temporary checkpoint to resume training after pre-emption periodically
-        if step != 0 and step % config.training.snapshot_freq_for_preemption == 0:
-            save_checkpoint(checkpoint_meta_dir, state)
-
         # Report the loss on an evaluation dataset periodically
         if step % config.training.eval_freq == 0:
-            try:
-                batch = next(eval_iter)
-            except StopIteration:
-                eval_iter = iter(eval_ds)
-                batch = next(eval_iter)
-
-            eval_loss, eval_loss_e, eval_loss_d = eval_step_fn(state, unbatch(config, batch))
+            with timer.phase('eval'):
+                eval_batch = next(eval_iter)
+                eval_ds.sampler.advance(eval_batch[0].shape[0])
+                eval_loss, eval_loss_e, eval_loss_d = eval_step_fn(state, eval_batch)
             logging.info("step: %d, eval_loss: %.5e = (%.5e, %.5e)" % (step, eval_loss.item(), eval_loss_e.item(), eval_loss_d.item()))
             writer.add_scalar("eval_loss", eval_loss.item(), step)
+            metrics['eval_loss'] = eval_loss.item()
 
         # Save a checkpoint periodically and generate samples if needed
         if step != 0 and step % config.training.snapshot_freq == 0 or step == num_train_steps:
             # Save the checkpoint.
             save_step = step // config.training.snapshot_freq
-            save_checkpoint(os.path.join(checkpoint_dir, f'checkpoint_{save_step}.pth'), state)
-            print(f">>> checkpoint_{save_step}.pth saved")
+            with timer.phase('checkpoint'):
+                ckpt_manager.save(save_step, state, metrics)
+            print(f">>> checkpoint_{save_step}.pth scheduled")
+
+        # Save a temporary checkpoint to resume training after pre-emption periodically. This happens
+        # last so that the saved RNG state is the one the next step starts from.
+        if step != 0 and step % config.training.snapshot_freq_for_preemption == 0:
+            with timer.phase('checkpoint'):
+                ckpt_writer.save(checkpoint_meta_dir, state)
+
+        timer.step_end(step, batch[0].shape[0])
+
+    timer.close()
+    ckpt_writer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+# pylint: skip-file
+"""Wall-clock breakdown of training steps for finding bottlenecks in the training loops."""
+
+import os
+import json
+import time
+import resource
+import contextlib
+from collections import defaultdict
+
+import torch
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class StepTimer:
+  """Records the wall time of the phases of each training step.
+
+  Phases are timed with `with timer.phase(name): ...`; `step_end` closes a step and every
+  `log_freq` steps the per-step averages, samples/sec and peak memory are written to TensorBoard
+  and appended to a JSONL trace. When disabled every method is a no-op, so the training loops can
+  be instrumented unconditionally.
+
+  On CUDA the device is synchronized around every phase so that asynchronous kernels are
+  attributed to the phase that launched them. This slows training down and is only done when
+  the timer is enabled.
+  """
+
+  def __init__(self, device, enabled=False, writer=None, trace_path=None, log_freq=100,
+               profile_dir=None, profile_wait=10, profile_steps=0):
+    self.enabled = enabled
+    self.writer = writer
+    self.trace_path = trace_path
+    self.log_freq = log_freq
+    self.cuda = torch.device(device).type == 'cuda'
+    self._totals = defaultdict(float)
+    self._num_steps = 0
+    self._num_samples = 0
+    self._window_start = time.perf_counter()
+    self._profiler = None
+
+    if not enabled:
+      return
+    if trace_path is not None:
+      os.makedirs(os.path.dirname(trace_path), exist_ok=True)
+    if self.cuda:
+      torch.cuda.reset_peak_memory_stats(device)
+    if profile_steps > 0:
+      # Wrap a window of steps with the PyTorch profiler and export a TensorBoard trace
+      activities = [torch.profiler.ProfilerActivity.CPU]
+      if self.cuda:
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+      self._profiler = torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=profile_wait, warmup=1, active=profile_steps, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(profile_dir),
+        record_shapes=True, profile_memory=True)
+      self._profiler.start()
+
+  def _sync(self):
+    if self.cuda:
+      torch.cuda.synchronize()
+
+  @contextlib.contextmanager
+  def _timed(self, name):
+    self._sync()
+    start = time.perf_counter()
+    with torch.profiler.record_function(name):
+      yield
+    self._sync()
+    self._totals[name] += time.perf_counter() - start
+
+  def phase(self, name):
+    """Context manager that adds the wall time of its body to phase `name`."""
+    if not self.enabled:
+      return _NULL_CONTEXT
+    return self._timed(name)
+
+  def _peak_memory_mb(self):
+    if self.cuda:
+      return torch.cuda.max_memory_allocated() / 2 ** 20
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+  def step_end(self, step, batch_size):
+    """Close the current step; writes a summary every `log_freq` steps."""
+    if not self.enabled:
+      return
+    self._num_steps += 1
+    self._num_samples += batch_size
+    if self._profiler is not None:
+      self._profiler.step()
+    if self._num_steps % self.log_freq == 0:
+      self.log(step)
+
+  def log(self, step):
+    if not self.enabled or self._num_steps == 0:
+      return
+    elapsed = time.perf_counter() - self._window_start
+    record = dict(step=step,
+                  steps=self._num_steps,
+                  samples_per_sec=self._num_samples / elapsed,
+                  peak_memory_mb=self._peak_memory_mb(),
+                  phases_ms={k: 1e3 * v / self._num_steps for k, v in self._totals.items()})
+    record['phases_ms']['other'] = max(
+      1e3 * elapsed / self._num_steps - sum(record['phases_ms'].values()), 0.)
+
+    if self.writer is not None:
+      for name, ms in record['phases_ms'].items():
+        self.writer.add_scalar(f"profile/{name}_ms", ms, step)
+      self.writer.add_scalar("profile/samples_per_sec", record['samples_per_sec'], step)
+      self.writer.add_scalar("profile/peak_memory_mb", record['peak_memory_mb'], step)
+    if self.trace_path is not None:
+      with open(self.trace_path, 'a') as fout:
+        fout.write(json.dumps(record) + '\n')
+
+    self._totals.clear()
+    self._num_steps = 0
+    self._num_samples = 0
+    self._window_start = time.perf_counter()
+
+  def close(self):
+    if self._profiler is not None:
+      self._profiler.stop()
+      self._profiler = None
+
+
+def get_step_timer(config, workdir, writer=None):
+  """Create the `StepTimer` of a training run from `config.training`."""
+  profile_dir = os.path.join(workdir, "profile")
+  return StepTimer(config.device,
+                   enabled=config.training.profile,
+                   writer=writer,
+                   trace_path=os.path.join(profile_dir, "steps.jsonl"),
+                   log_freq=config.training.log_freq,
+                   profile_dir=os.path.join(profile_dir, "trace"),
+                   profile_wait=config.training.profile_wait,
+                   profile_steps=config.training.profile_steps)
@@ -20,7 +20,11 @@ import gc
 import io
 import os
 import glob
+import json
 import time
+import multiprocessing
+import threading
+from concurrent import futures
 
 import numpy as np
 import logging
@@ -31,14 +35,17 @@ import sampling
 from models import utils as mutils
 from models.ema import ExponentialMovingAverage
 import datasets
+import distributed
 import evaluation
 import likelihood
+import profiling
 import sde_lib
 from absl import flags
 import torch
 from torch.utils import tensorboard
 from torchvision.utils import make_grid, save_image
-from utils import save_checkpoint, load_checkpoint, restore_checkpoint
+from utils import save_checkpoint, load_checkpoint, restore_checkpoint, AsyncCheckpointWriter, CheckpointManager, \
+  CheckpointWatcher, checkpoint_ready, RNGState, set_seed
 
 FLAGS = flags.FLAGS
 
@@ -65,6 +72,9 @@ def train(config, workdir):
     workdir: Working directory for checkpoints and TF summaries. If this
       contains checkpoint training will be resumed from the latest checkpoint.
   """
+  # Multi-process training when launched with torchrun; only the main process logs and samples
+  distributed.init_distributed(config)
+  main = distributed.is_main_process()
 
   # Create directories for experimental logs
   sample_dir = os.path.join(workdir, "samples")
@@ -72,13 +82,28 @@ def train(config, workdir):
 
   tb_dir = os.path.join(workdir, "tensorboard")
   os.makedirs(tb_dir, exist_ok=True)
-  writer = tensorboard.SummaryWriter(tb_dir)
+  writer = tensorboard.SummaryWriter(tb_dir) if main else None
+  set_seed(config.seed + distributed.get_rank())
+
+  # Build data loaders
+  train_ds, eval_ds = datasets.get_dataset(config,
+                                              uniform_dequantization=config.data.uniform_dequantization)
 
   # Initialize model.
   score_model = mutils.create_model(config)
   ema = ExponentialMovingAverage(score_model.parameters(), decay=config.model.ema_rate)
   optimizer = losses.get_optimizer(config, score_model.parameters())
-  state = dict(optimizer=optimizer, model=score_model, ema=ema, step=0)
+
+  # Setup SDEs
+  sde, sampling_eps = _get_sde(config)
+  t_sampler = losses.get_timestep_sampler(config, sde)
+
+  # The position in the training data, the RNG states and the time step histogram are checkpointed for
+  # reproducible resumption
+  state = dict(optimizer=optimizer, model=score_model, ema=ema, step=0,
+               sampler=train_ds.sampler, eval_sampler=eval_ds.sampler, rng=RNGState())
+  if t_sampler is not None:
+    state['t_sampler'] = t_sampler
 
   # Create checkpoints directory
   checkpoint_dir = os.path.join(workdir, "checkpoints")
@@ -89,18 +114,24 @@ def train(config, workdir):
   # Resume training when intermediate checkpoints are detected
   state = restore_checkpoint(checkpoint_meta_dir, state, config.device)
   initial_step = int(state['step'])
+  # Checkpoints are written in the background so that training is not blocked by disk I/O
+  ckpt_writer = AsyncCheckpointWriter()
+  ckpt_manager = CheckpointManager(checkpoint_dir, writer=ckpt_writer,
+                                   keep_last=config.training.keep_last,
+                                   keep_best=config.training.keep_best,
+                                   export_ema=config.training.export_ema,
+                                   export_fp16=config.training.export_fp16)
 
-  # Build data iterators
-  train_ds, eval_ds = datasets.get_dataset(config,
-                                              uniform_dequantization=config.data.uniform_dequantization)
-  train_iter = iter(train_ds)  # pytype: disable=wrong-arg-types
-  eval_iter = iter(eval_ds)  # pytype: disable=wrong-arg-types
   # Create data normalizer and its inverse
   scaler = datasets.get_data_scaler(config)
   inverse_scaler = datasets.get_data_inverse_scaler(config)
-
-  # Setup SDEs
-  sde, sampling_eps = _get_sde(config)
+  # Opt-in breakdown of the wall time of each training step
+  timer = profiling.get_step_timer(config, workdir, writer)
+  # Batches are copied to the device and normalized ahead of time; the training prefetcher times the 'data'
+  # and 'h2d' phases itself
+  prefetch_fn = lambda batch: scaler(batch[0].float())
+  train_iter = datasets.DevicePrefetcher(train_ds, config.device, transform=prefetch_fn, timer=timer)
+  eval_iter = datasets.DevicePrefetcher(eval_ds, config.device, transform=prefetch_fn, depth=1)
 
   # Build one-step training and evaluation functions
   optimize_fn = losses.optimization_manager(config)
@@ -109,16 +140,27 @@ def train(config, workdir):
   likelihood_weighting = config.training.likelihood_weighting
   train_step_fn = losses.get_step_fn(sde, train=True, optimize_fn=optimize_fn,
                                      reduce_mean=reduce_mean, continuous=continuous,
-                                     likelihood_weighting=likelihood_weighting)
+                                     likelihood_weighting=likelihood_weighting, timer=timer,
+                                     t_sampler=t_sampler, num_noise_draws=config.training.num_noise_draws,
+                                     t_sampling=config.training.t_sampling)
   eval_step_fn = losses.get_step_fn(sde, train=False, optimize_fn=optimize_fn,
                                     reduce_mean=reduce_mean, continuous=continuous,
                                     likelihood_weighting=likelihood_weighting)
 
   # Building sampling functions
-  if config.training.snapshot_sampling:
-    sampling_shape = (config.training.batch_size//4, config.data.num_channels,
-                      config.data.image_size, config.data.image_size)
-    sampling_fn = sampling.get_sampling_fn(config, sde, sampling_shape, inverse_scaler, sampling_eps)
+  async_sampling = main and config.training.snapshot_sampling and config.training.snapshot_sampling_workers > 0
+  sync_sampling = main and config.training.snapshot_sampling and not async_sampling
+  if async_sampling:
+    # Snapshot samples are drawn by background processes from the saved checkpoints
+    mp_context = multiprocessing.get_context('spawn')
+    sampling_jobs = mp_context.Queue()
+    samplers = [mp_context.Process(target=_snapshot_sampling_worker,
+                                   args=(config, sample_dir, tb_dir, sampling_jobs), daemon=True)
+                for _ in range(config.training.snapshot_sampling_workers)]
+    for sampler in samplers:
+      sampler.start()
+  elif sync_sampling:
+    sampling_fn = _get_snapshot_sampling_fn(config, sde, inverse_scaler, sampling_eps)
 
   num_train_steps = config.training.n_iters
   print("num_train_steps", num_train_steps)
@@ -126,63 +168,125 @@ def train(config, workdir):
   # In case there are multiple hosts (e.g., TPU pods), only log to host 0
   logging.info("Starting training loop at step %d." % (initial_step,))
 
+  # Latest evaluation metrics, recorded with each checkpoint for retention
+  metrics = {}
   for step in range(initial_step, num_train_steps+1):
-    try:
-      batch, target = next(train_iter)
-    except StopIteration:
-      train_iter = iter(train_ds)
-
-    # Convert data to JAX arrays and normalize them. Use ._numpy() to avoid copy.
-    batch = batch.to(config.device).float()
-    #batch = batch.permute(0, 3, 1, 2)
-    batch = scaler(batch)
+    batch = next(train_iter)
+    train_ds.sampler.advance(batch.shape[0])
 
     # Execute one training step
     loss = train_step_fn(state, batch)
-    if step % config.training.log_freq == 0:
+    if step % config.training.log_freq == 0 and main:
       logging.info("step: %d, training_loss: %.5e" % (step, loss.item()))
       writer.add_scalar("training_loss", loss, step)
-
-    # Save a temporary checkpoint to resume training after pre-emption periodically
-    if step != 0 and step % config.training.snapshot_freq_for_preemption == 0:
-      save_checkpoint(checkpoint_meta_dir, state)
+      if t_sampler is not None:
+        # Learned density of the time steps, one bucket per bin of the sampler; nothing is drawn
+        probs = t_sampler.probs().cpu().double()
+        edges = torch.linspace(t_sampler.eps, t_sampler.T, t_sampler.num_bins + 1, dtype=torch.float64)
+        centers = (edges[1:] + edges[:-1]) / 2
+        writer.add_histogram_raw("t_sampling", min=t_sampler.eps, max=t_sampler.T, num=1,
+                                 sum=(probs * centers).sum().item(),
+                                 sum_squares=(probs * centers ** 2).sum().item(),
+                                 bucket_limits=edges[1:].tolist(), bucket_counts=probs.tolist())
 
     # Report the loss on an evaluation dataset periodically
     if step % config.training.eval_freq == 0:
-      try:
-        eval_batch, _ = next(eval_iter)
-      except StopIteration:
-        eval_iter = iter(eval_ds)
-      eval_batch = eval_batch.to(config.device).float()
-      # eval_batch = eval_batch.permute(0, 3, 1, 2)
-      eval_batch = scaler(eval_batch)
-      eval_loss = eval_step_fn(state, eval_batch)
-      logging.info("step: %d, eval_loss: %.5e" % (step, eval_loss.item()))
-      writer.add_scalar("eval_loss", eval_loss.item(), step)
+      with timer.phase('eval'):
+        eval_batch = next(eval_iter)
+        eval_ds.sampler.advance(eval_batch.shape[0])
+        eval_loss = eval_step_fn(state, eval_batch)
+      if main:
+        logging.info("step: %d, eval_loss: %.5e" % (step, eval_loss.item()))
+        writer.add_scalar("eval_loss", eval_loss.item(), step)
+      metrics['eval_loss'] = eval_loss.item()
 
     # Save a checkpoint periodically and generate samples if needed
     if step != 0 and step % config.training.snapshot_freq == 0 or step == num_train_steps:
-      # Save the checkpoint.
+      # Save the checkpoint; called on every rank to gather a sharded optimizer state
       save_step = step // config.training.snapshot_freq
-      save_checkpoint(os.path.join(checkpoint_dir, f'checkpoint_{save_step}.pth'), state)
-      print(f">>> checkpoint_{save_step}.pth saved")
+      with timer.phase('checkpoint'):
+        ckpt_path = ckpt_manager.save(save_step, state, metrics)
+      if main:
+        print(f">>> checkpoint_{save_step}.pth scheduled")
 
       # Generate and save samples
-      if config.training.snapshot_sampling:
-        ema.store(score_model.parameters())
-        ema.copy_to(score_model.parameters())
-        sample, n = sampling_fn(score_model)
-        ema.restore(score_model.parameters())
-        this_sample_dir = os.path.join(sample_dir, "iter_{}".format(step))
-        os.makedirs(this_sample_dir, exist_ok=True)
-        nrow = int(np.sqrt(sample.shape[0]))
-        image_grid = make_grid(sample, nrow, padding=2)
-        sample = np.clip(sample.permute(0, 2, 3, 1).cpu().numpy() * 255, 0, 255).astype(np.uint8)
-        with open(os.path.join(this_sample_dir, "sample.np"), "wb") as fout:
-          np.save(fout, sample)
+      if async_sampling:
+        if config.training.export_ema:
+          ckpt_path = os.path.join(checkpoint_dir, "ema", os.path.basename(ckpt_path))
+        sampling_jobs.put((ckpt_path, step))
+      elif sync_sampling:
+        with timer.phase('sampling'):
+          ema.store(score_model.parameters())
+          ema.copy_to(score_model.parameters())
+          sample, n = sampling_fn(score_model)
+          ema.restore(score_model.parameters())
+          _save_snapshot_samples(sample, sample_dir, step, writer)
+
+    # Save a temporary checkpoint to resume training after pre-emption periodically. This happens
+    # last so that the saved RNG state is the one the next step starts from.
+    if step != 0 and step % config.training.snapshot_freq_for_preemption == 0:
+      with timer.phase('checkpoint'):
+        ckpt_writer.save(checkpoint_meta_dir, state)
+
+    timer.step_end(step, batch.shape[0])
+
+  timer.close()
+  ckpt_writer.close()
+  if async_sampling:
+    for _ in samplers:
+      sampling_jobs.put(None)
+    for sampler in samplers:
+      sampler.join()
+  distributed.cleanup()
+
+
+def _get_snapshot_sampling_fn(config, sde, inverse_scaler, sampling_eps):
+  sampling_shape = (config.training.batch_size//4, config.data.num_channels,
+                    config.data.image_size, config.data.image_size)
+  return sampling.get_sampling_fn(config, sde, sampling_shape, inverse_scaler, sampling_eps)
+
+
+def _save_snapshot_samples(sample, sample_dir, step, writer=None):
+  this_sample_dir = os.path.join(sample_dir, "iter_{}".format(step))
+  os.makedirs(this_sample_dir, exist_ok=True)
+  nrow = int(np.sqrt(sample.shape[0]))
+  image_grid = make_grid(sample, nrow, padding=2)
+  if writer is not None:
+    writer.add_image("samples", image_grid.clamp(0, 1), step)
+  sample = np.clip(sample.permute(0, 2, 3, 1).cpu().numpy() * 255, 0, 255).astype(np.uint8)
+  with open(os.path.join(this_sample_dir, "sample.np"), "wb") as fout:
+    np.save(fout, sample)
+
+  with open(os.path.join(this_sample_dir, "sample.png"), "wb") as fout:
+    save_image(image_grid, fout)
+
+
+def _snapshot_sampling_worker(config, sample_dir, tb_dir, jobs, ready_timeout=3600):
+  """Background process that draws snapshot samples while training continues.
 
-        with open(os.path.join(this_sample_dir, "sample.png"), "wb") as fout:
-          save_image(image_grid, fout)
+  Receives `(ckpt_path, step)` jobs from `train`, waits until the checkpoint is on disk, and
+  samples from its EMA weights. A `None` job stops the worker.
+  """
+  score_model = mutils.create_model(config)
+  inverse_scaler = datasets.get_data_inverse_scaler(config)
+  sde, sampling_eps = _get_sde(config)
+  sampling_fn = _get_snapshot_sampling_fn(config, sde, inverse_scaler, sampling_eps)
+  writer = tensorboard.SummaryWriter(tb_dir)
+
+  for ckpt_path, step in iter(jobs.get, None):
+    deadline = time.time() + ready_timeout
+    while not checkpoint_ready(ckpt_path) and time.time() < deadline:
+      time.sleep(1)
+    if not checkpoint_ready(ckpt_path):
+      logging.warning(f"Skipped snapshot sampling at step {step}: {ckpt_path} was not written")
+      continue
+    score_model = load_checkpoint(ckpt_path, score_model, config.device)
+    sample, n = sampling_fn(score_model)
+    _save_snapshot_samples(sample, sample_dir, step, writer)
+    writer.flush()
+    logging.info(f"Saved snapshot samples of step {step}")
+
+  writer.close()
 
 
 def _sample_fn(config, score_model):
@@ -229,35 +333,36 @@ def evaluate(config,
   eval_dir = os.path.join(workdir, eval_folder)
   os.makedirs(eval_dir, exist_ok=True)
 
-  # Build data pipeline
-  train_ds, eval_ds = datasets.get_dataset(config,
-                                              uniform_dequantization=config.data.uniform_dequantization,
-                                              evaluation=True)
-
   # Create data normalizer and its inverse
   scaler = datasets.get_data_scaler(config)
   inverse_scaler = datasets.get_data_inverse_scaler(config)
 
-  # Initialize model
-  score_model = mutils.create_model(config)
-  optimizer = losses.get_optimizer(config, score_model.parameters())
-  ema = ExponentialMovingAverage(score_model.parameters(), decay=config.model.ema_rate)
-  state = dict(optimizer=optimizer, model=score_model, ema=ema, step=0)
+  def new_state():
+    """Model and training state for one evaluation worker."""
+    score_model = mutils.create_model(config)
+    optimizer = losses.get_optimizer(config, score_model.parameters())
+    ema = ExponentialMovingAverage(score_model.parameters(), decay=config.model.ema_rate)
+    return dict(optimizer=optimizer, model=score_model, ema=ema, step=0)
+
+  def new_loaders():
+    """Evaluation and likelihood data loaders for one evaluation worker.
+
+    Loaders with persistent workers reuse one iterator and their samplers track a position, so they are not shared
+    between threads.
+    """
+    _, eval_ds = datasets.get_dataset(config,
+                                      uniform_dequantization=config.data.uniform_dequantization,
+                                      evaluation=True)
+    # Only evaluate likelihoods on uniformly dequantized data
+    train_ds_bpd, eval_ds_bpd = datasets.get_dataset(config,
+                                                     uniform_dequantization=True, evaluation=True)
+    ds_bpd = train_ds_bpd if config.eval.bpd_dataset.lower() == 'train' else eval_ds_bpd
+    return eval_ds, ds_bpd
 
   checkpoint_dir = os.path.join(workdir, "checkpoints")
 
   # Setup SDEs
-  if config.training.sde.lower() == 'vpsde':
-    sde = sde_lib.VPSDE(beta_min=config.model.beta_min, beta_max=config.model.beta_max, N=config.model.num_scales)
-    sampling_eps = 1e-3
-  elif config.training.sde.lower() == 'subvpsde':
-    sde = sde_lib.subVPSDE(beta_min=config.model.beta_min, beta_max=config.model.beta_max, N=config.model.num_scales)
-    sampling_eps = 1e-3
-  elif config.training.sde.lower() == 'vesde':
-    sde = sde_lib.VESDE(sigma_min=config.model.sigma_min, sigma_max=config.model.sigma_max, N=config.model.num_scales)
-    sampling_eps = 1e-5
-  else:
-    raise NotImplementedError(f"SDE {config.training.sde} unknown.")
+  sde, sampling_eps = _get_sde(config)
 
   # Create the one-step evaluation function when loss computation is enabled
   if config.eval.enable_loss:
@@ -272,15 +377,11 @@ def evaluate(config,
                                    likelihood_weighting=likelihood_weighting)
 
 
-  # Create data loaders for likelihood evaluation. Only evaluate on uniformly dequantized data
-  train_ds_bpd, eval_ds_bpd = datasets.get_dataset(config,
-                                                      uniform_dequantization=True, evaluation=True)
+  # Likelihoods are evaluated on the data loaders of `new_loaders`
   if config.eval.bpd_dataset.lower() == 'train':
-    ds_bpd = train_ds_bpd
     bpd_num_repeats = 1
   elif config.eval.bpd_dataset.lower() == 'test':
     # Go over the dataset 5 times when computing likelihood on the test dataset
-    ds_bpd = eval_ds_bpd
     bpd_num_repeats = 5
   else:
     raise ValueError(f"No bpd dataset {config.eval.bpd_dataset} recognized.")
@@ -300,37 +401,27 @@ def evaluate(config,
   inceptionv3 = config.data.image_size >= 256
   inception_model = evaluation.get_inception_model(inceptionv3=inceptionv3)
 
-  begin_ckpt = config.eval.begin_ckpt
-  logging.info("begin checkpoint: %d" % (begin_ckpt,))
-  for ckpt in range(begin_ckpt, config.eval.end_ckpt + 1):
-    # Wait if the target checkpoint doesn't exist yet
-    waiting_message_printed = False
-    ckpt_filename = os.path.join(checkpoint_dir, "checkpoint_{}.pth".format(ckpt))
-    while not os.path.exists(ckpt_filename):
-      if not waiting_message_printed:
-        logging.warning("Waiting for the arrival of checkpoint_%d" % (ckpt,))
-        waiting_message_printed = True
-      time.sleep(60)
-
-    # Wait for 2 additional mins in case the file exists but is not ready for reading
+  num_sampling_rounds = config.eval.num_samples // config.eval.batch_size + 1
+
+  def evaluate_ckpt(ckpt, state, eval_ds, ds_bpd):
+    """Run all enabled evaluations on one checkpoint, skipping the stages recorded as done."""
+    progress = _load_eval_progress(eval_dir, ckpt)
+    if ((not config.eval.enable_loss or progress['loss'])
+        and (not config.eval.enable_bpd or progress['bpd_round'] >= len(ds_bpd) * bpd_num_repeats)
+        and (not config.eval.enable_sampling or progress['stats'])):
+      logging.info("ckpt: %d already evaluated" % (ckpt,))
+      return
+
     ckpt_path = os.path.join(checkpoint_dir, f'checkpoint_{ckpt}.pth')
-    try:
-      state = restore_checkpoint(ckpt_path, state, device=config.device)
-    except:
-      time.sleep(60)
-      try:
-        state = restore_checkpoint(ckpt_path, state, device=config.device)
-      except:
-        time.sleep(120)
-        state = restore_checkpoint(ckpt_path, state, device=config.device)
-    ema.copy_to(score_model.parameters())
+    state = restore_checkpoint(ckpt_path, state, device=config.device)
+    score_model = state['model']
+    state['ema'].copy_to(score_model.parameters())
     # Compute the loss function on the full evaluation dataset if loss computation is enabled
-    if config.eval.enable_loss:
+    if config.eval.enable_loss and not progress['loss']:
       all_losses = []
       eval_iter = iter(eval_ds)  # pytype: disable=wrong-arg-types
-      for i, batch in enumerate(eval_iter):
-        eval_batch = torch.from_numpy(batch['image']._numpy()).to(config.device).float()
-        eval_batch = eval_batch.permute(0, 3, 1, 2)
+      for i, (eval_batch, _) in enumerate(eval_iter):
+        eval_batch = eval_batch.to(config.device).float()
         eval_batch = scaler(eval_batch)
         eval_loss = eval_step(state, eval_batch)
         all_losses.append(eval_loss.item())
@@ -343,35 +434,52 @@ def evaluate(config,
         io_buffer = io.BytesIO()
         np.savez_compressed(io_buffer, all_losses=all_losses, mean_loss=all_losses.mean())
         fout.write(io_buffer.getvalue())
+      progress['loss'] = True
+      _save_eval_progress(eval_dir, ckpt, progress)
 
     # Compute log-likelihoods (bits/dim) if enabled
     if config.eval.enable_bpd:
       bpds = []
+      bpd_file = lambda round_id: os.path.join(eval_dir, f"{config.eval.bpd_dataset}_ckpt_{ckpt}_bpd_{round_id}.npz")
       for repeat in range(bpd_num_repeats):
+        # Batches finished before the evaluation was interrupted are read back and not loaded again
+        start = min(max(progress['bpd_round'] - len(ds_bpd) * repeat, 0), len(ds_bpd))
+        for batch_id in range(start):
+          path = bpd_file(batch_id + len(ds_bpd) * repeat)
+          # Rounds past the end of a rank's sharded data were never written
+          if os.path.exists(path):
+            with open(path, "rb") as fin:
+              bpds.extend(np.load(fin)["arr_0"])
+        if start == len(ds_bpd):
+          continue
+        # Every repeat reads epoch `repeat` of the loader, so round ids map to the same batches after a resume
+        _start_loader(ds_bpd, repeat, start)
         bpd_iter = iter(ds_bpd)  # pytype: disable=wrong-arg-types
-        for batch_id in range(len(ds_bpd)):
-          batch = next(bpd_iter)
-          eval_batch = torch.from_numpy(batch['image']._numpy()).to(config.device).float()
-          eval_batch = eval_batch.permute(0, 3, 1, 2)
+        # Sharded data is dealt out unevenly, so a rank's loader may run out before `len(ds_bpd)` batches
+        for batch_id, (eval_batch, _) in zip(range(start, len(ds_bpd)), bpd_iter):
+          bpd_round_id = batch_id + len(ds_bpd) * repeat
+          eval_batch = eval_batch.to(config.device).float()
           eval_batch = scaler(eval_batch)
           bpd = likelihood_fn(score_model, eval_batch)[0]
           bpd = bpd.detach().cpu().numpy().reshape(-1)
           bpds.extend(bpd)
           logging.info(
             "ckpt: %d, repeat: %d, batch: %d, mean bpd: %6f" % (ckpt, repeat, batch_id, np.mean(np.asarray(bpds))))
-          bpd_round_id = batch_id + len(ds_bpd) * repeat
           # Save bits/dim to disk or Google Cloud Storage
-          with open(os.path.join(eval_dir,
-                                              f"{config.eval.bpd_dataset}_ckpt_{ckpt}_bpd_{bpd_round_id}.npz"),
-                                 "wb") as fout:
+          with open(bpd_file(bpd_round_id), "wb") as fout:
             io_buffer = io.BytesIO()
             np.savez_compressed(io_buffer, bpd)
             fout.write(io_buffer.getvalue())
+          progress['bpd_round'] = bpd_round_id + 1
+          _save_eval_progress(eval_dir, ckpt, progress)
+        # The remaining rounds of a loader that ran out early count as done
+        if progress['bpd_round'] < len(ds_bpd) * (repeat + 1):
+          progress['bpd_round'] = len(ds_bpd) * (repeat + 1)
+          _save_eval_progress(eval_dir, ckpt, progress)
 
     # Generate samples and compute IS/FID/KID when enabled
     if config.eval.enable_sampling:
-      num_sampling_rounds = config.eval.num_samples // config.eval.batch_size + 1
-      for r in range(num_sampling_rounds):
+      for r in range(progress['sampling_round'], num_sampling_rounds):
         logging.info("sampling -- ckpt: %d, round: %d" % (ckpt, r))
 
         # Directory to save samples. Different for each host to avoid writing conflicts
@@ -402,6 +510,8 @@ def evaluate(config,
           np.savez_compressed(
             io_buffer, pool_3=latents["pool_3"], logits=latents["logits"])
           fout.write(io_buffer.getvalue())
+        progress['sampling_round'] = r + 1
+        _save_eval_progress(eval_dir, ckpt, progress)
 
       # Compute inception scores, FIDs and KIDs.
       # Load all statistics that have been previously computed and saved for each host
@@ -449,4 +559,62 @@ def evaluate(config,
         io_buffer = io.BytesIO()
         np.savez_compressed(io_buffer, IS=inception_score, fid=fid, kid=kid)
         f.write(io_buffer.getvalue())
-    '''
\ No newline at end of file
+    '''
+      progress['stats'] = True
+      _save_eval_progress(eval_dir, ckpt, progress)
+
+  begin_ckpt = config.eval.begin_ckpt
+  logging.info("begin checkpoint: %d" % (begin_ckpt,))
+  # Each worker thread evaluates one checkpoint at a time on its own copy of the model
+  worker_local = threading.local()
+
+  def worker_fn(ckpt):
+    if not hasattr(worker_local, 'state'):
+      worker_local.state = new_state()
+      worker_local.loaders = new_loaders()
+    evaluate_ckpt(ckpt, worker_local.state, *worker_local.loaders)
+
+  watcher = CheckpointWatcher(checkpoint_dir, range(begin_ckpt, config.eval.end_ckpt + 1))
+  with futures.ThreadPoolExecutor(max_workers=config.eval.num_workers) as pool:
+    jobs = []
+    for ckpt in watcher:
+      # Surface failures of finished jobs without waiting for the remaining checkpoints
+      for job in jobs:
+        if job.done():
+          job.result()
+      jobs.append(pool.submit(worker_fn, ckpt))
+    for job in jobs:
+      job.result()
+
+
+def _start_loader(loader, epoch, num_batches):
+  """Make the next iteration of `loader` start at batch `num_batches` of epoch `epoch`."""
+  sampler = loader.sampler
+  sampler.load_state_dict(dict(sampler.state_dict(), epoch=epoch, offset=0))
+  sampler.advance(num_batches * loader.batch_size)
+  # Positions the next iteration at the advanced epoch and offset
+  sampler.load_state_dict(sampler.state_dict())
+  if isinstance(loader.dataset, torch.utils.data.IterableDataset) and loader.num_workers > 0:
+    # Persistent workers of a sharded dataset only see the new position when they are started again
+    loader.restart()
+
+
+def _eval_progress_path(eval_dir, ckpt):
+  return os.path.join(eval_dir, f"ckpt_{ckpt}_progress.json")
+
+
+def _load_eval_progress(eval_dir, ckpt):
+  """Stages of the evaluation of `ckpt` that finished in a previous run."""
+  progress = dict(loss=False, bpd_round=0, sampling_round=0, stats=False)
+  path = _eval_progress_path(eval_dir, ckpt)
+  if os.path.exists(path):
+    with open(path) as fin:
+      progress.update(json.load(fin))
+  return progress
+
+
+def _save_eval_progress(eval_dir, ckpt, progress):
+  path = _eval_progress_path(eval_dir, ckpt)
+  with open(path + '.tmp', 'w') as fout:
+    json.dump(progress, fout)
+  os.replace(path + '.tmp', path)
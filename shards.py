@@ -0,0 +1,244 @@
+# pylint: skip-file
+"""Sharded, preprocessed image datasets that are read sequentially.
+
+Random-access reads of single files (LSUN's LMDB, CelebA's JPEGs, image folders) are slow on
+network file systems. `ShardWriter` packs a dataset once into tar shards of uint8 arrays at the
+training resolution, so that training only streams large files:
+
+  python shards.py --config configs/ve/celeba_ncsnpp.py --split train --out_dir ./data/shards/celeba
+  python shards.py --config configs/ve/celeba_ncsnpp.py --split test --out_dir ./data/shards/celeba
+  python shards.py --config ... --folder path/to/images --split train --out_dir ./data/shards/images
+
+and `config.data.shard_dir` points `datasets.get_dataset` at the output directory. Each shard
+holds `{key}.npy` (a CHW uint8 array) and `{key}.cls` (the label) per sample; `{split}.json`
+lists the shards and their sizes.
+"""
+
+import io
+import os
+import json
+import tarfile
+import logging
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset
+
+
+class ShardWriter:
+  """Writes (image, label) pairs to `{out_dir}/{split}-{i:05d}.tar`, `samples_per_shard` per shard."""
+
+  def __init__(self, out_dir, split, samples_per_shard=2000):
+    self.out_dir = out_dir
+    self.split = split
+    self.samples_per_shard = samples_per_shard
+    self.shards = []
+    self._tar = None
+    self._count = 0
+    os.makedirs(out_dir, exist_ok=True)
+
+  def _add(self, tar, name, payload):
+    info = tarfile.TarInfo(name)
+    info.size = len(payload)
+    tar.addfile(info, io.BytesIO(payload))
+
+  def _next_shard(self):
+    self._close_shard()
+    name = f'{self.split}-{len(self.shards):05d}.tar'
+    self.shards.append(dict(name=name, size=0))
+    self._tar = tarfile.open(os.path.join(self.out_dir, name), 'w')
+
+  def _close_shard(self):
+    if self._tar is not None:
+      self._tar.close()
+      self._tar = None
+
+  def write(self, image, label=0):
+    """Add a CHW uint8 image (tensor or array) with an integer label."""
+    if self._tar is None or self.shards[-1]['size'] == self.samples_per_shard:
+      self._next_shard()
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    buffer = io.BytesIO()
+    np.save(buffer, image)
+    key = f'{self._count:09d}'
+    self._add(self._tar, f'{key}.npy', buffer.getvalue())
+    self._add(self._tar, f'{key}.cls', str(int(label)).encode())
+    self.shards[-1]['size'] += 1
+    self._count += 1
+
+  def close(self):
+    self._close_shard()
+    with open(os.path.join(self.out_dir, f'{self.split}.json'), 'w') as fout:
+      json.dump(dict(shards=self.shards, size=self._count), fout)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def _read_shard(path):
+  """Yield the (image, label) pairs of a shard in the order they were written."""
+  image = None
+  # Streaming mode reads the file front to back without seeking
+  with tarfile.open(path, 'r|') as tar:
+    for member in tar:
+      payload = tar.extractfile(member).read()
+      if member.name.endswith('.npy'):
+        image = np.load(io.BytesIO(payload))
+      elif member.name.endswith('.cls'):
+        yield image, int(payload)
+
+
+class ShardedDataset(IterableDataset):
+  """Streams the shards of `{shard_dir}/{split}.json`.
+
+  Every epoch the shards are permuted with a generator seeded with `seed + epoch` and dealt out
+  to the `num_replicas` ranks and, within a rank, to the DataLoader workers, whose streams the
+  DataLoader interleaves. Samples pass through a shuffle buffer of `shuffle_buffer_size`.
+
+  The dataset also takes the role of the training loop's sampler: `advance`, `state_dict` and
+  `load_state_dict` track the epoch and the samples consumed in it. On resume each worker skips
+  its share of the consumed samples, so the data order continues approximately where it left off.
+  Persistent DataLoader workers iterate over their own copies of the dataset, so a position loaded
+  after they were started only applies to new workers (see `datasets.AugmentedLoader.restart`).
+  """
+
+  def __init__(self, shard_dir, split='train', shuffle=True, shuffle_buffer_size=10000, seed=0,
+               num_replicas=1, rank=0):
+    with open(os.path.join(shard_dir, f'{split}.json')) as fin:
+      index = json.load(fin)
+    self.paths = [os.path.join(shard_dir, shard['name']) for shard in index['shards']]
+    self.sizes = [shard['size'] for shard in index['shards']]
+    self.shuffle = shuffle
+    self.shuffle_buffer_size = shuffle_buffer_size if shuffle else 0
+    self.seed = seed
+    self.num_replicas = num_replicas
+    self.rank = rank
+    self.epoch = 0
+    self.offset = 0
+    self._next_start = (0, 0)
+
+  def _shards(self, epoch):
+    if self.shuffle:
+      generator = torch.Generator()
+      generator.manual_seed(self.seed + epoch)
+      order = torch.randperm(len(self.paths), generator=generator).tolist()
+    else:
+      order = list(range(len(self.paths)))
+    return order[self.rank::self.num_replicas]
+
+  def __len__(self):
+    # Shards are dealt out unevenly, so ranks read different numbers of samples
+    return self.epoch_size(self.epoch)
+
+  def epoch_size(self, epoch):
+    """Number of samples this rank reads in `epoch`."""
+    return sum(self.sizes[i] for i in self._shards(epoch))
+
+  def _shuffled(self, samples, generator):
+    if self.shuffle_buffer_size == 0:
+      yield from samples
+      return
+    buffer = []
+    for sample in samples:
+      if len(buffer) < self.shuffle_buffer_size:
+        buffer.append(sample)
+        continue
+      i = torch.randint(len(buffer), (), generator=generator).item()
+      buffer[i], sample = sample, buffer[i]
+      yield sample
+    order = torch.randperm(len(buffer), generator=generator).tolist()
+    yield from (buffer[i] for i in order)
+
+  def __iter__(self):
+    worker_info = torch.utils.data.get_worker_info()
+    worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+    # As with ResumableSampler every new iterator continues with the next epoch
+    epoch, offset = self._next_start
+    self._next_start = (epoch + 1, 0)
+
+    shards = self._shards(epoch)[worker_id::num_workers]
+    generator = torch.Generator()
+    generator.manual_seed(hash((self.seed, epoch, self.rank, worker_id)) % 2 ** 63)
+    samples = (sample for i in shards for sample in _read_shard(self.paths[i]))
+    skip = offset // num_workers
+    for n, (image, label) in enumerate(self._shuffled(samples, generator)):
+      if n >= skip:
+        yield torch.from_numpy(image), label
+
+  def advance(self, num_samples):
+    """Record that `num_samples` more samples were consumed."""
+    self.offset += num_samples
+    while self.offset >= self.epoch_size(self.epoch) > 0:
+      self.offset -= self.epoch_size(self.epoch)
+      self.epoch += 1
+
+  def state_dict(self):
+    return dict(epoch=self.epoch, offset=self.offset, seed=self.seed, num_replicas=self.num_replicas)
+
+  def load_state_dict(self, state_dict):
+    self.epoch = int(state_dict['epoch'])
+    self.seed = int(state_dict['seed'])
+    # Shards are dealt out differently with another number of ranks; the epoch is then started over
+    same_replicas = int(state_dict.get('num_replicas', 1)) == self.num_replicas
+    if not same_replicas:
+      logging.warning("Resuming sharded data with a different number of processes; restarting the epoch.")
+    self.offset = int(state_dict['offset']) if same_replicas else 0
+    self._next_start = (self.epoch, self.offset)
+
+
+def _source(config, split, folder=None):
+  """(uint8 CHW image, label) pairs of the dataset in `config` at `config.data.image_size`."""
+  from PIL import Image
+  from torchvision import datasets as tv_datasets, transforms
+  import datasets
+
+  size = config.data.image_size
+  if folder is not None:
+    transform = transforms.Compose([
+      transforms.PILToTensor(),
+      datasets.resize_small(size),
+      datasets.central_crop(size)])
+    names = sorted(f for f in os.listdir(folder) if f.endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')))
+    return ((transform(Image.open(os.path.join(folder, name)).convert('RGB')), 0) for name in names)
+
+  if config.data.dataset == 'CELEBA':
+    transform = transforms.Compose([
+      transforms.PILToTensor(),
+      datasets.central_crop(140),
+      transforms.Resize([size, size], antialias=True)])
+    return tv_datasets.CelebA(root='./data', split=split, download=True, transform=transform)
+  elif config.data.dataset == 'LSUN':
+    steps = [transforms.PILToTensor(), datasets.central_crop(size)]
+    if size == 128:
+      steps.insert(1, datasets.resize_small(size))
+    return tv_datasets.LSUN(root='./data', classes=[config.data.category], transform=transforms.Compose(steps))
+  raise NotImplementedError(f'Writing shards of {config.data.dataset} is not supported.')
+
+
+def main(argv):
+  from absl import flags
+
+  FLAGS = flags.FLAGS
+  with ShardWriter(FLAGS.out_dir, FLAGS.split, FLAGS.samples_per_shard) as writer:
+    for i, (image, label) in enumerate(_source(FLAGS.config, FLAGS.split, FLAGS.folder)):
+      writer.write(image, label)
+      if (i + 1) % 10000 == 0:
+        logging.info("Wrote %d samples" % (i + 1))
+  logging.info("Wrote %d samples in %d shards to %s" % (writer._count, len(writer.shards), FLAGS.out_dir))
+
+
+if __name__ == "__main__":
+  from absl import app
+  from absl import flags
+  from ml_collections.config_flags import config_flags
+
+  config_flags.DEFINE_config_file("config", None, "Data configuration.", lock_config=False)
+  flags.DEFINE_string("out_dir", None, "Output directory of the shards.")
+  flags.DEFINE_enum("split", "train", ["train", "test"], "Dataset split to write.")
+  flags.DEFINE_string("folder", None, "Write the images in this folder instead of the dataset of --config.")
+  flags.DEFINE_integer("samples_per_shard", 2000, "Samples per shard.")
+  flags.mark_flags_as_required(["config", "out_dir"])
+  app.run(main)
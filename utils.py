@@ -1,7 +1,17 @@
 import torch
+import numpy as np
 import os
+import json
+import random
+import re
+import hashlib
+import queue
+import atexit
 import logging
+import threading
 import time
+from torch.distributed.optim import ZeroRedundancyOptimizer
+import distributed
 
 class Clock:
     def __init__(self, itv):
@@ -24,27 +34,458 @@ def restore_checkpoint(ckpt_dir, state, device):
     return state
   else:
     loaded_state = torch.load(ckpt_dir, map_location=device)
+    # A consolidated optimizer state is re-sharded by `ZeroRedundancyOptimizer.load_state_dict`
     state['optimizer'].load_state_dict(loaded_state['optimizer'])
     state['model'].load_state_dict(loaded_state['model'], strict=False)
     state['ema'].load_state_dict(loaded_state['ema'])
     state['step'] = loaded_state['step']
+    for key in _OPTIONAL_STATE:
+      if key in state and key in loaded_state:
+        state[key].load_state_dict(loaded_state[key])
     return state
 
-def load_checkpoint(ckpt_dir, model, device):
+
+def set_seed(seed):
+  """Seed the Python, NumPy and torch random number generators."""
+  random.seed(seed)
+  np.random.seed(seed)
+  torch.manual_seed(seed)
+
+
+class RNGState:
+  """Checkpointable state of the global Python, NumPy and torch random number generators.
+
+  Everything is stored as tensors and plain Python values, so checkpoints can still be loaded
+  with `weights_only=True`. In multi-process training the states of all ranks are gathered and
+  each rank restores its own.
+  """
+
+  def state_dict(self):
+    state_dict = self._local_state_dict()
+    if distributed.is_initialized():
+      return dict(ranks=distributed.all_gather_object(state_dict))
+    return state_dict
+
+  def load_state_dict(self, state_dict):
+    if 'ranks' in state_dict:
+      if len(state_dict['ranks']) != distributed.get_world_size():
+        logging.warning(f"RNG states were saved by {len(state_dict['ranks'])} processes, "
+                        f"keeping the current ones for {distributed.get_world_size()} processes.")
+        return
+      state_dict = state_dict['ranks'][distributed.get_rank()]
+    elif distributed.get_world_size() > 1:
+      logging.warning("RNG state was saved by a single process, keeping the current ones.")
+      return
+    self._load_local_state_dict(state_dict)
+
+  def _local_state_dict(self):
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state_dict = {
+      'python': random.getstate(),
+      'numpy': dict(keys=torch.from_numpy(keys.astype(np.int64)), pos=int(pos),
+                    has_gauss=int(has_gauss), cached_gaussian=float(cached_gaussian)),
+      'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+      state_dict['cuda'] = torch.cuda.get_rng_state_all()
+    return state_dict
+
+  def _load_local_state_dict(self, state_dict):
+    random.setstate(state_dict['python'])
+    np_state = state_dict['numpy']
+    np.random.set_state(('MT19937', np_state['keys'].cpu().numpy().astype(np.uint32), np_state['pos'],
+                         np_state['has_gauss'], np_state['cached_gaussian']))
+    # map_location may have moved the states to the GPU, the setters need CPU byte tensors
+    torch.set_rng_state(state_dict['torch'].cpu())
+    if 'cuda' in state_dict and torch.cuda.is_available():
+      torch.cuda.set_rng_state_all([s.cpu() for s in state_dict['cuda']])
+
+def _load_mmap(ckpt_dir):
+  """Load a checkpoint lazily; tensors are only read from disk when they are used."""
+  try:
+    return torch.load(ckpt_dir, map_location='cpu', mmap=True)
+  except (TypeError, RuntimeError):
+    # Older PyTorch versions or checkpoints in the legacy serialization format
+    return torch.load(ckpt_dir, map_location='cpu')
+
+
+def load_checkpoint(ckpt_dir, model, device, use_ema=True):
+  """Load the weights for inference into `model`.
+
+  `ckpt_dir` is either a full training checkpoint or an EMA-only export written by
+  `CheckpointManager`. For training checkpoints the EMA weights are used unless `use_ema` is False;
+  optimizer state is never read.
+  """
   if not os.path.exists(ckpt_dir):
     logging.warning(f"No checkpoint found at {ckpt_dir}. "
                     f"Returned the same state as input")
     return model
   else:
-    state = torch.load(ckpt_dir, map_location=device)["model"]
-    model.load_state_dict(state)
-    return model
+    loaded_state = _load_mmap(ckpt_dir)
+    model.load_state_dict(loaded_state["model"])
+    if use_ema and 'ema' in loaded_state:
+      parameters = [p for p in model.parameters() if p.requires_grad]
+      with torch.no_grad():
+        for s_param, param in zip(loaded_state['ema']['shadow_params'], parameters):
+          param.copy_(s_param)
+    return model.to(device)
+
+
+def manifest_path(ckpt_dir):
+  """Path of the manifest that marks `ckpt_dir` as completely written."""
+  return ckpt_dir + '.json'
+
+
+def checkpoint_ready(ckpt_dir):
+  """Whether the checkpoint at `ckpt_dir` can be read.
+
+  Checkpoints are renamed into place only once fully written, and their manifest follows the
+  rename. Checkpoints written before manifests existed are accepted as soon as the file is present.
+  """
+  if os.path.exists(manifest_path(ckpt_dir)):
+    return True
+  return os.path.exists(ckpt_dir) and not os.path.exists(ckpt_dir + '.tmp')
+
+
+def _to_cpu(obj):
+  """Recursively copy all tensors in `obj` to host memory."""
+  if torch.is_tensor(obj):
+    return obj.detach().to('cpu', copy=True)
+  elif isinstance(obj, dict):
+    return {k: _to_cpu(v) for k, v in obj.items()}
+  elif isinstance(obj, (list, tuple)):
+    return type(obj)(_to_cpu(v) for v in obj)
+  return obj
+
+
+# Optional entries of the training state that are saved and restored when present
+_OPTIONAL_STATE = ('sampler', 'eval_sampler', 'rng', 't_sampler')
+
+
+def _state_dicts(state):
+  """State dicts of the training state, or None on all but the main process.
+
+  In multi-process training this is a collective and has to be called on every rank: a sharded
+  optimizer state is consolidated on the main process, which alone writes checkpoints.
+  """
+  if isinstance(state['optimizer'], ZeroRedundancyOptimizer):
+    state['optimizer'].consolidate_state_dict(to=0)
+  optional_state = {key: state[key].state_dict() for key in _OPTIONAL_STATE if key in state}
+  if not distributed.is_main_process():
+    return None
 
-def save_checkpoint(ckpt_dir, state):
   saved_state = {
     'optimizer': state['optimizer'].state_dict(),
     'model': state['model'].state_dict(),
     'ema': state['ema'].state_dict(),
     'step': state['step']
   }
-  torch.save(saved_state, ckpt_dir)
\ No newline at end of file
+  saved_state.update(optional_state)
+  return saved_state
+
+
+def _ema_state_dict(model_state, param_names, shadow_params, fp16=False):
+  """Model state dict with the trainable parameters replaced by their moving averages."""
+  ema_state = dict(model_state)
+  for name, s_param in zip(param_names, shadow_params):
+    ema_state[name] = s_param
+  if fp16:
+    ema_state = {k: v.half() if v.is_floating_point() else v for k, v in ema_state.items()}
+  return ema_state
+
+
+def _sha256(path, chunk_size=1 << 20):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as fin:
+    for chunk in iter(lambda: fin.read(chunk_size), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def _fsync_dir(dirname):
+  try:
+    fd = os.open(dirname, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(fd)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
+
+
+def _atomic_save(saved_state, ckpt_dir):
+  """Write `saved_state` to a temporary file, fsync it, rename it into place and write the manifest."""
+  dirname = os.path.dirname(os.path.abspath(ckpt_dir))
+  manifest = manifest_path(ckpt_dir)
+  if os.path.exists(manifest):
+    os.remove(manifest)
+
+  tmp_dir = ckpt_dir + '.tmp'
+  with open(tmp_dir, 'wb') as fout:
+    torch.save(saved_state, fout)
+    fout.flush()
+    os.fsync(fout.fileno())
+  os.replace(tmp_dir, ckpt_dir)
+
+  tmp_manifest = manifest + '.tmp'
+  with open(tmp_manifest, 'w') as fout:
+    json.dump(dict(file=os.path.basename(ckpt_dir),
+                   step=int(saved_state['step']),
+                   size=os.path.getsize(ckpt_dir),
+                   time=time.time()), fout)
+    fout.flush()
+    os.fsync(fout.fileno())
+  os.replace(tmp_manifest, manifest)
+  _fsync_dir(dirname)
+
+
+def save_checkpoint(ckpt_dir, state):
+  saved_state = _state_dicts(state)
+  if saved_state is not None:
+    _atomic_save(saved_state, ckpt_dir)
+
+
+class AsyncCheckpointWriter:
+  """Writes checkpoints in a background thread.
+
+  `save` copies the training state to host memory and returns; serialization and the atomic
+  rename happen in the writer thread. At most `max_pending` snapshots are kept in memory,
+  further calls to `save` block until the oldest one is on disk.
+  """
+
+  def __init__(self, max_pending=1):
+    self._queue = queue.Queue(maxsize=max_pending)
+    self._error = None
+    self._closed = False
+    self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+    self._thread.start()
+    atexit.register(self.close)
+
+  def _run(self):
+    while True:
+      item = self._queue.get()
+      try:
+        if item is None:
+          return
+        ckpt_dir, saved_state, callback = item
+        _atomic_save(saved_state, ckpt_dir)
+        if callback is not None:
+          callback(ckpt_dir, saved_state)
+      except BaseException as e:
+        logging.error(f"Failed to write checkpoint {ckpt_dir}: {e}")
+        self._error = e
+      finally:
+        self._queue.task_done()
+
+  def _check(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise RuntimeError("Asynchronous checkpoint write failed.") from error
+
+  def save(self, ckpt_dir, state, callback=None):
+    """Snapshot `state` and schedule it to be written to `ckpt_dir`.
+
+    `callback(ckpt_dir, saved_state)` is called from the writer thread once the file is on disk.
+    In multi-process training this has to be called on every rank; only the main process writes.
+    """
+    self._check()
+    if self._closed:
+      raise RuntimeError("Checkpoint writer is closed.")
+    saved_state = _state_dicts(state)
+    if saved_state is None:
+      return
+    self._queue.put((ckpt_dir, _to_cpu(saved_state), callback))
+
+  def wait(self):
+    """Block until all scheduled checkpoints are on disk."""
+    self._queue.join()
+    self._check()
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    self._queue.put(None)
+    self._thread.join()
+    self._check()
+
+
+class CheckpointManager:
+  """Indexes the checkpoints in `ckpt_dir` and applies a retention policy to them.
+
+  The index is kept in `manifest.json` and records the step, metrics and SHA-256 of every
+  checkpoint. After each save only the `keep_last` most recent checkpoints and the `keep_best`
+  checkpoints with the lowest `metric` are kept; 0 disables the respective rule and when both are
+  0 nothing is deleted. The newest checkpoint is never deleted, and with `keep_best` neither are
+  unscored checkpoints newer than the newest scored one, as their metric may still arrive. With
+  `export_ema`, a compact copy holding only the EMA weights (optionally in fp16) is written to
+  `ckpt_dir/ema/` for sampling and inverse problems.
+  """
+
+  def __init__(self, ckpt_dir, writer=None, keep_last=0, keep_best=0, metric='eval_loss',
+               export_ema=False, export_fp16=False):
+    self.ckpt_dir = ckpt_dir
+    self.writer = writer
+    self.keep_last = keep_last
+    self.keep_best = keep_best
+    self.metric = metric
+    self.export_ema = export_ema
+    self.export_fp16 = export_fp16
+    self.index_path = os.path.join(ckpt_dir, 'manifest.json')
+    self._lock = threading.Lock()
+    os.makedirs(ckpt_dir, exist_ok=True)
+    if export_ema:
+      os.makedirs(os.path.join(ckpt_dir, 'ema'), exist_ok=True)
+
+    if os.path.exists(self.index_path):
+      with open(self.index_path) as fin:
+        self.entries = json.load(fin)['checkpoints']
+    else:
+      self.entries = []
+
+  @property
+  def latest(self):
+    return max(self.entries, key=lambda e: e['step'], default=None)
+
+  def best(self, metric=None):
+    metric = metric or self.metric
+    scored = [e for e in self.entries if e['metrics'].get(metric) is not None]
+    return min(scored, key=lambda e: e['metrics'][metric], default=None)
+
+  def save(self, save_step, state, metrics=None):
+    """Save `state` as `checkpoint_{save_step}.pth` and record it in the index.
+
+    In multi-process training this has to be called on every rank; only the main process writes.
+    """
+    ckpt_path = os.path.join(self.ckpt_dir, f'checkpoint_{save_step}.pth')
+    param_names = [n for n, p in state['model'].named_parameters() if p.requires_grad]
+    metrics = {k: float(v) for k, v in (metrics or {}).items()}
+
+    def on_saved(ckpt_path, saved_state):
+      entry = dict(file=os.path.basename(ckpt_path),
+                   save_step=save_step,
+                   step=int(saved_state['step']),
+                   metrics=metrics,
+                   sha256=_sha256(ckpt_path),
+                   time=time.time())
+      if self.export_ema:
+        ema_path = os.path.join(self.ckpt_dir, 'ema', entry['file'])
+        ema_state = _ema_state_dict(saved_state['model'], param_names,
+                                    saved_state['ema']['shadow_params'], fp16=self.export_fp16)
+        _atomic_save(dict(model=ema_state, step=saved_state['step']), ema_path)
+        entry['ema'] = os.path.relpath(ema_path, self.ckpt_dir)
+        entry['ema_sha256'] = _sha256(ema_path)
+      self._add(entry)
+
+    if self.writer is None:
+      saved_state = _state_dicts(state)
+      if saved_state is not None:
+        _atomic_save(saved_state, ckpt_path)
+        on_saved(ckpt_path, saved_state)
+    else:
+      self.writer.save(ckpt_path, state, callback=on_saved)
+    return ckpt_path
+
+  def _add(self, entry):
+    with self._lock:
+      self.entries = [e for e in self.entries if e['file'] != entry['file']] + [entry]
+      removed = self._retain()
+      self._write_index()
+    for e in removed:
+      for path in (e['file'], e.get('ema')):
+        if path is None:
+          continue
+        path = os.path.join(self.ckpt_dir, path)
+        for f in (path, manifest_path(path)):
+          if os.path.exists(f):
+            os.remove(f)
+      logging.info(f"Removed checkpoint {e['file']} by retention policy")
+
+  def _retain(self):
+    if self.keep_last <= 0 and self.keep_best <= 0:
+      return []
+    # The newest checkpoint is always kept, e.g. for resuming or for an evaluator waiting for it
+    keep = {self.latest['file']}
+    if self.keep_last > 0:
+      by_step = sorted(self.entries, key=lambda e: e['step'], reverse=True)
+      keep.update(e['file'] for e in by_step[:self.keep_last])
+    if self.keep_best > 0:
+      scored = [e for e in self.entries if e['metrics'].get(self.metric) is not None]
+      by_metric = sorted(scored, key=lambda e: e['metrics'][self.metric])
+      keep.update(e['file'] for e in by_metric[:self.keep_best])
+      # Checkpoints newer than the newest scored one may still get their metric
+      newest_scored = max((e['step'] for e in scored), default=-1)
+      keep.update(e['file'] for e in self.entries
+                  if e['metrics'].get(self.metric) is None and e['step'] > newest_scored)
+    removed = [e for e in self.entries if e['file'] not in keep]
+    self.entries = [e for e in self.entries if e['file'] in keep]
+    return removed
+
+  def _write_index(self):
+    tmp_path = self.index_path + '.tmp'
+    with open(tmp_path, 'w') as fout:
+      json.dump(dict(checkpoints=sorted(self.entries, key=lambda e: e['step'])), fout, indent=2)
+      fout.flush()
+      os.fsync(fout.fileno())
+    os.replace(tmp_path, self.index_path)
+
+
+class CheckpointWatcher:
+  """Iterates over the checkpoints `checkpoint_{k}.pth` in `ckpt_dir` as they become ready.
+
+  Only the ids in `ckpts` are reported, in order of arrival. The directory is listed again only
+  when its mtime changes; while nothing arrives the polling interval doubles from `min_interval`
+  up to `max_interval` seconds.
+  """
+
+  _PATTERN = re.compile(r'^checkpoint_(\d+)\.pth$')
+
+  def __init__(self, ckpt_dir, ckpts, min_interval=1., max_interval=60.):
+    self.ckpt_dir = ckpt_dir
+    self.ckpts = list(ckpts)
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+
+  def scan(self, pending):
+    """Ready checkpoints among `pending`, oldest first."""
+    found = []
+    if not os.path.isdir(self.ckpt_dir):
+      return found
+    with os.scandir(self.ckpt_dir) as it:
+      for entry in it:
+        match = self._PATTERN.match(entry.name)
+        if match is None or int(match.group(1)) not in pending:
+          continue
+        if checkpoint_ready(entry.path):
+          found.append((entry.stat().st_mtime, int(match.group(1))))
+    return [ckpt for _, ckpt in sorted(found)]
+
+  def __iter__(self):
+    pending = set(self.ckpts)
+    interval = self.min_interval
+    last_mtime = None
+    waiting_message_printed = False
+    while pending:
+      mtime = os.stat(self.ckpt_dir).st_mtime_ns if os.path.isdir(self.ckpt_dir) else None
+      # A full listing is only needed when the directory changed, or once per slowest interval
+      if mtime != last_mtime or interval >= self.max_interval:
+        last_mtime = mtime
+        arrived = self.scan(pending)
+      else:
+        arrived = []
+
+      for ckpt in arrived:
+        pending.discard(ckpt)
+        waiting_message_printed = False
+        yield ckpt
+
+      if arrived:
+        interval = self.min_interval
+      elif pending:
+        if not waiting_message_printed:
+          logging.warning(f"Waiting for the arrival of checkpoints {sorted(pending)[:5]} in {self.ckpt_dir}")
+          waiting_message_printed = True
+        time.sleep(interval)
+        interval = min(2 * interval, self.max_interval)